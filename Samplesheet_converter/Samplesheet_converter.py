@@ -32,79 +32,122 @@
 # 1,Sample_101_S4,101_S4,HGWT5ALXX,1:1,AACCGTAA,,Project_001,
 # ------------------------------------------------------------------------------------------------------
 
-# Samplesheet_convert_v1.1
+# Samplesheet_convert_v1.2
 # Written by Chuan Wang (chuan-wang@github), 2017-03-08
 
 #!/usr/bin/python
 
+import os
 import sys
 import csv
+import glob
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 # Read index library
-def read_index_library(indexlibrary):
+# Sets of 4 single indexes: SI-GA-A1,GGTTTACT,CTAAACGG,TCGGCGTC,AACCGTAA
+# Dual indexes, as in the index CSVs of 10X: SI-TT-A1,i7,i5 (workflow a),i5 (workflow b), or SI-TT-A1,i7,i5
+# Every index name is compiled to the tuple of (index, index2) pairs its rows expand into, index2 None for single indexes
+def read_index_library(indexlibrary, i5_workflow='a'):
+    index_library = {}
     with open(indexlibrary,mode='r') as input_file:
-        indexes = csv.reader(input_file)
-        index_library = {rows[0]:[rows[1],rows[2],rows[3],rows[4]] for rows in indexes}
+        for rows in csv.reader(input_file):
+            if not rows or rows[0] == 'index_name':
+                continue
+            if len(rows) == 5:
+                index_library[rows[0]] = tuple((index, None) for index in rows[1:5])
+            elif len(rows) == 4:
+                index_library[rows[0]] = ((rows[1], rows[2] if i5_workflow == 'a' else rows[3]), )
+            elif len(rows) == 3:
+                index_library[rows[0]] = ((rows[1], rows[2]), )
+            else:
+                sys.exit("Unexpected line in index library {}: {}".format(indexlibrary, ",".join(rows)))
     return index_library
 
-# Modify samplesheet
-def modify_samplesheet(inputfile,indexlibrary):
-    index_library=read_index_library(indexlibrary)
-    modified_samplesheet=[]
-    with open(inputfile,mode='r') as org:
-        samplesheet = csv.reader(org)
-        header_flag = True
-        for row in samplesheet:
-            # Looking for the header '[Data]'
-            if header_flag:
-                if '[Data]' not in row:
-                    modified_samplesheet.append(row)
-                else:
-                    # Jump to the row with column names, specify the variable index of 'index'
-                    row = next(samplesheet)
-                    index1 = row.index("index")
-                    modified_samplesheet.append(row)
-                    header_flag = False
-            # Working with the body part of samplesheet
-            else:
-                if row[index1] not in index_library:
-                    modified_samplesheet.append(row)
-                else:
-                    index_count = 1
-                    org_row = row[:]
-                    for index in index_library[row[index1]]:
-                        row[1] += '_S'
-                        row[1] += str(index_count)
-                        row[2] += '_S'
-                        row[2] += str(index_count)
-                        row[index1] = index
-                        modified_samplesheet.append(row)
-                        index_count += 1
-                        row = org_row[:]
-    return modified_samplesheet
+# Expand the rows of a samplesheet, one at a time
+def expand_samplesheet(samplesheet, index_library):
+    header_flag = True
+    for row in samplesheet:
+        # Looking for the header '[Data]'
+        if header_flag:
+            yield row
+            if '[Data]' in row:
+                # Jump to the row with column names, specify the variable index of 'index' and 'index2'
+                row = next(samplesheet)
+                index1 = row.index("index")
+                index2 = row.index("index2") if "index2" in row else None
+                yield row
+                header_flag = False
+        # Working with the body part of samplesheet
+        elif row[index1] not in index_library:
+            yield row
+        else:
+            indexes = index_library[row[index1]]
+            for index_count, (index, index_2) in enumerate(indexes, 1):
+                new_row = row[:]
+                # Sets of indexes give one sample per index, suffixed with _Sx
+                if len(indexes) > 1:
+                    new_row[1] = "{}_S{}".format(row[1], index_count)
+                    new_row[2] = "{}_S{}".format(row[2], index_count)
+                new_row[index1] = index
+                if index_2 is not None:
+                    if index2 is None:
+                        sys.exit("Dual index {} found in a samplesheet without index2 column".format(row[index1]))
+                    new_row[index2] = index_2
+                yield new_row
+
+# Convert a samplesheet, writing the rows as they are expanded to <outputfile>.part, renamed once complete
+# (so that the output can be the input file itself); the .part file is removed if the conversion fails
+def convert_samplesheet(inputfile, outputfile, index_library):
+    partfile = outputfile + '.part'
+    try:
+        with open(inputfile,mode='r') as org, open(partfile,mode='w') as new_samplesheet:
+            writer = csv.writer(new_samplesheet)
+            writer.writerows(expand_samplesheet(csv.reader(org), index_library))
+        os.rename(partfile, outputfile)
+    except BaseException:
+        if os.path.exists(partfile):
+            os.remove(partfile)
+        raise
+    return outputfile
 
-# Write new samplesheet
-def write_new_samplesheet(modified_samplesheet,outputfile):
-    with open(outputfile,mode='w') as new_samplesheet:
-        writer=csv.writer(new_samplesheet)
-        for row in modified_samplesheet:
-            writer.writerow(row)
+# Samplesheets to convert: the files given, and the csv files of the directories given (e.g. run directories)
+def list_samplesheets(inputs):
+    samplesheets = []
+    for path in inputs:
+        if os.path.isdir(path):
+            samplesheets.extend(sorted(glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            samplesheets.append(path)
+    return samplesheets
 
 # Main
-def main(argv):
-    inputfile = args.inputfile
-    outputfile  = args.outputfile
-    indexlibrary = args.indexlibrary
+def main(args):
+    inputfiles = list_samplesheets(args.inputfile)
+    index_library = read_index_library(args.indexlibrary, args.i5_workflow)
 
-    modified_samplesheet = modify_samplesheet(inputfile,indexlibrary)
-    write_new_samplesheet(modified_samplesheet,outputfile)
+    if len(args.inputfile) == 1 and not os.path.isdir(args.inputfile[0]):
+        convert_samplesheet(inputfiles[0], args.outputfile, index_library)
+        return
+    # Several samplesheets: the output is a directory where they keep their file names
+    if not os.path.isdir(args.outputfile):
+        os.makedirs(args.outputfile)
+    outputfiles = [os.path.join(args.outputfile, os.path.basename(inputfile)) for inputfile in inputfiles]
+    if len(set(outputfiles)) < len(outputfiles):
+        sys.exit("Samplesheets with the same file name would overwrite each other in {}".format(args.outputfile))
+    if set(map(os.path.realpath, outputfiles)) & set(map(os.path.realpath, inputfiles)):
+        sys.exit("The output directory {} would overwrite the input samplesheets, use another directory".format(args.outputfile))
+    with ProcessPoolExecutor(args.workers) as pool:
+        for outputfile in pool.map(convert_samplesheet, inputfiles, outputfiles, [index_library] * len(inputfiles)):
+            print("Written {}".format(outputfile))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', dest="inputfile", help="Original samplesheet", type=str, required=True, default=False)
-    parser.add_argument('-o', dest="outputfile", help="Output modified samplesheet", type=str, required=True, default=False)
+    parser.add_argument('-i', dest="inputfile", help="Original samplesheet(s), or directories whose csv files are converted", type=str, nargs='+', required=True, default=False)
+    parser.add_argument('-o', dest="outputfile", help="Output modified samplesheet, or output directory when converting several samplesheets", type=str, required=True, default=False)
     parser.add_argument('-x', dest="indexlibrary", help="Index library", type=str, required=True, default='Chromium_10X_indexes')
+    parser.add_argument('--i5-workflow', dest="i5_workflow", help="i5 column used for dual indexes of 10X index CSVs: a (forward strand) or b (reverse complement)", choices=('a', 'b'), default='a')
+    parser.add_argument('--workers', dest="workers", help="Number of samplesheets converted in parallel", type=int, default=1)
     args = parser.parse_args()
 
     main(args)
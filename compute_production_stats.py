@@ -11,8 +11,11 @@ import json
 import distance
 import operator
 import time
+import functools
+import pandas as pd
 from datetime import  date
 from datetime import  datetime
+from statusdb_flowcells import add_reader_arguments, check_reader_arguments, reader_from_args
 try:
     import ConfigParser
 except ImportError:
@@ -69,11 +72,159 @@ def get_FC_type(FCid):
 
 
 
-def parse_flowcell_db():
-    couch       = setupServer(CONFIG)
-    #fetch info about proejcts (reference type)
-    projectsDB = couch["projects"]
-    project_summary = projectsDB.view("project/summary")
+#bumped whenever the columns or the rows of the lane table change, so that saved tables are built again
+LANE_TABLE_VERSION = 2
+#columns of the lane table, record tells the kind of row:
+# - lane: an entry of illumina.Demultiplex_Stats.Barcode_lane_statistics
+# - samplesheet: an entry of samplesheet_csv (lane, sample and project only)
+# - flowcell: one per flowcell document, yield_mbases is the yield of the whole flowcell
+#   (Flowcell_stats in x_flowcells, the sum of Barcode_lane_statistics in flowcells)
+LANE_TABLE_COLUMNS = ['db', 'record', 'flowcell_id', 'flowcell', 'instrument', 'date', 'lane', 'sample', 'project',
+                      'barcode', 'clusters', 'yield_mbases', 'pc_lane', 'undetermined']
+
+#the two flowcell databases do not name the Barcode_lane_statistics fields in the same way,
+#for each column the first field found is used
+LANE_FIELDS = {
+    'x_flowcells': {'sample': ('Sample',),
+                    'project': ('Sample_Project', 'Project'),
+                    'barcode': ('Barcode sequence',),
+                    'clusters': ('PF Clusters', 'Clusters'),
+                    'yield_mbases': ('Yield (Mbases)', 'Yield (MBases)'),
+                    'pc_lane': ('% of thelane',)},
+    'flowcells':   {'sample': ('Sample ID',),
+                    'project': ('Description', 'Project'),
+                    'barcode': ('Index',),
+                    'clusters': ('# Reads', 'Clusters'),
+                    'yield_mbases': ('Yield (Mbases)', 'Yield (MBases)'),
+                    'pc_lane': ('% of raw clusters per lane',)},
+}
+
+
+def normalise_project_name(project):
+    """Turns the project names found in the flowcell documents (e.g. a_test_15_01, A__test_15_01) into A.test_15_01"""
+    project = project.strip()
+    if "." not in project:
+        project = project.replace("__", "_").replace("_", ".", 1)
+    if "." in project:
+        project_pieaces = project.split(".")
+        project = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
+    return project
+
+
+def _first_field(entry, fields):
+    for field in fields:
+        if field in entry:
+            return entry[field]
+    return None
+
+
+def _flowcell_yield(demultiplex_stats, lane_stats, db_name):
+    #as the yearly production has always been computed
+    if db_name == 'x_flowcells':
+        return demultiplex_stats.get('Flowcell_stats', {}).get('Yield (MBases)')
+    if lane_stats is None:
+        return None
+    try:
+        return sum(int(entry['Yield (Mbases)'].replace(',', '')) for entry in lane_stats)
+    except (KeyError, AttributeError, ValueError):
+        return None
+
+
+def flowcell_lane_rows(fc_doc, db_name):
+    """Yields the rows (tuples ordered as LANE_TABLE_COLUMNS) of a flowcell document: one flowcell row,
+    one samplesheet row per samplesheet_csv entry and one lane row per Barcode_lane_statistics entry"""
+    run_info = fc_doc.get('RunInfo', {})
+    if 'Id' not in run_info or 'Date' not in run_info:
+        return
+    flowcell = (run_info['Id'], run_info.get('Flowcell', ""), run_info.get('Instrument', ""), run_info['Date'])
+    demultiplex_stats = fc_doc.get('illumina', {}).get('Demultiplex_Stats')
+    if not isinstance(demultiplex_stats, dict):
+        demultiplex_stats = None
+    lane_stats = demultiplex_stats.get('Barcode_lane_statistics') if demultiplex_stats is not None else None
+    flowcell_yield = _flowcell_yield(demultiplex_stats, lane_stats, db_name) if demultiplex_stats is not None else None
+    yield (db_name, 'flowcell') + flowcell + ("", "", "", "", None, flowcell_yield, None, False)
+    for entry in fc_doc.get('samplesheet_csv') or []:
+        project = _first_field(entry, ('Sample_Project', 'Project')) or ""
+        yield ((db_name, 'samplesheet') + flowcell +
+               (entry.get('Lane', ""), _first_field(entry, ('Sample_ID', 'SampleID')) or "", normalise_project_name(project),
+                "", None, None, None, False))
+    fields = LANE_FIELDS[db_name]
+    for entry in lane_stats or []:
+        sample = _first_field(entry, fields['sample']) or ""
+        barcode = _first_field(entry, fields['barcode']) or ""
+        project = _first_field(entry, fields['project']) or ""
+        yield (db_name, 'lane') + flowcell + (
+               entry.get('Lane', ""),
+               sample,
+               normalise_project_name(project),
+               barcode,
+               _first_field(entry, fields['clusters']),
+               _first_field(entry, fields['yield_mbases']),
+               _first_field(entry, fields['pc_lane']),
+               sample in ('unknown', 'Undetermined') or barcode in ('unknown', 'Undetermined'))
+
+
+def _lane_records(db_name, fc_docs):
+    records = []
+    for fc_doc in fc_docs:
+        records.extend(flowcell_lane_rows(fc_doc, db_name))
+    return records
+
+
+def _to_number(column):
+    """Vectorised conversion of strings like '1,234' to numbers, empty or missing values become NaN"""
+    return pd.to_numeric(column.astype(str).str.replace(',', '', regex=False), errors='coerce')
+
+
+def build_lane_table(fc_reader, db_names=('flowcells', 'x_flowcells')):
+    """Flattens the flowcell databases in a single pass into a typed lane table (pandas.DataFrame).
+
+    Rows keep the order of the databases in db_names and of the documents within them.
+    """
+    records = []
+    for db_name in db_names:
+        #with more than one worker the databases are read and flattened in parallel by ranges of documents
+        for partition_records in fc_reader.map_partitions(db_name, functools.partial(_lane_records, db_name)):
+            records.extend(partition_records)
+    table = pd.DataFrame.from_records(records, columns=LANE_TABLE_COLUMNS)
+    table['date'] = pd.to_datetime(table['date'].str[0:6], format='%y%m%d', errors='coerce')
+    table['clusters'] = _to_number(table['clusters'])
+    table['yield_mbases'] = _to_number(table['yield_mbases'])
+    table['pc_lane'] = _to_number(table['pc_lane'])
+    table['undetermined'] = table['undetermined'].astype(bool)
+    for column in ('db', 'record', 'instrument', 'lane', 'project'):
+        table[column] = table[column].astype('category')
+    return table
+
+
+def load_lane_table(fc_reader, lane_table_file=None, rebuild=False, db_names=('flowcells', 'x_flowcells')):
+    """Returns the lane table, read from lane_table_file (Parquet) when it is up to date.
+
+    The sequences of the flowcell databases the table was built at are kept next to it in
+    <lane_table_file>.json. The table is built again (and saved, if lane_table_file is given)
+    when the file does not exist, when the databases (or the local cache) have changed since,
+    or when rebuild is set.
+    """
+    if lane_table_file is None:
+        return build_lane_table(fc_reader, db_names)
+    #through json, so that the sequences compare equal to the stored ones
+    state = json.loads(json.dumps({'version': LANE_TABLE_VERSION,
+                                   'sequences': dict((db_name, fc_reader.update_seq(db_name)) for db_name in db_names)}))
+    state_file = "{}.json".format(lane_table_file)
+    if not rebuild and os.path.exists(lane_table_file) and os.path.exists(state_file):
+        with open(state_file) as saved_state:
+            if json.load(saved_state) == state:
+                return pd.read_parquet(lane_table_file)
+    table = build_lane_table(fc_reader, db_names)
+    table.to_parquet(lane_table_file, index=False)
+    with open(state_file, 'w') as saved_state:
+        json.dump(state, saved_state)
+    return table
+
+
+def fetch_reference_genomes(couch):
+    """Returns a dict project_name -> reference genome from the projects database"""
+    project_summary = couch["projects"].view("project/summary")
     projects = {}
     for row in project_summary:
         if "project_name" not in row.value:
@@ -82,119 +233,55 @@ def parse_flowcell_db():
             projects[row.value["project_name"]] = row.value["reference_genome"]
         else:
             projects[row.value["project_name"]] = "None"
+    return projects
 
-    flowcell_db = couch["x_flowcells"]
-    flowcells   = {}
 
+def parse_flowcell_db(lane_table):
+    couch       = setupServer(CONFIG)
+    #fetch info about proejcts (reference type)
+    projects = fetch_reference_genomes(couch)
+
+    #only the samplesheets of x_flowcells, of the flowcells run in 2016 (date of the flowcell id)
+    samples = lane_table[(lane_table['db'] == 'x_flowcells') & (lane_table['record'] == 'samplesheet')]
+    samples = samples[['flowcell_id', 'lane', 'project']].astype(str)
+    fc_dates = pd.to_datetime(samples['flowcell_id'].str[0:6], format='%y%m%d', errors='coerce')
+    samples = samples[(fc_dates >= datetime(2016, 1, 1)) & (fc_dates < datetime(2017, 1, 1))]
+    samples['instrument_type'] = samples['flowcell_id'].map(get_FC_type)
+    samples.loc[samples['instrument_type'] == "MiSeq", 'lane'] = "1"
+    for project in sorted(set(samples['project']) - set(projects)):
+        print("{} not found in projects".format(project))
+    samples['reference'] = samples['project'].map(projects)
+
+    #a lane is human if all its projects are hg19, mixed if its projects have different references
+    lane_keys = ['instrument_type', 'flowcell_id', 'lane']
+    lanes = samples.groupby(lane_keys)['reference'].agg(['nunique', 'first']).reset_index()
+    lanes['lane_type'] = "non-human"
+    lanes.loc[(lanes['nunique'] == 1) & (lanes['first'] == "hg19"), 'lane_type'] = "human"
+    lanes.loc[lanes['nunique'] > 1, 'lane_type'] = "mixed"
+
+    fc_counts = lanes.groupby('instrument_type')['flowcell_id'].nunique()
+    instrument_lane_counts = lanes.groupby('instrument_type').size()
+    lane_counts = lanes.groupby(['instrument_type', 'lane_type']).size()
     instrument_types = ["HiSeqX", "MiSeq", "HiSeq2500"]
     for instrument_type in instrument_types:
-        flowcells[instrument_type] = {}
-
-    for fc_doc in flowcell_db:
-        try:
-            samplesheet_csv = flowcell_db[fc_doc]["samplesheet_csv"]
-        except KeyError:
-            if "RunInfo" in flowcell_db[fc_doc]:
-                print("{}".format(flowcell_db[fc_doc]["RunInfo"]["Id"]))
-            continue
-        flowcell_id     = flowcell_db[fc_doc]["RunInfo"]["Id"]
-        instrument_type = get_FC_type(flowcell_id)
-        if flowcell_id not in flowcells[instrument_type]:
-            flowcells[instrument_type][flowcell_id] = {}
-
-        for sample_lane in samplesheet_csv:
-            if instrument_type == "MiSeq":
-                lane = "1"
-            else:
-                lane = sample_lane["Lane"]
-            if lane not in flowcells[instrument_type][flowcell_id]:
-                flowcells[instrument_type][flowcell_id][lane] = {}
-            if "Sample_Project"  in sample_lane:
-                project = sample_lane["Sample_Project"].strip()
-            elif "Project" in sample_lane:
-                project = sample_lane["Project"].strip()
-            else:
-                print("WRONG")
-            # now correct the project
-            if "." not in project:
-                project = project.replace("__", "_").replace("_", ".", 1)
-            if "." in project:
-                project_pieaces = project.split(".")
-                project = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
-
-            if project not in projects:
-                print("{} not found in projects".format(project))
-                continue
-            if project in flowcells[instrument_type][flowcell_id][lane]:
-                # cehck that it is the same
-                if projects[project] != flowcells[instrument_type][flowcell_id][lane][project]:
-                    print("stange found same  project but different organisms")
-            else:
-                flowcells[instrument_type][flowcell_id][lane][project] = projects[project]
-
-    #now in flowcell I have a full list of instrument/FCid/lanes/Project and organism
-    #now i can pull all the stats I want
-    date_low_limit = date(16,1,1)
-    date_upper_limit = date(17,1,1)
-    total_number_FC    = 0
-    total_number_lanes = 0
-    total_number_human_lanes     = 0
-    total_number_non_human_lanes = 0
-    total_number_mixed_lanes     = 0
-    for instrument_type in flowcells:
-        instrument_number_FC    = 0
-        instrument_number_lanes = 0
-        instrument_number_human_lanes     = 0
-        instrument_number_non_human_lanes = 0
-        instrument_number_mixed_lanes     = 0
-        for flowcell_id in flowcells[instrument_type]:
-            start_date_string = flowcell_id
-            year = start_date_string[0:2]
-            month = start_date_string[2:4]
-            day = start_date_string[4:6]
-            fc_date = date(int(year), int(month), int(day))
-            if fc_date >= date_low_limit and fc_date < date_upper_limit:
-                total_number_FC += 1
-                instrument_number_FC += 1
-                for lane in flowcells[instrument_type][flowcell_id]:
-                    total_number_lanes += 1
-                    instrument_number_lanes += 1
-                    lane_type = ""
-                    for project in flowcells[instrument_type][flowcell_id][lane]:
-                        if lane_type == "":
-                            lane_type = flowcells[instrument_type][flowcell_id][lane][project]
-                        elif lane_type !=  flowcells[instrument_type][flowcell_id][lane][project]:
-                            lane_type = "mixed"
-                        else:
-                            lane_type = flowcells[instrument_type][flowcell_id][lane][project]
-                    if lane_type == "mixed":
-                        total_number_mixed_lanes += 1
-                        instrument_number_mixed_lanes += 1
-                    elif lane_type == "hg19":
-                        total_number_human_lanes += 1
-                        instrument_number_human_lanes += 1
-                    else:
-                        total_number_non_human_lanes += 1
-                        instrument_number_non_human_lanes += 1
-            else:
-                continue
         print("{}".format(instrument_type))
-        print("\tNumber of FC: {}".format(instrument_number_FC))
-        print("\tNumber of lanes: {}".format(instrument_number_lanes))
-        print("\tNumber of Human lanes: {}".format(instrument_number_human_lanes))
-        print("\tNumber of Non-Human lanes: {}".format(instrument_number_non_human_lanes))
-        print("\tNumber of Mixed lanes: {}".format(instrument_number_mixed_lanes))
+        print("\tNumber of FC: {}".format(fc_counts.get(instrument_type, 0)))
+        print("\tNumber of lanes: {}".format(instrument_lane_counts.get(instrument_type, 0)))
+        print("\tNumber of Human lanes: {}".format(lane_counts.get((instrument_type, "human"), 0)))
+        print("\tNumber of Non-Human lanes: {}".format(lane_counts.get((instrument_type, "non-human"), 0)))
+        print("\tNumber of Mixed lanes: {}".format(lane_counts.get((instrument_type, "mixed"), 0)))
+    lane_type_counts = lanes.groupby('lane_type').size()
     print("TOTAL")
-    print("\tNumber of FC: {}".format(total_number_FC))
-    print("\tNumber of lanes: {}".format(total_number_lanes))
-    print("\tNumber of Human lanes: {}".format(total_number_human_lanes))
-    print("\tNumber of Non-Human lanes: {}".format(total_number_non_human_lanes))
-    print("\tNumber of Mixed lanes: {}".format(total_number_mixed_lanes))
+    print("\tNumber of FC: {}".format(fc_counts.sum()))
+    print("\tNumber of lanes: {}".format(len(lanes)))
+    print("\tNumber of Human lanes: {}".format(lane_type_counts.get("human", 0)))
+    print("\tNumber of Non-Human lanes: {}".format(lane_type_counts.get("non-human", 0)))
+    print("\tNumber of Mixed lanes: {}".format(lane_type_counts.get("mixed", 0)))
 
 
 
 
-def instrument_usage():
+def instrument_usage(lane_table):
     couch       = setupServer(CONFIG)
     #fetch info about proejcts (reference type)
     projectsDB = couch["projects"]
@@ -230,278 +317,215 @@ def instrument_usage():
                 else:
                     instruments[instrument]['setup'][sequencing_setup] += 1
             project_name = row.value["project_name"]
-            projects[project_name] = {'sequencing_platform': instrument,
-                                        'sequencing_setup' :  sequencing_setup,
-                                        'samples_sequenced': set(),
-                                        'lanes': 0,
-                                        'sequencers' : set()
-                                        }
-    flowcell_db = couch["x_flowcells"]
-    project_sequenced = {}
-    instrument_runs_per_week = {}
-    for fc_doc in flowcell_db:
-        if 'RunInfo' not in flowcell_db[fc_doc]:
-            continue
-        instrument = flowcell_db[fc_doc]["RunInfo"]['Instrument']
-        if 'illumina' not in flowcell_db[fc_doc]:
-            print("Not illumina field found in doc")
-            continue
-        if 'Demultiplex_Stats' not in  flowcell_db[fc_doc]['illumina']:
-            print("Not Demultiplex_Stats field found in doc")
-            continue
-        if 'Barcode_lane_statistics' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-            print("Not Barcode_lane_statistics field found in doc")
-            continue
-        projects_in_lanes = {}
-        for sample_lane in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
-            if sample_lane['Sample'] == 'unknown' :
-                continue
-            if "Sample_Project"  in sample_lane:
-                project = sample_lane["Sample_Project"].strip()
-            elif "Project" in sample_lane:
-                project = sample_lane["Project"].strip()
-            else:
-                print("WRONG")
-            # now correct the project
-            if "." not in project:
-                project = project.replace("__", "_").replace("_", ".", 1)
-            if "." in project:
-                project_pieaces = project.split(".")
-                project = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
-
-            if project == "default":
-                continue
-            elif project not in projects:
-                continue
-            projects[project]['samples_sequenced'].update([sample_lane['Sample']])
-            projects[project]['sequencers'].update([instrument])
-            lane = sample_lane['Lane']
-            if lane not in projects_in_lanes:
-                projects_in_lanes[lane] = {}
-            if project not in projects_in_lanes[lane] :
-                projects_in_lanes[lane][project] = 1
-            else:
-                projects_in_lanes[lane][project] += 1
-        year  = int("20" + flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-        month =  int(flowcell_db[fc_doc]['RunInfo']['Date'][2:4])
-        day   = int(flowcell_db[fc_doc]['RunInfo']['Date'][4:6])
-        date_seq = datetime(year , month , day )
-        if instrument not in instrument_runs_per_week:
-            instrument_runs_per_week[instrument] = {}
-        date_entry = "{}_{}".format(year, month) #date_seq.isocalendar()[1]) # year plus week number
-        if date_entry not in instrument_runs_per_week[instrument]:
-            instrument_runs_per_week[instrument][date_entry] = 1
-        else:
-            instrument_runs_per_week[instrument][date_entry] += 1
-        for lane in projects_in_lanes:
-            for project in projects_in_lanes[lane]:
-                projects[project]['lanes'] += 1
-                if 'date' in projects[project]:
-                    if projects[project]['date'] < date_seq:
-                        projects[project]['date'] = date_seq
-                else:
-                    projects[project]['date'] = date_seq
-    flowcell_db = couch["flowcells"]
-    for fc_doc in flowcell_db:
-        if 'RunInfo' not in flowcell_db[fc_doc]:
-            continue
-        if 'Date' not in flowcell_db[fc_doc]['RunInfo']:
-            continue
-        year = int(flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-        if year < 13:
-            print("run {} too old".format(flowcell_db[fc_doc]['RunInfo']['Id']))
-            continue
-        if 'Instrument' not in flowcell_db[fc_doc]["RunInfo"]:
-            print("ERROR: Instrument not found in RunInfo: how is this possible?")
-            exit
+            projects[project_name] = sequencing_setup
 
-        instrument = flowcell_db[fc_doc]["RunInfo"]['Instrument']
-        if 'illumina' not in flowcell_db[fc_doc]:
-            print("Not illumina field found in doc {}".format(fc_doc))
-            continue
-        if 'Demultiplex_Stats' not in  flowcell_db[fc_doc]['illumina']:
-            print("Not Demultiplex_Stats field found in doc {}".format(fc_doc))
-            continue
-        if 'Barcode_lane_statistics' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-            print("Not Barcode_lane_statistics field found in doc {}".format(fc_doc))
-            continue
-
-        projects_in_lanes = {}
-        for sample_lane in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
-            if sample_lane['Sample ID'] == 'unknown' :
-                continue
-            if "Description"  in sample_lane:
-                project = sample_lane["Description"].strip()
-            elif "Project" in sample_lane:
-                project = sample_lane["Project"].strip()
-            else:
-                print("WRONG")
-            # now correct the project
-            if "." not in project:
-                project = project.replace("__", "_").replace("_", ".", 1)
-            if "." in project:
-                project_pieaces = project.split(".")
-                project = "{}.{}".format(project_pieaces[0].upper(), project_pieaces[1])
-
-            if project == "default":
-                continue
-            elif project not in projects:
-                continue
-            elif len(projects[project]['samples_sequenced']) > 0:
-                continue #it means I have already saw this i x_flowcell db
-            projects[project]['samples_sequenced'].update([sample_lane['Sample ID']])
-            projects[project]['sequencers'].update([instrument])
-            lane = sample_lane['Lane']
-            if lane not in projects_in_lanes:
-                projects_in_lanes[lane] = {}
-            if project not in projects_in_lanes[lane] :
-                projects_in_lanes[lane][project] = 1
-            else:
-                projects_in_lanes[lane][project] += 1
-        year  = int("20" + flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-        month =  int(flowcell_db[fc_doc]['RunInfo']['Date'][2:4])
-        day   = int(flowcell_db[fc_doc]['RunInfo']['Date'][4:6])
-        date_seq = datetime(year , month , day )
-        if instrument not in instrument_runs_per_week:
-            instrument_runs_per_week[instrument] = {}
-        date_entry = "{}_{}".format(year, month) #date_seq.isocalendar()[1]) # year plus week number
-        if date_entry not in instrument_runs_per_week[instrument]:
-            instrument_runs_per_week[instrument][date_entry] = 1
-        else:
-            instrument_runs_per_week[instrument][date_entry] += 1
-
-        for lane in projects_in_lanes:
-            for project in projects_in_lanes[lane]:
-                projects[project]['lanes'] += 1
-                if 'date' in projects[project]:
-                    if projects[project]['date'] < date_seq:
-                        projects[project]['date'] = date_seq
-                else:
-                    projects[project]['date'] = date_seq
+    lane_table = lane_table[lane_table['record'] == 'lane']
+    #runs from the old flowcells db are considered only from 2013
+    runs = lane_table[lane_table['date'].notna() &
+                      ((lane_table['db'] == 'x_flowcells') | (lane_table['date'] >= datetime(2013, 1, 1)))]
+    runs = runs[['db', 'flowcell_id', 'instrument', 'date']].astype({'db': str, 'instrument': str}).drop_duplicates()
+    runs['date_entry'] = runs['date'].dt.year.astype(int).astype(str) + "_" + runs['date'].dt.month.astype(int).astype(str)
+    instrument_runs_per_month = runs.groupby(['instrument', 'date_entry']).size()
 
     years = [2013, 2014, 2015, 2016, 2017]
+    run_instruments = sorted(runs['instrument'].unique())
     sys.stdout.write('date,')
-    for instrument in sorted(instrument_runs_per_week):
+    for instrument in run_instruments:
         sys.stdout.write('{},'.format(instrument))
     sys.stdout.write('\n')
     for year in years:
         for week in range(1,13):
             date_to_search = "{}_{}".format(year, week)
             sys.stdout.write('{},'.format(date_to_search))
-            for instrument in sorted(instrument_runs_per_week):
-                if date_to_search in instrument_runs_per_week[instrument]:
-                    sys.stdout.write('{},'.format(instrument_runs_per_week[instrument][date_to_search]))
-                else:
-                    sys.stdout.write('0,')
+            for instrument in run_instruments:
+                sys.stdout.write('{},'.format(instrument_runs_per_month.get((instrument, date_to_search), 0)))
             sys.stdout.write('\n')
     sys.stdout.write('\n')
 
-    years = [2013, 2014, 2015, 2016, 2017]
-    sequencers_year_setup = {}
-    sequencers_setup = set([ projects[project]['sequencing_setup'] for project in projects if projects[project]['lanes'] > 0])
-    for project in projects:
-        if len(projects[project]['sequencers']) == 0:
-            continue
-        year = projects[project]['date'].year
-        samples = len(projects[project]['samples_sequenced'])
-        sequencers = projects[project]['sequencers']
-        sequencing_setup = projects[project]['sequencing_setup']
-        for sequencer in sequencers:
-            if sequencer not in sequencers_year_setup:
-                sequencers_year_setup[sequencer] = {}
-            if year not in sequencers_year_setup[sequencer]:
-                sequencers_year_setup[sequencer][year] = {}
-            if sequencing_setup not in sequencers_year_setup[sequencer][year]:
-                sequencers_year_setup[sequencer][year][sequencing_setup] = samples
-            else:
-                sequencers_year_setup[sequencer][year][sequencing_setup] += samples
-
-
-    for sequencer in sorted(sequencers_year_setup):
+    #sequenced samples of the known projects, projects already seen in x_flowcells are not taken from flowcells
+    samples = lane_table[~lane_table['undetermined'] & lane_table['date'].notna()]
+    samples = samples[['db', 'flowcell_id', 'instrument', 'date', 'lane', 'sample', 'project']].astype(
+        {'db': str, 'instrument': str, 'lane': str, 'project': str})
+    samples = samples[samples['project'].isin(projects)]
+    x_samples = samples[samples['db'] == 'x_flowcells']
+    old_samples = samples[(samples['db'] == 'flowcells') & (samples['date'] >= datetime(2013, 1, 1)) &
+                          ~samples['project'].isin(set(x_samples['project']))]
+    #as before, only the first sample found in flowcells is counted for those projects (with its instrument and date)
+    samples = pd.concat([x_samples, old_samples.drop_duplicates('project')])
+
+    project_stats = samples.groupby('project').agg(samples=('sample', 'nunique'), date=('date', 'max'))
+    project_stats['year'] = project_stats['date'].dt.year
+    project_stats['setup'] = project_stats.index.map(projects)
+    sequencers_setup = set(project_stats['setup'])
+    project_sequencers = samples[['project', 'instrument']].drop_duplicates()
+    sequencers_year_setup = project_sequencers.join(project_stats, on='project').groupby(
+        ['instrument', 'year', 'setup'])['samples'].sum()
+
+    for sequencer in sorted(project_sequencers['instrument'].unique()):
         sys.stdout.write('{}\n'.format(sequencer))
         for setup in sorted(sequencers_setup):
             sys.stdout.write('{},'.format(setup))
             for year in sorted(years):
-                if year not in sequencers_year_setup[sequencer]:
-                    #this sequencer, this year had no runs
-                    sys.stdout.write('0,')
-                else:
-                     if setup not in sequencers_year_setup[sequencer][year]:
-                        #it means that this sequencer this year has not such setup
-                        sys.stdout.write('0,')
-                     else:
-                        sys.stdout.write('{},'.format(sequencers_year_setup[sequencer][year][setup]))
+                sys.stdout.write('{},'.format(sequencers_year_setup.get((sequencer, year, setup), 0)))
             sys.stdout.write('\n')
 
 
-def year_bp_production():
-    couch       = setupServer(CONFIG)
-    db_names = ['flowcells', 'x_flowcells']
-    flowcells   = {}
-    production_stats = {}
-    for db_name in db_names:
-        flowcell_db = couch[db_name]
-        for fc_doc in flowcell_db:
-            if 'RunInfo' not in flowcell_db[fc_doc]:
-                continue
-            if 'Flowcell' not in flowcell_db[fc_doc]['RunInfo']:
-                continue
-            fc_name = flowcell_db[fc_doc]['RunInfo']['Flowcell']
-            if fc_name in flowcells:
-                continue
-            else:
-                flowcells[fc_name] = 0
-            year  = int(flowcell_db[fc_doc]['RunInfo']['Date'][0:2])
-            month = int(flowcell_db[fc_doc]['RunInfo']['Date'][2:4])
-            if year < 12:
-                continue
-            yield_MBases = 0
-            if 'illumina' not in flowcell_db[fc_doc]:
-                continue
-            if 'Demultiplex_Stats' not in flowcell_db[fc_doc]['illumina']:
-                continue
-            if db_name == "x_flowcells":
-                if 'Flowcell_stats' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-                    continue
-                if 'Yield (MBases)' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Flowcell_stats']:
-                    continue
-                yield_MBases = int(flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Flowcell_stats']['Yield (MBases)'].replace(',', ''))
-            else:
-                if 'Barcode_lane_statistics' not in  flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
-                    continue
-                for sample  in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']:
-                    yield_MBases +=  int(sample['Yield (Mbases)'].replace(',', ''))
-
-            if year not in production_stats:
-                production_stats[year] = month_production = [0]*12
-            production_stats[year][month-1] += yield_MBases
+def year_bp_production(lane_table):
+    #a flowcell present in both databases is counted once, from the first document found (flowcells first)
+    flowcells = lane_table[(lane_table['record'] == 'flowcell') & (lane_table['flowcell'] != "")]
+    production = flowcells.drop_duplicates('flowcell')
+    production = production[(production['date'] >= datetime(2012, 1, 1)) & production['yield_mbases'].notna()]
+    production_stats = production.groupby([production['date'].dt.year % 100, production['date'].dt.month])[
+        'yield_mbases'].sum().astype(int)
+    production_years = sorted(production_stats.index.get_level_values(0).unique())
     sys.stdout.write(',')
-    for year in sorted(production_stats):
+    for year in production_years:
         sys.stdout.write('{},'.format(year))
     sys.stdout.write('\n')
     for month in range(0,12,1):
         sys.stdout.write('{},'.format(month+1))
-        for year in sorted(production_stats):
-            sys.stdout.write('{},'.format(production_stats[year][month]))
+        for year in production_years:
+            sys.stdout.write('{},'.format(production_stats.get((year, month+1), 0)))
         sys.stdout.write('\n')
     sys.stdout.write('\n')
 
 
 
+#design document deployed in the flowcell databases by the deploy-views mode, its views
+#are keyed by [instrument, year, month] so that they can be queried with group_level 1 to 3
+PRODUCTION_DESIGN_DOC_ID = "_design/production"
+PRODUCTION_MAP_HEADER = """function(doc) {
+    if (!doc.RunInfo || !doc.RunInfo.Date || !doc.RunInfo.Instrument || !doc.illumina || !doc.illumina.Demultiplex_Stats ||
+        !doc.illumina.Demultiplex_Stats.Barcode_lane_statistics) {
+        return;
+    }
+    var date = doc.RunInfo.Date;
+    var key = [doc.RunInfo.Instrument, 2000 + parseInt(date.substring(0, 2), 10), parseInt(date.substring(2, 4), 10)];
+    var lanes = {};
+    var number_of_lanes = 0;
+    var yield_mbases = 0;
+    doc.illumina.Demultiplex_Stats.Barcode_lane_statistics.forEach(function(entry) {
+        if (!(entry.Lane in lanes)) {
+            lanes[entry.Lane] = true;
+            number_of_lanes += 1;
+        }
+        var lane_yield = parseInt(String(entry['Yield (Mbases)'] || entry['Yield (MBases)'] || '0').replace(/,/g, ''), 10);
+        if (!isNaN(lane_yield)) {
+            yield_mbases += lane_yield;
+        }
+    });
+"""
+PRODUCTION_DESIGN_DOC = {
+    "_id": PRODUCTION_DESIGN_DOC_ID,
+    "language": "javascript",
+    "views": {
+        #_stats gives the total yield (sum) and the number of flowcells (count)
+        "yield_by_month": {
+            "map": PRODUCTION_MAP_HEADER + "    emit(key, yield_mbases);\n}",
+            "reduce": "_stats"
+        },
+        "lanes_by_month": {
+            "map": PRODUCTION_MAP_HEADER + "    emit(key, number_of_lanes);\n}",
+            "reduce": "_sum"
+        }
+    }
+}
+
+
+def deploy_views(couch, db_names=('flowcells', 'x_flowcells')):
+    """Saves PRODUCTION_DESIGN_DOC in the flowcell databases, updating it when it differs"""
+    for db_name in db_names:
+        flowcell_db = couch[db_name]
+        design_doc = dict(PRODUCTION_DESIGN_DOC)
+        existing = flowcell_db.get(PRODUCTION_DESIGN_DOC_ID)
+        if existing is not None:
+            if existing.get('views') == design_doc['views']:
+                print("{}: {} already up to date".format(db_name, PRODUCTION_DESIGN_DOC_ID))
+                continue
+            design_doc['_rev'] = existing['_rev']
+        flowcell_db.save(design_doc)
+        print("{}: {} deployed".format(db_name, PRODUCTION_DESIGN_DOC_ID))
+
+
+def verify_views(couch, db_names=('flowcells', 'x_flowcells')):
+    """Checks that the deployed design documents are the ones shipped with this script and that their views answer.
+
+    :returns: True if all the databases have working, up to date views
+    """
+    all_ok = True
+    for db_name in db_names:
+        flowcell_db = couch[db_name]
+        existing = flowcell_db.get(PRODUCTION_DESIGN_DOC_ID)
+        if existing is None:
+            print("{}: {} missing, run --mode deploy-views".format(db_name, PRODUCTION_DESIGN_DOC_ID))
+            all_ok = False
+            continue
+        if existing.get('views') != PRODUCTION_DESIGN_DOC['views']:
+            print("{}: {} differs from the one in this script, run --mode deploy-views".format(db_name, PRODUCTION_DESIGN_DOC_ID))
+            all_ok = False
+            continue
+        for view_name in sorted(PRODUCTION_DESIGN_DOC['views']):
+            rows = flowcell_db.view("production/{}".format(view_name), group_level=0).rows
+            print("{}: production/{} OK ({})".format(db_name, view_name, rows[0].value if rows else "empty"))
+    return all_ok
+
+
+def view_stats(couch, group_level, db_names=('flowcells', 'x_flowcells')):
+    """Prints yield, number of flowcells and number of lanes grouped by instrument (1), year (2) and month (3)
+    using the reduced views of PRODUCTION_DESIGN_DOC, only the aggregated rows are transferred.
+
+    Flowcells present in both databases are counted twice.
+    """
+    stats = {}
+    for db_name in db_names:
+        flowcell_db = couch[db_name]
+        for row in flowcell_db.view("production/yield_by_month", group_level=group_level):
+            key = tuple(row.key)
+            if key not in stats:
+                stats[key] = {'yield': 0, 'flowcells': 0, 'lanes': 0}
+            stats[key]['yield'] += row.value['sum']
+            stats[key]['flowcells'] += row.value['count']
+        for row in flowcell_db.view("production/lanes_by_month", group_level=group_level):
+            stats[tuple(row.key)]['lanes'] += row.value
+    columns = ['instrument', 'year', 'month'][0:group_level]
+    sys.stdout.write("{},yield_mbases,flowcells,lanes\n".format(",".join(columns)))
+    #views deployed before documents without instrument were skipped have null keys
+    for key in sorted(stats, key=lambda key: tuple('' if value is None else value for value in key)):
+        sys.stdout.write("{},{},{},{}\n".format(",".join(str(value) for value in key), int(stats[key]['yield']),
+                                               stats[key]['flowcells'], stats[key]['lanes']))
+
+
 def main(args):
     configuration_file = args.config
     load_yaml_config(configuration_file)
     configuration_file = args.config
     load_yaml_config(configuration_file)
+    couch = setupServer(CONFIG)
+
+    if args.mode == 'deploy-views':
+        deploy_views(couch)
+        return
+
+    if args.mode == 'verify-views':
+        if not verify_views(couch):
+            sys.exit(1)
+        return
+
+    if args.mode == 'view-stats':
+        view_stats(couch, args.group_level)
+        return
+
+    fc_reader = reader_from_args(couch, args)
+    lane_table = load_lane_table(fc_reader, args.lane_table, args.rebuild_lane_table)
 
     if args.mode == 'production-stats':
-        projects = parse_flowcell_db()
+        projects = parse_flowcell_db(lane_table)
 
     if args.mode == 'instrument-usage':
-        instrument_usage()
+        instrument_usage(lane_table)
 
     if args.mode == 'year-stats':
-        year_bp_production()
+        year_bp_production(lane_table)
 
 
 
@@ -515,9 +539,18 @@ if __name__ == '__main__':
          - production-stats: for each instrument type it prints number of FCs, number of lanes, etc. It then prints a summary of all stats
          - instrument-usage: for each instrument type and year it prints different run set-ups and samples run with that set-up
          - year-stats: cumulative data production by month
+         - deploy-views: saves the production design document (map/reduce views) in the flowcell databases
+         - verify-views: checks that the deployed views are up to date and working
+         - view-stats: yield, number of flowcells and lanes per instrument/year/month computed by the views (see --group-level)
         """)
     parser.add_argument('--config', help="configuration file", type=str,  required=True)
-    parser.add_argument('--mode', help="define what action needs to be executed", type=str, required=True, choices=('production-stats', 'instrument-usage', 'year-stats'))
+    parser.add_argument('--mode', help="define what action needs to be executed", type=str, required=True, choices=('production-stats', 'instrument-usage', 'year-stats', 'deploy-views', 'verify-views', 'view-stats'))
+    parser.add_argument('--group-level', help="in view-stats mode group by instrument (1), year (2) or month (3)", type=int, default=3, choices=(1, 2, 3))
+    parser.add_argument('--lane-table', help="Parquet file with the lane table extracted from the flowcell databases, built and saved if it does not exist or the databases changed since", type=str, default=None)
+    parser.add_argument('--rebuild-lane-table', help="build the lane table again even if it is up to date", action='store_true')
+    add_reader_arguments(parser)
 
     args = parser.parse_args()
+    if args.mode not in ('deploy-views', 'verify-views', 'view-stats'):
+        check_reader_arguments(parser, args)
     main(args)
@@ -8,8 +8,13 @@ import logging
 import argparse
 import yaml
 import json
-import distance
 import operator
+import sqlite3
+import copy
+import functools
+from collections import Counter, defaultdict
+from statusdb_flowcells import DEFAULT_BATCH_SIZE, add_reader_arguments, check_reader_arguments, reader_from_args, iter_change_batches
+from illumina_indexes import PackedIndexes, BarcodeMatcher, load_catalogue, catalogue_matcher, describe_index, reverse_complement
 try:
     import ConfigParser
 except ImportError:
@@ -66,52 +71,37 @@ class Indexes:
     #indexes looks like:
     #index_seq: ((index_name, index_type, kit_name), ....)
     indexes = {}
+    #reverse complement of each index_seq in indexes: index_seq
+    reverse_complements = {}
 
     def __init__(self, indexes_file):
+        #compiled catalogue, cached next to the yaml file and rebuilt only when the file changes
         try:
-            with open(indexes_file, 'r') as f:
-                self.indexes_by_kit = yaml.load(f)
+            catalogue = load_catalogue(indexes_file)
         except IOError as e:
                 e.message = "Could not open configuration file \"{}\".".format(indexes_file)
                 raise e
-        #now create a more index centric object
-        for kit_type in self.indexes_by_kit: #for each kit type
-            if kit_type not in self.indexes_by_kit:
-                print("file {} badly fomatted".format(indexes_file))
-                return
-            for index_type in self.indexes_by_kit[kit_type]: # for each type of indexes
-                for index_name, index_seq in self.indexes_by_kit[kit_type][index_type].items():
-                    index_obj = {'name': index_name, 'index_type': index_type, 'kit_type': kit_type}
-                    self._add_index(index_seq, index_obj)
+        self.indexes_by_kit = catalogue.indexes_by_kit
+        #now a more index centric object
+        self.indexes = catalogue.indexes
+        self.reverse_complements = catalogue.reverse_complements
 
     #computes reverse complement
-    def _reverse_complement(self, index):
-        for base in index:
-            if base not in 'ATCGNatcgn':
-                print("Error: NOT a DNA sequence")
-                return None
-        complement_dict = {"A":"T", "C":"G", "G":"C", "T":"A", "N":"N", "a":"t", "c":"g", "g":"c", "t":"a", "n":"n" }
-        return "".join([complement_dict[base] for base in reversed(index)])
+    @staticmethod
+    def _reverse_complement(index):
+        try:
+            return reverse_complement(index)
+        except ValueError:
+            print("Error: NOT a DNA sequence")
+            return None
 
     #check if index exists in the  indexes list
     def is_index(self, index):
-        if index in self.indexes or self._reverse_complement(index) in self.indexes:
+        if index in self.indexes or index in self.reverse_complements:
             return True
         else:
             return False
 
-    def _add_index(self, index_seq, index_obj):
-        index_to_modify = ""
-        if index_seq in self.indexes:
-            index_to_modify = index_seq
-        elif self._reverse_complement(index_seq) in self.indexes:
-            index_to_modify = self._reverse_complement(index_seq)
-        else:
-            index_to_modify = index_seq
-            self.indexes[index_to_modify] = []
-        #add the information
-        self.indexes[index_to_modify].append(index_obj)
-
 
 
 
@@ -122,17 +112,32 @@ class Indexes:
             kits.append(kit_type)
         return kits
 
-    #still to be defined
-    def check_left_shift_conflicts(self):
-        #checks if indexes from the same library after a left shift are conflicting
+    def check_left_shift_conflicts(self, max_distance=2, shifts=(1,), cross_kit=False):
+        """Prints the indexes that, read shifted (shift > 0 left, < 0 right, missing bases read as A), are
+        at most max_distance from an index of the same kit and type, or of any kit with cross_kit.
+        Distances for a whole kit are computed at once on indexes packed in integers (see PackedIndexes)"""
+        groups = []
         for kit_type in self.indexes_by_kit: #for each lib kit type
             for index_type in self.indexes_by_kit[kit_type]: # for each type of indexes
-                for index_name, index_seq in self.indexes_by_kit[kit_type][index_type].items():
-                    fake_index = index_seq[1:] + "A"
-                    for index_name_check, index_seq_check in self.indexes_by_kit[kit_type][index_type].items():
-                        hamming_dist = distance.hamming(index_seq_check, fake_index)
-                        if hamming_dist <= 2:
-                            print("{} {} {} {} {}".format(index_seq, index_seq_check, fake_index, hamming_dist, kit_type))
+                sequences = [str(index_seq) for index_seq in self.indexes_by_kit[kit_type][index_type].values()]
+                groups.append((kit_type, sequences))
+        if cross_kit:
+            all_kits = [kit_type for kit_type, sequences in groups for index_seq in sequences]
+            all_indexes = PackedIndexes([index_seq for kit_type, sequences in groups for index_seq in sequences])
+        conflicts = []
+        for kit_type, sequences in groups:
+            packed = PackedIndexes(sequences)
+            for shift in shifts:
+                fake_indexes = packed.shifted(shift)
+                checked = all_indexes if cross_kit else packed
+                for row, column, hamming_dist in fake_indexes.conflicts(checked, max_distance):
+                    index_seq, fake_index, index_seq_check = sequences[row], fake_indexes.sequences[row], checked.sequences[column]
+                    if cross_kit:
+                        conflicts.append((index_seq, index_seq_check, fake_index, hamming_dist, kit_type, all_kits[column]))
+                    else:
+                        conflicts.append((index_seq, index_seq_check, fake_index, hamming_dist, kit_type))
+                    print(" ".join(str(field) for field in conflicts[-1]))
+        return conflicts
 
 
 
@@ -149,48 +154,44 @@ def get_FC_type(FCid):
 import time
 from datetime import  date
 
-def check_single_sample_lanes(instrument_type):
-    couch=setupServer(CONFIG)
-    flowcell_db = couch["x_flowcells"]
-    flowcell_docs = {}
 
-    for fc_doc in flowcell_db:
-        try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
-            continue
-        flowcell_docs[flowcell_db[fc_doc]["RunInfo"]["Id"]] = fc_doc
+class SingleSampleLanes(object):
+    """single_sample_lanes: lanes with a single sample and more than 10% undetermined, per instrument and index"""
 
-    undet_stats = {}
-    indexes = {}
-    date_limit = date(16,3,1)
-    for FCid in sorted(flowcell_docs):
+    def __init__(self, instrument_type):
+        self.instrument_type = instrument_type
+        #FCid -> (instrument_name, indexes of single sample lanes with high undetermined)
+        self.flowcell_hits = {}
+        self.date_limit = date(16,3,1)
+
+    def add(self, fc_doc):
         # first check that I have all necessary info to extract information
-        fc_doc = flowcell_docs[FCid]
+        if "Undetermined" not in fc_doc:
+            return
+        FCid = fc_doc["RunInfo"]["Id"]
         FC_type = get_FC_type(FCid)
         #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        instrument_name = flowcell_db[fc_doc]['RunInfo']['Instrument']
-        if instrument_name not in undet_stats:
-            undet_stats[instrument_name] = {}
+        if self.instrument_type is not None:
+            if self.instrument_type != FC_type:
+                return
+        instrument_name = fc_doc['RunInfo']['Instrument']
+        self.flowcell_hits[FCid] = (instrument_name, [])
         #this is working only HiSeqX
         #only recent runs
 
-        start_date_string = flowcell_db[fc_doc]['RunInfo']['Date']
+        start_date_string = fc_doc['RunInfo']['Date']
         year = start_date_string[0:2]
         month = start_date_string[2:4]
         day = start_date_string[4:6]
         fc_date = date(int(year), int(month), int(day))
-        if fc_date < date_limit:
-            continue
+        if fc_date < self.date_limit:
+            return
         #understand which ones are the FCs with a single sample per lane
         single_sample_lanes = []
         lanes = {}
-        if 'samplesheet_csv' not in flowcell_db[fc_doc]:
-            continue
-        for sample in flowcell_db[fc_doc]['samplesheet_csv']:
+        if 'samplesheet_csv' not in fc_doc:
+            return
+        for sample in fc_doc['samplesheet_csv']:
             if sample['Lane'] not in lanes:
                 lanes[sample['Lane']] = []
             lanes[sample['Lane']].append(sample['index'])
@@ -204,128 +205,144 @@ def check_single_sample_lanes(instrument_type):
             lane = lane_index[0]
             index = lane_index[1]
             #get percentage of undetermined
-            if lane not in flowcell_db[fc_doc]["Undetermined"]:
+            if lane not in fc_doc["Undetermined"]:
                 continue #it means this lane has no undetermined
-            pc_undet = [sample['% of thelane'] for sample in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics'] if sample['Lane']==lane and sample['Barcode sequence']=='unknown'][0]
+            pc_undet = [sample['% of thelane'] for sample in fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics'] if sample['Lane']==lane and sample['Barcode sequence']=='unknown'][0]
             try:
                 pc_undet = float(pc_undet)
             except ValueError: #sometimes it is empty
                 continue
             if pc_undet > 10:
+                self.flowcell_hits[FCid][1].append(index)
+
+    def merge(self, other):
+        self.flowcell_hits.update(other.flowcell_hits)
+
+    def report(self):
+        #aggregate in FCid order so that the index columns are printed as before
+        undet_stats = {}
+        indexes = {}
+        for FCid in sorted(self.flowcell_hits):
+            instrument_name, high_undet_indexes = self.flowcell_hits[FCid]
+            if instrument_name not in undet_stats:
+                undet_stats[instrument_name] = {}
+            for index in high_undet_indexes:
                 if index not in undet_stats[instrument_name]:
                     undet_stats[instrument_name][index] = 0 #initialiaze this
                     indexes[index] = 0 #mark this as seen
                 undet_stats[instrument_name][index] += 1 # seen a lane with high amount of undetermined
 
-    print(",", end=' ')
-    for index in indexes:
-        print("{},".format(index), end=' ')
-    print("")
-    for instrument in undet_stats:
-        print("{},".format(instrument), end=' ')
+        print(",", end=' ')
         for index in indexes:
-            if index in undet_stats[instrument]:
-                print("{},".format(undet_stats[instrument][index]), end=' ')
-            else:
-                print("0,", end=' ')
+            print("{},".format(index), end=' ')
+        print("")
+        for instrument in undet_stats:
+            print("{},".format(instrument), end=' ')
+            for index in indexes:
+                if index in undet_stats[instrument]:
+                    print("{},".format(undet_stats[instrument][index]), end=' ')
+                else:
+                    print("0,", end=' ')
+            print("")
         print("")
-    print("")
-
-
-
-
 
-def find_undetermined_index_over_time(index_to_be_searched, instrument_type):
-    couch=setupServer(CONFIG)
-    flowcell_db = couch["x_flowcells"]
-    flowcell_docs = {}
-    for fc_doc in flowcell_db:
-        try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
-            continue
-        flowcell_docs[flowcell_db[fc_doc]["RunInfo"]["Id"]] = fc_doc
 
+class UndetIndexOverTime(object):
+    """check_undet_index: occurrences of an index in the undetermined of every FC and lane"""
 
-    time_line = []
+    def __init__(self, index_to_be_searched, instrument_type):
+        self.index_to_be_searched = index_to_be_searched
+        self.instrument_type = instrument_type
+        #FCid -> [[lane, count], ...]
+        self.time_line = {}
 
-    for FCid in sorted(flowcell_docs):
+    def add(self, fc_doc):
+        if "Undetermined" not in fc_doc:
+            return
+        FCid = fc_doc["RunInfo"]["Id"]
         # first check that I have all necessary info to extract information
-        fc_doc = flowcell_docs[FCid]
         FC_type = get_FC_type(FCid)
         #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        undetermined = flowcell_db[fc_doc]["Undetermined"]
-        lanes_undet = [FCid, []]
+        if self.instrument_type is not None:
+            if self.instrument_type != FC_type:
+                return
+        undetermined = fc_doc["Undetermined"]
+        lanes_undet = []
         for lane in ['1','2','3','4','5','6','7','8']:
             if lane not in undetermined:
                 continue
             index_to_be_searched_count = 0
             for undetermined_index in undetermined[lane]:
-                if index_to_be_searched in undetermined_index:
+                if self.index_to_be_searched in undetermined_index:
                     index_to_be_searched_count = undetermined[lane][undetermined_index]
-            lanes_undet[1].append([lane, index_to_be_searched_count])
-        if len(lanes_undet[1]) > 0:
-            time_line.append(lanes_undet)
-
-    for FC in time_line:
-        FCid = FC[0]
-        for lane in FC[1]:
-            print("{}_{} {}".format(FCid, lane[0], lane[1]))
-
-
-
-
-def undet_index_to_projects(index_to_be_searched, instrument_type, min_occurences=0):
-    status_db = setupServer(CONFIG)
-    workset_db = status_db['worksets']
-    workset_project_view = workset_db.view('project/ws_proj')
-
-
-    flowcell_db = status_db["x_flowcells"]
-    flowcell_docs = {}
-    counter = 0
-    projects_with_undet_in_fc_set = set()
-    worksets_with_undet_in_fc     = {}
-    for fc_doc in flowcell_db:
-        try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
-            continue
-        FCid = flowcell_db[fc_doc]["RunInfo"]["Id"]
+            lanes_undet.append([lane, index_to_be_searched_count])
+        self.time_line[FCid] = lanes_undet
+
+    def merge(self, other):
+        self.time_line.update(other.time_line)
+
+    def report(self):
+        for FCid in sorted(self.time_line):
+            for lane in self.time_line[FCid]:
+                print("{}_{} {}".format(FCid, lane[0], lane[1]))
+
+
+class WorksetUndet(object):
+    """workset_undet: worksets, FCs, lanes and samples where an index has been found in undetermined"""
+
+    def __init__(self, index_to_be_searched, instrument_type, min_occurences=0):
+        self.index_to_be_searched = index_to_be_searched
+        self.instrument_type = instrument_type
+        self.min_occurences = min_occurences
+        self.conf = CONFIG
+        self._workset_project_view = None
+        self.projects_with_undet_in_fc_set = set()
+        self.worksets_with_undet_in_fc     = {}
+
+    @property
+    def workset_project_view(self):
+        #opened when first needed, so that the aggregator can be sent to other processes
+        if self._workset_project_view is None:
+            status_db = setupServer(self.conf)
+            workset_db = status_db['worksets']
+            self._workset_project_view = workset_db.view('project/ws_proj')
+        return self._workset_project_view
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_workset_project_view'] = None
+        return state
+
+    def add(self, fc_doc):
+        if "Undetermined" not in fc_doc:
+            return
+        FCid = fc_doc["RunInfo"]["Id"]
         # first check that I have all necessary info to extract information
         FC_type = get_FC_type(FCid)
         #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        undetermined = flowcell_db[fc_doc]["Undetermined"]
+        if self.instrument_type is not None:
+            if self.instrument_type != FC_type:
+                return
+        undetermined = fc_doc["Undetermined"]
+        index_to_be_searched = self.index_to_be_searched
+        worksets_with_undet_in_fc = self.worksets_with_undet_in_fc
         for lane in ['1','2','3','4','5','6','7','8']:
             if lane not in undetermined:
                 continue
-            index_to_be_searched_count = 0
-            if  index_to_be_searched in undetermined[lane] and undetermined[lane][index_to_be_searched] > min_occurences:
+            if  index_to_be_searched in undetermined[lane] and undetermined[lane][index_to_be_searched] > self.min_occurences:
                 name = 'SampleName'
-                for samplesheet_entry in flowcell_db[fc_doc]["samplesheet_csv"]:
+                for samplesheet_entry in fc_doc["samplesheet_csv"]:
                     if 'SampleName' not in samplesheet_entry:
                          name = 'Sample_Name'
-                samples_with_undet_in_lane  = set([samplesheet_entry[name] for samplesheet_entry in  flowcell_db[fc_doc]["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
-                projects_with_undet_in_lane = set([samplesheet_entry[name].split("_")[0] for samplesheet_entry in  flowcell_db[fc_doc]["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
-                projects_with_undet_in_fc_set.update(projects_with_undet_in_lane)
+                samples_with_undet_in_lane  = set([samplesheet_entry[name] for samplesheet_entry in  fc_doc["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
+                projects_with_undet_in_lane = set([samplesheet_entry[name].split("_")[0] for samplesheet_entry in  fc_doc["samplesheet_csv"] if samplesheet_entry['Lane']==lane])
+                self.projects_with_undet_in_fc_set.update(projects_with_undet_in_lane)
                 #find out which workset contains these samples
                 for project in projects_with_undet_in_lane:
                     #for each proejct look which workset has been involved
-                    #if len(workset_project_view[project].rows) > 1:
-                    #    import pdb
-                    #    pdb.set_trace()
-
-                    samples_with_undet_ws  = {}
                     for sample in samples_with_undet_in_lane:
                         #now I need to figure out in which WS the samples were... might be more than one as samples might be pooled
-                        for row in workset_project_view[project].rows:
-                            ws_doc_id = row.id
+                        for row in self.workset_project_view[project].rows:
                             ws_id = list(row.value.keys())[0] #I am pretty sure that for each row I have a sinlge entry
                             if sample in list(row.value[ws_id]['samples'].keys()):
                                 location = row.value[ws_id]['samples'][sample]['location']
@@ -338,128 +355,122 @@ def undet_index_to_projects(index_to_be_searched, instrument_type, min_occurence
                                     worksets_with_undet_in_fc[ws_id][FCid][lane] = set()
                                 worksets_with_undet_in_fc[ws_id][FCid][lane].add((sample,location))
 
-    for ws_id in sorted(worksets_with_undet_in_fc):
-        print(ws_id)
-        for run_id in sorted(worksets_with_undet_in_fc[ws_id]):
-            print("\t{}".format(run_id))
-            for lane in sorted(worksets_with_undet_in_fc[ws_id][run_id]):
-                sys.stdout.write("\t\t{}: ".format(lane))
-                for sample_location in worksets_with_undet_in_fc[ws_id][run_id][lane]:
-                    sys.stdout.write("({},{}) ".format(sample_location[0], sample_location[1]))
-                sys.stdout.write('\n')
-
-
-
-
-
-
-def fetch_undermined_stats():
-    #initialise
-    couch=setupServer(CONFIG)
-    flowcell_db = couch["x_flowcells"]
-    #initialise counters for all FCs
-    MostOccurringUndetIndexes = {}
-    FC_num = 0
-    lanes_num = 0
-    MostOccurringUndetIndexes["Total"] = {}
-    #for HiSeqX FCs
-    FC_XTen_num = 0
-    lanes_Xten_num = 0
-    MostOccurringUndetIndexes["HiSeqX"] = {}
-    #for MiSeq FCs
-    FC_MiSeq_num = 0
-    lanes_MiSeq_num = 0
-    MostOccurringUndetIndexes["MiSeq"] = {}
-    #for HiSeq2500 FCs
-    FC_HiSeq_num = 0
-    lanes_HiSeq_num = 0
-    MostOccurringUndetIndexes["HiSeq2500"] = {}
-    for fc_doc in sorted(flowcell_db):
+    def merge(self, other):
+        self.projects_with_undet_in_fc_set.update(other.projects_with_undet_in_fc_set)
+        for ws_id, ws_runs in other.worksets_with_undet_in_fc.items():
+            for FCid, fc_lanes in ws_runs.items():
+                for lane, samples in fc_lanes.items():
+                    self.worksets_with_undet_in_fc.setdefault(ws_id, {}).setdefault(FCid, {}).setdefault(lane, set()).update(samples)
+
+    def report(self):
+        worksets_with_undet_in_fc = self.worksets_with_undet_in_fc
+        for ws_id in sorted(worksets_with_undet_in_fc):
+            print(ws_id)
+            for run_id in sorted(worksets_with_undet_in_fc[ws_id]):
+                print("\t{}".format(run_id))
+                for lane in sorted(worksets_with_undet_in_fc[ws_id][run_id]):
+                    sys.stdout.write("\t\t{}: ".format(lane))
+                    for sample_location in sorted(worksets_with_undet_in_fc[ws_id][run_id][lane]):
+                        sys.stdout.write("({},{}) ".format(sample_location[0], sample_location[1]))
+                    sys.stdout.write('\n')
+
+
+class MostUndetermined(object):
+    """most_undet: number of lanes where each index is the most occurring undetermined, per instrument type.
+
+    Only the most occurring index of each lane is counted, so the counters hold at most
+    one entry per lane and the top_k indexes are selected with a heap (Counter.most_common).
+    With per_year the same stats are also reported for each year.
+    """
+
+    FC_TYPES = (("Total", "All Flowcells:"), ("HiSeqX", "All HiSeqX:"), ("HiSeq2500", "All HiSeq2500:"), ("MiSeq", "All MiSeq:"))
+
+    def __init__(self, top_k=10, per_year=False):
+        self.top_k = top_k
+        self.per_year = per_year
+        #all counters are keyed by (year, FC_type), year is "All" for the whole history
+        self.MostOccurringUndetIndexes = defaultdict(Counter)
+        self.FC_num = Counter()
+        self.lanes_num = Counter()
+
+    def add(self, fc_doc):
         # first check that I have all necessary info to extract information
-        try:
-            undetermined = flowcell_db[fc_doc]["Undetermined"]
-        except KeyError:
-            continue
-        FCid = flowcell_db[fc_doc]["RunInfo"]["Id"]
+        if "Undetermined" not in fc_doc:
+            return
+        undetermined = fc_doc["Undetermined"]
+        FCid = fc_doc["RunInfo"]["Id"]
         FC_type = get_FC_type(FCid)
-        FC_num += 1
-        if FC_type == "HiSeqX":
-            FC_XTen_num += 1
-        elif FC_type == "HiSeq2500":
-            FC_HiSeq_num += 1
-        elif FC_type == "MiSeq":
-            FC_MiSeq_num += 1
+        counters = [("All", "Total"), ("All", FC_type)]
+        if self.per_year:
+            year = "20{}".format(FCid[0:2])
+            counters += [(year, "Total"), (year, FC_type)]
+        self.FC_num.update(counters)
         #we can use the illumina Demultiplex_Stats Barcode_lane_statistics to fetch info about indexes
         for lane in undetermined:
             #for each lane
             if len(undetermined[lane]) > 1: # if there are elements (there is the NoIndex case)
-                if 'TOTAL' in undetermined[lane]:
-                    del undetermined[lane]['TOTAL']
-                most_occuring_undet = sorted(list(undetermined[lane].items()), key=operator.itemgetter(1), reverse=True)[0]
-                lanes_num += 1
-                if FC_type == "HiSeqX":
-                    lanes_Xten_num += 1
-                elif FC_type == "HiSeq2500":
-                    lanes_HiSeq_num += 1
-                elif FC_type == "MiSeq":
-                    lanes_MiSeq_num += 1
-
-                if most_occuring_undet[0] not in MostOccurringUndetIndexes[FC_type]:
-                    MostOccurringUndetIndexes[FC_type][most_occuring_undet[0]] = 0
-                MostOccurringUndetIndexes[FC_type][most_occuring_undet[0]] += 1
-                if most_occuring_undet[0] not in MostOccurringUndetIndexes["Total"]:
-                    MostOccurringUndetIndexes["Total"][most_occuring_undet[0]] = 0
-                MostOccurringUndetIndexes["Total"][most_occuring_undet[0]] += 1
-
-
-
-    print("Flowcells (lanes): {} ({})".format(FC_num, lanes_num))
-    print("HiSeqX (lanes): {} ({})".format(FC_XTen_num, lanes_Xten_num))
-    print("HiSeq2500 (lanes): {} ({})".format(FC_HiSeq_num, lanes_HiSeq_num))
-    print("MiSeq (lanes): {} ({})".format(FC_MiSeq_num, lanes_MiSeq_num))
-
-    print("Most occuring undetermined (seen in #lanes)")
-    print("All Flowcells:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["Total"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_num)))
-    print("All HiSeqX:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["HiSeqX"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_Xten_num)))
-    print("All HiSeq2500:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["HiSeq2500"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_HiSeq_num)))
-    print("All MiSeq:")
-    for twenty_most_occuring_undet in sorted(list(MostOccurringUndetIndexes["MiSeq"].items()), key=operator.itemgetter(1), reverse=True)[0:10]:
-        print("{}\t{}\t{}".format(twenty_most_occuring_undet[0], twenty_most_occuring_undet[1], twenty_most_occuring_undet[1]/float(lanes_MiSeq_num)))
-
-
-
-
-def fetch_pooled_projects(instrument_type):
-    status_db = setupServer(CONFIG)
-    flowcell_db = status_db["x_flowcells"]
-    counter = 0
-    projects_pooled = {}
-    for fc_doc in flowcell_db:
-        if 'RunInfo' not in flowcell_db[fc_doc]:
-            continue
-        FCid = flowcell_db[fc_doc]["RunInfo"]["Id"]
+                #the document is shared with the other reports, TOTAL is skipped rather than deleted
+                lane_undet = ((index, count) for index, count in undetermined[lane].items() if index != 'TOTAL')
+                most_occuring_undet = max(lane_undet, key=operator.itemgetter(1))
+                self.lanes_num.update(counters)
+                for counter in counters:
+                    self.MostOccurringUndetIndexes[counter][most_occuring_undet[0]] += 1
+
+    def merge(self, other):
+        #Counter.update keeps the order in which the indexes were first seen, so ties are reported as in a serial scan
+        for counter, indexes in other.MostOccurringUndetIndexes.items():
+            self.MostOccurringUndetIndexes[counter].update(indexes)
+        self.FC_num.update(other.FC_num)
+        self.lanes_num.update(other.lanes_num)
+
+    def report(self):
+        self._report_period("All")
+        if self.per_year:
+            for year in sorted(set(year for year, FC_type in self.FC_num if year != "All")):
+                print("")
+                print("Year {}".format(year))
+                self._report_period(year)
+
+    def _report_period(self, year):
+        print("Flowcells (lanes): {} ({})".format(self.FC_num[(year, "Total")], self.lanes_num[(year, "Total")]))
+        print("HiSeqX (lanes): {} ({})".format(self.FC_num[(year, "HiSeqX")], self.lanes_num[(year, "HiSeqX")]))
+        print("HiSeq2500 (lanes): {} ({})".format(self.FC_num[(year, "HiSeq2500")], self.lanes_num[(year, "HiSeq2500")]))
+        print("MiSeq (lanes): {} ({})".format(self.FC_num[(year, "MiSeq")], self.lanes_num[(year, "MiSeq")]))
+
+        print("Most occuring undetermined (seen in #lanes)")
+        for FC_type, title in self.FC_TYPES:
+            print(title)
+            for most_occuring_undet in self.MostOccurringUndetIndexes[(year, FC_type)].most_common(self.top_k):
+                print("{}\t{}\t{}".format(most_occuring_undet[0], most_occuring_undet[1], most_occuring_undet[1]/float(self.lanes_num[(year, FC_type)])))
+
+
+class PooledProjects(object):
+    """fetch_pooled_projects: projects that have been run in a pool, with the samples of each pool"""
+
+    def __init__(self, instrument_type):
+        self.instrument_type = instrument_type
+        self.projects_pooled = {}
+
+    def add(self, fc_doc):
+        if 'RunInfo' not in fc_doc:
+            return
+        FCid = fc_doc["RunInfo"]["Id"]
         # first check that I have all necessary info to extract information
         FC_type = get_FC_type(FCid)
         #if a instrument type is specifed process only FCs run on that instrument
-        if instrument_type is not None:
-            if instrument_type != FC_type:
-                continue
-        if 'illumina' not in flowcell_db[fc_doc]:
+        if self.instrument_type is not None:
+            if self.instrument_type != FC_type:
+                return
+        if 'illumina' not in fc_doc:
             print("Not illumina field found in doc")
-            continue
-        if 'Demultiplex_Stats' not in  flowcell_db[fc_doc]['illumina']:
+            return
+        if 'Demultiplex_Stats' not in  fc_doc['illumina']:
             print("Not Demultiplex_Stats field found in doc")
-            continue
-        if 'Barcode_lane_statistics' not in flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']:
+            return
+        if 'Barcode_lane_statistics' not in fc_doc['illumina']['Demultiplex_Stats']:
             print("Not Barcode_lane_statistics field found in doc")
-            continue
-        demux_stats = flowcell_db[fc_doc]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
+            return
+        demux_stats = fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
         for lane in ['1','2','3','4','5','6','7','8']:
             samples_in_lane =  [entry['Sample'] for entry in demux_stats if entry['Lane'] == lane and not(entry['Sample'] == 'unknown' or entry['Sample'] == 'Undetermined') ]
             if len(samples_in_lane) > 1:
@@ -469,39 +480,338 @@ def fetch_pooled_projects(instrument_type):
                 for sample in sorted(samples_in_lane):
                     samples_concat += sample + " "
                 for project in projects:
-                    if project not in projects_pooled:
-                        projects_pooled[project] = set()
-                    projects_pooled[project].add(samples_concat)
+                    if project not in self.projects_pooled:
+                        self.projects_pooled[project] = set()
+                    self.projects_pooled[project].add(samples_concat)
+
+    def merge(self, other):
+        for project, pools in other.projects_pooled.items():
+            self.projects_pooled.setdefault(project, set()).update(pools)
+
+    def report(self):
+        for project in self.projects_pooled:
+            print(project)
+            for pool in sorted(self.projects_pooled[project]):
+                print("\t{}".format(pool))
+
+
+class UndetAttribution(object):
+    """attribute_undet: most occurring undetermined barcodes with the nearest known indexes.
+
+    Every undetermined barcode of every lane is matched against the indexes of the samples in
+    the same lane (mismatches, reverse complements, swapped i7/i5), the most occurring ones are
+    also matched against the kits of the indexes file when reported.
+    """
+
+    def __init__(self, indexes_file, instrument_type=None, top_k=10, min_occurences=0, max_mismatches=1):
+        self.indexes_file = indexes_file
+        self.instrument_type = instrument_type
+        self.top_k = top_k
+        self.min_occurences = min_occurences
+        self.max_mismatches = max_mismatches
+        self.reads = Counter()
+        self.lanes = Counter()
+        #barcode -> Counter of the edits from the indexes of the samples of the lane
+        self.sample_edits = defaultdict(Counter)
+
+    def add(self, fc_doc):
+        if "Undetermined" not in fc_doc or 'RunInfo' not in fc_doc:
+            return
+        if self.instrument_type is not None and self.instrument_type != get_FC_type(fc_doc["RunInfo"]["Id"]):
+            return
+        for lane, lane_undet in fc_doc["Undetermined"].items():
+            matcher = None
+            for barcode, count in lane_undet.items():
+                if barcode == 'TOTAL' or count <= self.min_occurences:
+                    continue
+                self.reads[barcode] += count
+                self.lanes[barcode] += 1
+                if matcher is None:
+                    matcher = BarcodeMatcher(self._samplesheet_indexes(fc_doc, lane), self.max_mismatches, expand_known=False)
+                attribution = matcher.attribute(barcode)
+                if attribution is not None:
+                    self.sample_edits[barcode][attribution.edit] += 1
+
+    @staticmethod
+    def _samplesheet_indexes(fc_doc, lane):
+        for samplesheet_entry in fc_doc.get("samplesheet_csv", []):
+            if samplesheet_entry.get('Lane') != lane:
+                continue
+            name = samplesheet_entry.get('SampleName', samplesheet_entry.get('Sample_Name', ''))
+            #dual indexes are either in index and index2 or in index as i7-i5
+            reads = re.split(r'[+-]', samplesheet_entry.get('index', ''))
+            if samplesheet_entry.get('index2'):
+                reads.append(samplesheet_entry['index2'])
+            for index_type, read in zip(('i7', 'i5'), reads):
+                if re.match(r'^[ACGTN]+$', read, re.IGNORECASE):
+                    yield read, {'name': name, 'index_type': index_type}
+
+    def merge(self, other):
+        self.reads.update(other.reads)
+        self.lanes.update(other.lanes)
+        for barcode, edits in other.sample_edits.items():
+            self.sample_edits[barcode].update(edits)
+
+    def report(self):
+        kit_matcher = catalogue_matcher(load_catalogue(self.indexes_file), self.max_mismatches)
+        print("barcode\treads\tlanes\tkit_indexes\tkit_edit\tdistance\tsamples_edit (lanes)")
+        for barcode, reads in self.reads.most_common(self.top_k):
+            attribution = kit_matcher.attribute(barcode)
+            if attribution is None:
+                kit_indexes, kit_edit, kit_distance = "", "unknown", ""
+            else:
+                kit_indexes = " + ".join("/".join(describe_index(match[3]) for match in read_matches) or "?" for read_matches in attribution.matches)
+                kit_edit, kit_distance = attribution.edit, attribution.distance
+            samples_edit = ", ".join("{} ({})".format(edit, lanes) for edit, lanes in self.sample_edits[barcode].most_common())
+            print("{}\t{}\t{}\t{}\t{}\t{}\t{}".format(barcode, reads, self.lanes[barcode], kit_indexes, kit_edit, kit_distance, samples_edit))
+
+
+def _aggregate_docs(aggregators, fc_docs):
+    """Feeds fc_docs to copies of the (empty) aggregators, returns the copies"""
+    aggregators = copy.deepcopy(aggregators)
+    for fc_doc in fc_docs:
+        for aggregator in aggregators:
+            aggregator.add(fc_doc)
+    return aggregators
+
+
+def scan_flowcells(fc_reader, aggregators):
+    """Feeds every x_flowcells document to all the aggregators in a single scan.
+
+    An aggregator receives the flowcell documents one at a time through add(fc_doc) and
+    prints its results with report(), so several reports can share a single scan of
+    the database. With more than one worker the scan is split in ranges of documents processed in parallel,
+    each by its own copy of the aggregators, and the copies are merged back in document
+    id order with merge(other).
+    """
+    partial_results = fc_reader.map_partitions("x_flowcells", functools.partial(_aggregate_docs, aggregators))
+    for partial_aggregators in partial_results:
+        for aggregator, partial_aggregator in zip(aggregators, partial_aggregators):
+            aggregator.merge(partial_aggregator)
+
+
+def run_aggregators(fc_reader, aggregators):
+    scan_flowcells(fc_reader, aggregators)
+    for aggregator in aggregators:
+        aggregator.report()
+
+
+def check_single_sample_lanes(fc_reader, instrument_type):
+    run_aggregators(fc_reader, [SingleSampleLanes(instrument_type)])
+
+
+def find_undetermined_index_over_time(fc_reader, index_to_be_searched, instrument_type):
+    run_aggregators(fc_reader, [UndetIndexOverTime(index_to_be_searched, instrument_type)])
 
-    for project in projects_pooled:
-        print(project)
-        for pool in projects_pooled[project]:
-            print("\t{}".format(pool))
+
+def undet_index_to_projects(fc_reader, index_to_be_searched, instrument_type, min_occurences=0):
+    run_aggregators(fc_reader, [WorksetUndet(index_to_be_searched, instrument_type, min_occurences)])
+
+
+def fetch_undermined_stats(fc_reader, top_k=10, per_year=False):
+    run_aggregators(fc_reader, [MostUndetermined(top_k, per_year)])
+
+
+def fetch_pooled_projects(fc_reader, instrument_type):
+    run_aggregators(fc_reader, [PooledProjects(instrument_type)])
+
+
+def attribute_undet(fc_reader, indexes_file, instrument_type, top_k=10, min_occurences=0, max_mismatches=1):
+    run_aggregators(fc_reader, [UndetAttribution(indexes_file, instrument_type, top_k, min_occurences, max_mismatches)])
+
+
+def canonical_barcode(barcode):
+    """Returns the representative of a barcode and of its reverse complement (the smallest of the two).
+
+    Dual indexes (e.g. AAAA+CCCC) are normalised index by index, sequences that are not DNA are returned as they are.
+    """
+    parts = re.split(r'([+-])', barcode)
+    for i in range(0, len(parts), 2):
+        if re.match(r'^[ACGTN]+$', parts[i], re.IGNORECASE):
+            index = parts[i].upper()
+            parts[i] = min(index, Indexes._reverse_complement(index))
+    return "".join(parts)
+
+
+class UndetBarcodeIndex(object):
+    """Inverted index from undetermined barcodes to the FCs and lanes where they appear.
+
+    Stored in a SQLite file and kept up to date from the _changes feed of x_flowcells,
+    each entry is (barcode, FCid, lane, count, date). Barcodes are stored in canonical
+    form (see canonical_barcode), so a lookup finds a barcode and its reverse complement.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS occurrences "
+                                "(doc_id TEXT, barcode TEXT, fcid TEXT, lane TEXT, count INTEGER, date TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS occurrences_barcode ON occurrences (barcode, count)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS occurrences_barcode_date ON occurrences (barcode, date)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS occurrences_doc ON occurrences (doc_id)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def last_seq(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'last_seq'").fetchone()
+        if row is None:
+            return 0
+        return json.loads(row[0])
+
+    def clear(self):
+        self.connection.execute("DELETE FROM occurrences")
+        self.connection.execute("DELETE FROM meta")
+        self.connection.commit()
+
+    def update(self, flowcell_db, batch_size=DEFAULT_BATCH_SIZE):
+        """Indexes the flowcells created or modified since the last update"""
+        for changes, last_seq in iter_change_batches(flowcell_db, self.last_seq(), batch_size):
+            for change in changes:
+                self.connection.execute("DELETE FROM occurrences WHERE doc_id = ?", (change['id'],))
+                if not change.get('deleted'):
+                    self.connection.executemany("INSERT INTO occurrences VALUES (?, ?, ?, ?, ?, ?)",
+                                                self._occurrences(change['doc']))
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_seq', ?)",
+                                    (json.dumps(last_seq),))
+            self.connection.commit()
+
+    @staticmethod
+    def _occurrences(fc_doc):
+        if "Undetermined" not in fc_doc or 'RunInfo' not in fc_doc:
+            return
+        FCid = fc_doc["RunInfo"]["Id"]
+        start_date_string = fc_doc["RunInfo"]["Date"]
+        fc_date = "20{}-{}-{}".format(start_date_string[0:2], start_date_string[2:4], start_date_string[4:6])
+        for lane, lane_undet in fc_doc["Undetermined"].items():
+            for barcode, count in lane_undet.items():
+                if barcode == 'TOTAL':
+                    continue
+                yield (fc_doc['_id'], canonical_barcode(barcode), FCid, lane, count, fc_date)
+
+    def lookup(self, barcode, min_occurences=0, from_date=None, to_date=None):
+        """Returns the (FCid, lane, count, date) where barcode (or its reverse complement) is undetermined
+        more than min_occurences times, optionally restricted to the runs between from_date and to_date (YYYY-MM-DD)
+        """
+        query = "SELECT fcid, lane, count, date FROM occurrences WHERE barcode = ? AND count > ?"
+        parameters = [canonical_barcode(barcode), min_occurences]
+        if from_date is not None:
+            query += " AND date >= ?"
+            parameters.append(from_date)
+        if to_date is not None:
+            query += " AND date <= ?"
+            parameters.append(to_date)
+        query += " ORDER BY fcid, lane"
+        return self.connection.execute(query, parameters).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def lookup_undet_index(couch, undet_index_file, index_to_be_searched, instrument_type, min_occurences=0, from_date=None, to_date=None,
+                       offline=False, refresh=False, batch_size=DEFAULT_BATCH_SIZE):
+    #only the undet index is read, it is brought up to date from x_flowcells unless offline
+    undet_index = UndetBarcodeIndex(undet_index_file)
+    if refresh:
+        undet_index.clear()
+    if not offline:
+        undet_index.update(couch["x_flowcells"], batch_size)
+    for FCid, lane, count, fc_date in undet_index.lookup(index_to_be_searched, min_occurences, from_date, to_date):
+        #if a instrument type is specifed process only FCs run on that instrument
+        if instrument_type is not None and instrument_type != get_FC_type(FCid):
+            continue
+        print("{}_{} {} {}".format(FCid, lane, count, fc_date))
+    undet_index.close()
+
+
+#reports that can be computed together in the combined mode
+REPORTS = ('most_undet', 'single_sample_lanes', 'check_undet_index', 'workset_undet', 'fetch_pooled_projects', 'attribute_undet')
+#reports that need --index
+INDEX_REPORTS = ('check_undet_index', 'workset_undet')
+#reports that need --indexes
+INDEXES_FILE_REPORTS = ('attribute_undet', )
+
+
+def build_aggregator(report, args):
+    if report == 'most_undet':
+        return MostUndetermined(args.top, args.per_year)
+    if report == 'single_sample_lanes':
+        return SingleSampleLanes("HiSeqX")
+    if report == 'check_undet_index':
+        return UndetIndexOverTime(args.index, args.instrument_type)
+    if report == 'workset_undet':
+        return WorksetUndet(args.index, args.instrument_type, args.min_occurences)
+    if report == 'fetch_pooled_projects':
+        return PooledProjects(args.instrument_type)
+    if report == 'attribute_undet':
+        return UndetAttribution(args.indexes, args.instrument_type, args.top, args.min_occurences, args.max_mismatches)
+
+
+def combined_reports(fc_reader, args):
+    reports = args.reports
+    if reports is None:
+        #all the reports that can be computed with the given arguments
+        reports = [report for report in REPORTS if (args.index is not None or report not in INDEX_REPORTS) and
+                   (args.indexes is not None or report not in INDEXES_FILE_REPORTS)]
+    for report in reports:
+        if report in INDEX_REPORTS and args.index is None:
+            sys.exit("report {} needs --index to be specified".format(report))
+        if report in INDEXES_FILE_REPORTS and args.indexes is None:
+            sys.exit("report {} needs --indexes to be specified".format(report))
+    aggregators = [build_aggregator(report, args) for report in reports]
+    scan_flowcells(fc_reader, aggregators)
+    for report, aggregator in zip(reports, aggregators):
+        print("### {}".format(report))
+        aggregator.report()
 
 
 def main(args):
+    if args.mode == 'index_conflicts':
+        if args.indexes is None:
+            sys.exit("in this mode --indexes must be specified")
+        Indexes(args.indexes).check_left_shift_conflicts(args.max_distance, args.shifts, args.cross_kit)
+        return
+
+    if args.config is None:
+        sys.exit("in this mode --config must be specified")
     configuration_file = args.config
     load_yaml_config(configuration_file)
+    couch = setupServer(CONFIG)
+
+    if args.mode == 'lookup_undet_index':
+        if args.index is None or args.undet_index is None:
+            sys.exit("in this mode --index and --undet-index must be specified")
+        lookup_undet_index(couch, args.undet_index, args.index, args.instrument_type, args.min_occurences, args.from_date, args.to_date,
+                           args.offline, args.refresh, args.batch_size)
+        return
+
+    fc_reader = reader_from_args(couch, args)
 
     if args.mode == 'most_undet':
-        fetch_undermined_stats()
+        fetch_undermined_stats(fc_reader, args.top, args.per_year)
 
     if args.mode == 'check_undet_index':
         if args.index is None:
             sys.exit("in this mode --index must be specified")
-        find_undetermined_index_over_time(args.index, args.instrument_type)
+        find_undetermined_index_over_time(fc_reader, args.index, args.instrument_type)
 
     if args.mode == 'workset_undet':
         if args.index is None:
             sys.exit("in this mode --index must be specified")
-        undet_index_to_projects(args.index, args.instrument_type, args.min_occurences)
+        undet_index_to_projects(fc_reader, args.index, args.instrument_type, args.min_occurences)
 
 
     if args.mode == 'single_sample_lanes':
-        check_single_sample_lanes("HiSeqX")
+        check_single_sample_lanes(fc_reader, "HiSeqX")
 
     if args.mode == 'fetch_pooled_projects':
-        fetch_pooled_projects(args.instrument_type)
+        fetch_pooled_projects(fc_reader, args.instrument_type)
+
+    if args.mode == 'combined':
+        combined_reports(fc_reader, args)
+
+    if args.mode == 'attribute_undet':
+        if args.indexes is None:
+            sys.exit("in this mode --indexes must be specified")
+        attribute_undet(fc_reader, args.indexes, args.instrument_type, args.top, args.min_occurences, args.max_mismatches)
 
 
 
@@ -517,16 +827,35 @@ if __name__ == '__main__':
         - most_undet: outputs a summary about undetermiend indexes, printing the most 20 most occurring indexes for each instrument type
         - single_sample_lanes: prints stats about HiSeqX lanes run with a single sample in it
         - workset_undet: prints for each workset the FC, lanes and samples where the specified index has been found in undet. For each sample the plate position is printed.
+        - fetch_pooled_projects: returns pooled projects, that is projects that have been run in a pool.
+        - combined: computes several of the above reports (see --reports) with a single scan of the flowcells
+        - lookup_undet_index: prints the FCs and lanes where the specified index (or its reverse complement) has been found in undet, using the inverted index stored in --undet-index
+        - attribute_undet: prints the most occurring undetermined barcodes with the nearest indexes of --indexes and of the samples in the same lane (mismatches, reverse complements, swapped i7/i5)
+        - index_conflicts: prints the indexes of --indexes that, read shifted (see --shifts), are too close to another index of the same kit (or any kit with --cross-kit)
         """)
-    parser.add_argument('--config', help="configuration file", type=str,  required=True)
+    parser.add_argument('--config', help="configuration file, needed in all modes but index_conflicts", type=str)
     parser.add_argument('--indexes', help="yamls file containing indexes we want to analyse", type=str)
-    parser.add_argument('--min_occurences', help="minimum number of occurences in undet in workset_undet mode", type=int, default=0)
+    parser.add_argument('--min_occurences', help="minimum number of occurences in undet in workset_undet, lookup_undet_index and attribute_undet modes", type=int, default=0)
+    parser.add_argument('--top', help="number of most occurring undetermined indexes printed in most_undet and attribute_undet modes", type=int, default=10)
+    parser.add_argument('--per-year', help="in most_undet mode print the stats also for each year", action='store_true')
+    parser.add_argument('--undet-index', help="SQLite file holding the inverted index of undetermined barcodes, created and updated in lookup_undet_index mode", type=str, default=None)
+    parser.add_argument('--from-date', help="in lookup_undet_index mode consider only runs from this date (YYYY-MM-DD)", type=str, default=None)
+    parser.add_argument('--to-date', help="in lookup_undet_index mode consider only runs up to this date (YYYY-MM-DD)", type=str, default=None)
+    parser.add_argument('--max-distance', help="in index_conflicts mode report the indexes at most this Hamming distance apart", type=int, default=2)
+    parser.add_argument('--shifts', help="in index_conflicts mode the shifts checked, positive to the left and negative to the right", type=int, nargs='+', default=[1])
+    parser.add_argument('--max-mismatches', help="in attribute_undet mode the largest number of mismatches from a known index", type=int, default=1)
+    parser.add_argument('--cross-kit', help="in index_conflicts mode compare the shifted indexes with the indexes of all kits", action='store_true')
 
 
-    parser.add_argument('--mode', help="define what action needs to be executed", type=str, required=True, choices=('check_undet_index', 'most_undet', 'single_sample_lanes', 'workset_undet', 'fetch_pooled_projects'))
+    parser.add_argument('--mode', help="define what action needs to be executed", type=str, required=True, choices=('check_undet_index', 'most_undet', 'single_sample_lanes', 'workset_undet', 'fetch_pooled_projects', 'combined', 'lookup_undet_index', 'index_conflicts', 'attribute_undet'))
+    parser.add_argument('--reports', help="reports computed with a single scan of the flowcells in combined mode (default: all the ones possible with the given arguments)", nargs='+', choices=REPORTS, default=None)
 
 
     parser.add_argument('--index', help="a specifc index (e.g., CTTGTAAT) to be searched across lanes and FCs", type=str)
     parser.add_argument('--instrument-type', help="type of instrument", type=str, default=None, choices=('HiSeqX', 'MiSeq', 'HiSeq2500'))
+    add_reader_arguments(parser)
     args = parser.parse_args()
+    #index_conflicts does not read flowcells, lookup_undet_index reads its own index
+    if args.mode not in ('index_conflicts', 'lookup_undet_index'):
+        check_reader_arguments(parser, args)
     main(args)
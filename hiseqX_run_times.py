@@ -6,6 +6,7 @@ from datetime import datetime
 from datetime import date
 import argparse
 import yaml
+from statusdb_flowcells import add_reader_arguments, check_reader_arguments, reader_from_args
 try:
     import ConfigParser
 except ImportError:
@@ -20,8 +21,7 @@ logger = logging.getLogger(__name__)
 def main(args):
     configuration_file = args.config
     load_yaml_config(configuration_file)
-    couch=setupServer(CONFIG)
-    flowcell_db = couch["x_flowcells"]
+    fc_reader = reader_from_args(setupServer(CONFIG), args)
     instruments = {}
     instruments["ST-E00198"] = []
     instruments["ST-E00201"] = []
@@ -29,20 +29,20 @@ def main(args):
     instruments["ST-E00266"] = []
     instruments["ST-E00269"] = []
 
-    for fc_doc in flowcell_db:
+    for fc_doc in fc_reader.iter_docs("x_flowcells"):
         try:
-            instrument = flowcell_db[fc_doc]["Runinfo"]["Instrument"]
-            fcid = flowcell_db[fc_doc]["Runinfo"]["Id"]
+            instrument = fc_doc["Runinfo"]["Instrument"]
+            fcid = fc_doc["Runinfo"]["Id"]
         except KeyError:
-            if "RunInfo" in flowcell_db[fc_doc]:
-                instrument = flowcell_db[fc_doc]["RunInfo"]["Instrument"]
-                fcid = flowcell_db[fc_doc]["RunInfo"]["Id"]
+            if "RunInfo" in fc_doc:
+                instrument = fc_doc["RunInfo"]["Instrument"]
+                fcid = fc_doc["RunInfo"]["Id"]
             else:
                 continue
         #check if the instrument is one of the ones I want to check
         if instrument in ["ST-E00198", "ST-E00201", "ST-E00214", "ST-E00266", "ST-E00269"]:
             try:
-                time_cycles = flowcell_db[fc_doc]["time cycles"]
+                time_cycles = fc_doc["time cycles"]
             except KeyError:
                 continue
             first_cycle_start = time_cycles[0]['start']
@@ -97,6 +97,8 @@ def load_yaml_config(config_file):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("""Check running times""")
     parser.add_argument('--config', help="configuration file", type=str,  required=True)
+    add_reader_arguments(parser)
     args = parser.parse_args()
+    check_reader_arguments(parser, args)
 
     main(args)
@@ -0,0 +1,382 @@
+"""Helpers shared by the scripts working with Illumina index sequences
+(compute_undet_index_stats.py, index_fixer.py).
+"""
+import os
+import re
+import pickle
+import itertools
+import hashlib
+import yaml
+import numpy
+from collections import namedtuple
+from pickle_cache import write_pickle
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+#IUPAC nucleotide codes and their complements
+IUPAC_BASES = 'ACGTRYSWKMBDHVN'
+IUPAC_COMPLEMENTS = 'TGCAYRSWMKVHDBN'
+try:
+    _COMPLEMENT = str.maketrans(IUPAC_BASES + IUPAC_BASES.lower(), IUPAC_COMPLEMENTS + IUPAC_COMPLEMENTS.lower())
+except AttributeError:
+    import string
+    _COMPLEMENT = string.maketrans(IUPAC_BASES + IUPAC_BASES.lower(), IUPAC_COMPLEMENTS + IUPAC_COMPLEMENTS.lower())
+_IUPAC_SEQUENCE = re.compile(r'[{}]*\Z'.format(IUPAC_BASES), re.IGNORECASE)
+#separator of the sequences of a column, see reverse_complement_column
+_COLUMN_SEPARATOR = ','
+_IUPAC_COLUMN = re.compile(r'[{}{}]*\Z'.format(IUPAC_BASES, _COLUMN_SEPARATOR), re.IGNORECASE)
+
+#2 bits per base; N is coded as A and flagged in a separate mask
+BASE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'N': 0}
+#bumped whenever IndexCatalogue changes, so that older cached catalogues are rebuilt
+CATALOGUE_VERSION = 1
+#longest index that fits in 64 bits
+MAX_PACKED_LENGTH = 32
+#bit 0 of every 2 bits group
+_LOW_BITS = 0x5555555555555555
+
+
+def _popcount(values):
+    """Number of bits set in each element of an uint64 array"""
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(values).astype(numpy.int64)
+    as_bytes = values.view(numpy.uint8).reshape(values.shape + (8,))
+    return numpy.unpackbits(as_bytes, axis=-1).sum(axis=-1).astype(numpy.int64)
+
+
+class PackedIndexes(object):
+    """Index sequences packed as integers with 2 bits per base, the first base in the lowest bits.
+
+    Hamming distances between two sets of indexes are computed for all pairs at
+    once with XOR and popcount through NumPy broadcasting. Indexes of different
+    lengths are compared on the length of the shorter one.
+    """
+
+    def __init__(self, sequences):
+        self.sequences = list(sequences)
+        codes = []
+        n_masks = []
+        for sequence in self.sequences:
+            sequence = sequence.upper()
+            if len(sequence) > MAX_PACKED_LENGTH:
+                raise ValueError("index {} is longer than {} bases".format(sequence, MAX_PACKED_LENGTH))
+            code = 0
+            n_mask = 0
+            for position, base in enumerate(sequence):
+                if base not in BASE_CODES:
+                    raise ValueError("index {} is not a DNA sequence".format(sequence))
+                code |= BASE_CODES[base] << (2 * position)
+                if base == 'N':
+                    n_mask |= 1 << (2 * position)
+            codes.append(code)
+            n_masks.append(n_mask)
+        self.codes = numpy.array(codes, dtype=numpy.uint64)
+        self.n_masks = numpy.array(n_masks, dtype=numpy.uint64)
+        self.lengths = numpy.array([len(sequence) for sequence in self.sequences], dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def shifted(self, shift, fill='A'):
+        """Returns the indexes as read after a shift: shift > 0 drops the first bases (left shift),
+        shift < 0 drops the last ones (right shift). The missing bases are read as fill"""
+        shifted = []
+        for sequence in self.sequences:
+            if shift >= 0:
+                shifted.append(sequence[shift:] + fill * min(shift, len(sequence)))
+            else:
+                shifted.append(fill * min(-shift, len(sequence)) + sequence[:shift])
+        return PackedIndexes(shifted)
+
+    def hamming(self, other):
+        """Matrix of the Hamming distances between every index of self (rows) and of other (columns)"""
+        different = self.codes[:, None] ^ other.codes[None, :]
+        #a base differs if either bit of its group differs, or if only one of the two is an N
+        different = ((different | (different >> numpy.uint64(1))) & numpy.uint64(_LOW_BITS)) | (self.n_masks[:, None] ^ other.n_masks[None, :])
+        compared = numpy.minimum(self.lengths[:, None], other.lengths[None, :])
+        #low bit of the groups of the compared bases (a shift by 64 bits is undefined, empty indexes are handled apart)
+        shift = numpy.minimum(2 * (MAX_PACKED_LENGTH - compared), 62).astype(numpy.uint64)
+        length_mask = numpy.where(compared > 0, numpy.uint64(_LOW_BITS) >> shift, numpy.uint64(0))
+        return _popcount(different & length_mask)
+
+    def conflicts(self, other, max_distance):
+        """Yields (row, column, distance) for the pairs at most max_distance apart, in row order"""
+        distances = self.hamming(other)
+        for row, column in zip(*numpy.nonzero(distances <= max_distance)):
+            yield int(row), int(column), int(distances[row, column])
+
+
+def reverse_complement(sequence):
+    """Reverse complement of a sequence of IUPAC nucleotide codes, case preserved.
+
+    Raises ValueError if sequence contains anything else.
+    """
+    if not _IUPAC_SEQUENCE.match(sequence):
+        raise ValueError("{} is not a DNA sequence".format(sequence))
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def reverse_complement_column(sequences):
+    """Reverse complements of a list of sequences, e.g. the index column of a samplesheet.
+
+    The sequences are joined, validated, translated and reversed as a single string, which
+    reverses both their order and each of them, so the whole column costs a few passes in C
+    instead of a Python call per sequence. Raises ValueError naming the first invalid sequence.
+    """
+    sequences = list(sequences)
+    if not sequences:
+        return []
+    column = _COLUMN_SEPARATOR.join(sequences)
+    if not _IUPAC_COLUMN.match(column) or column.count(_COLUMN_SEPARATOR) != len(sequences) - 1:
+        for sequence in sequences:
+            reverse_complement(sequence)
+    return column.translate(_COMPLEMENT)[::-1].split(_COLUMN_SEPARATOR)[::-1]
+
+
+def transform_index_columns(indexes, indexes2, rc1=False, rc2=False, swap=False):
+    """Applies index_fixer's --rc1, --rc2 and --swap to whole index columns.
+
+    Reverse complements are applied before the swap. Returns the new (indexes, indexes2) lists.
+    """
+    indexes = reverse_complement_column(indexes) if rc1 else list(indexes)
+    indexes2 = reverse_complement_column(indexes2) if rc2 else list(indexes2)
+    if swap:
+        indexes, indexes2 = indexes2, indexes
+    return indexes, indexes2
+
+
+class IndexCatalogue(object):
+    """The indexes of illumina_indexes.yaml, ready for lookups.
+
+    indexes_by_kit is the content of the file (kit -> index type -> index name -> sequence),
+    indexes maps every sequence to the list of {'name', 'index_type', 'kit_type'} using it;
+    a sequence whose reverse complement is already there is stored under that one.
+    reverse_complements maps the reverse complement of every key of indexes to the key.
+    """
+
+    def __init__(self, indexes_by_kit):
+        self.indexes_by_kit = indexes_by_kit
+        self.indexes = {}
+        self.reverse_complements = {}
+        for kit_type in indexes_by_kit: #for each kit type
+            for index_type in indexes_by_kit[kit_type]: # for each type of indexes
+                for index_name, index_seq in indexes_by_kit[kit_type][index_type].items():
+                    index_obj = {'name': index_name, 'index_type': index_type, 'kit_type': kit_type}
+                    self._add_index(str(index_seq), index_obj)
+
+    def _add_index(self, index_seq, index_obj):
+        if index_seq in self.indexes:
+            index_to_modify = index_seq
+        elif index_seq in self.reverse_complements:
+            index_to_modify = self.reverse_complements[index_seq]
+        else:
+            index_to_modify = index_seq
+            self.indexes[index_to_modify] = []
+            self.reverse_complements[reverse_complement(index_seq)] = index_seq
+        self.indexes[index_to_modify].append(index_obj)
+
+    def is_index(self, sequence):
+        """True if sequence or its reverse complement is a known index"""
+        return sequence in self.indexes or sequence in self.reverse_complements
+
+    def lookup(self, sequence):
+        """Returns the indexes (dicts with name, index_type and kit_type) with this sequence or its reverse complement"""
+        if sequence in self.indexes:
+            return self.indexes[sequence]
+        return self.indexes.get(self.reverse_complements.get(sequence), [])
+
+
+def load_catalogue(indexes_file, cache_file=None):
+    """Returns the IndexCatalogue of indexes_file (e.g. illumina_indexes.yaml).
+
+    The catalogue is pickled to cache_file (by default indexes_file + '.pickle') and read from
+    there as long as indexes_file keeps the same modification time and size, or else the same
+    content hash. A cache that cannot be read or written is ignored.
+    """
+    if cache_file is None:
+        cache_file = indexes_file + '.pickle'
+    with open(indexes_file, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        cached = None
+        try:
+            with open(cache_file, 'rb') as cache:
+                cached = pickle.load(cache)
+            if cached['version'] == CATALOGUE_VERSION and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+                return cached['catalogue']
+        except Exception:
+            cached = None
+        content = f.read()
+    sha1 = hashlib.sha1(content).hexdigest()
+    if cached is not None and cached['version'] == CATALOGUE_VERSION and cached['sha1'] == sha1:
+        catalogue = cached['catalogue']
+    else:
+        catalogue = IndexCatalogue(yaml.load(content, Loader=YamlLoader))
+    try:
+        write_pickle(cache_file, {'version': CATALOGUE_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1,
+                                  'catalogue': catalogue})
+    except (IOError, OSError):
+        pass
+    return catalogue
+
+
+def mismatch_neighbourhood(sequence, max_mismatches):
+    """Yields (variant, distance) for every sequence within max_mismatches substitutions of sequence (N included)"""
+    yield sequence, 0
+    for distance in range(1, max_mismatches + 1):
+        for positions in itertools.combinations(range(len(sequence)), distance):
+            for bases in itertools.product(*[[base for base in 'ACGTN' if base != sequence[position]] for position in positions]):
+                variant = list(sequence)
+                for position, base in zip(positions, bases):
+                    variant[position] = base
+                yield ''.join(variant), distance
+
+
+def describe_index(info):
+    """kit:name (index type) of an index of the catalogue, or the name of a samplesheet index"""
+    if 'kit_type' in info:
+        return "{}:{} ({})".format(info['kit_type'], info['name'], info['index_type'])
+    return "{} ({})".format(info['name'], info['index_type'])
+
+
+#edit: e.g. "i7:1_mismatch i5:reverse_complement swapped", distance: total mismatches,
+#matches: for each index read the list of nearest (distance, orientation, sequence, info)
+BarcodeAttribution = namedtuple('BarcodeAttribution', ['edit', 'distance', 'matches'])
+
+
+class BarcodeMatcher(object):
+    """Attributes barcodes (ACGTACGT, or ACGTACGT+TTGGCCAA for dual indexes) to the nearest known indexes.
+
+    known is an iterable of (sequence, info), info describing the index with at least a name and
+    an index_type starting with i7 or i5 (e.g. the dicts of IndexCatalogue.indexes). Each index read
+    of a barcode is matched against the known indexes and their reverse complements up to
+    max_mismatches substitutions, through a hash of mismatch neighbourhoods: with expand_known the
+    neighbourhoods of the known indexes are stored once and a read costs one lookup (for large, reused
+    sets such as the kits), otherwise the neighbourhood of the read is looked up among the known
+    indexes (for small sets used a few times, such as the samples of a lane).
+    """
+
+    def __init__(self, known, max_mismatches=1, expand_known=True):
+        self.max_mismatches = max_mismatches
+        self.expand_known = expand_known
+        self.neighbours = {}
+        for sequence, info in known:
+            sequence = sequence.upper()
+            oriented = [('forward', sequence)]
+            if reverse_complement(sequence) != sequence:
+                oriented.append(('reverse_complement', reverse_complement(sequence)))
+            for orientation, oriented_sequence in oriented:
+                for variant, distance in mismatch_neighbourhood(oriented_sequence, max_mismatches if expand_known else 0):
+                    self._add(variant, (distance, orientation, sequence, info))
+
+    def _add(self, variant, match):
+        matches = self.neighbours.get(variant)
+        if matches is None or match[0] < matches[0][0]:
+            self.neighbours[variant] = [match]
+        elif match[0] == matches[0][0]:
+            matches.append(match)
+
+    def match_read(self, read):
+        """Returns the nearest known indexes of a single index read as a list of (distance, orientation, sequence, info)"""
+        read = read.upper()
+        if self.expand_known:
+            return self.neighbours.get(read, [])
+        best = []
+        for variant, distance in mismatch_neighbourhood(read, self.max_mismatches):
+            if best and distance > best[0][0]:
+                break
+            for known_distance, orientation, sequence, info in self.neighbours.get(variant, []):
+                best.append((distance, orientation, sequence, info))
+        return best
+
+    def attribute(self, barcode):
+        """Returns the BarcodeAttribution of barcode, None if none of its index reads is near a known index"""
+        reads = re.split(r'[+-]', barcode)
+        matches = [self.match_read(read) for read in reads]
+        if not any(matches):
+            return None
+        names = ['i7', 'i5'] if len(reads) == 2 else ['read{}'.format(number + 1) for number in range(len(reads))]
+        edits = []
+        for name, read_matches in zip(names, matches):
+            if not read_matches:
+                edits.append("{}:unknown".format(name))
+                continue
+            distance, orientation = read_matches[0][0], read_matches[0][1]
+            edit = []
+            if orientation == 'reverse_complement':
+                edit.append('reverse_complement')
+            if distance:
+                edit.append('{}_mismatch'.format(distance))
+            edits.append("{}:{}".format(name, '+'.join(edit) or 'exact'))
+        #i7 read matching only i5 indexes and the other way around
+        if len(reads) == 2 and all(matches) and \
+                all(str(match[3]['index_type']).startswith('i5') for match in matches[0]) and \
+                all(str(match[3]['index_type']).startswith('i7') for match in matches[1]):
+            edits.append('swapped')
+        return BarcodeAttribution(" ".join(edits), sum(read_matches[0][0] for read_matches in matches if read_matches), matches)
+
+
+def catalogue_matcher(catalogue, max_mismatches=1):
+    """BarcodeMatcher of all the indexes of an IndexCatalogue"""
+    known = []
+    for kit_type in catalogue.indexes_by_kit:
+        for index_type in catalogue.indexes_by_kit[kit_type]:
+            for index_name, index_seq in catalogue.indexes_by_kit[kit_type][index_type].items():
+                known.append((str(index_seq), {'name': index_name, 'index_type': index_type, 'kit_type': kit_type}))
+    return BarcodeMatcher(known, max_mismatches)
+
+
+def _concatenated_reverse_complement(sequence):
+    #one call and one string concatenation per base, as index_fixer.py used to do
+    complements = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C', 'N': 'N'}
+    rc = ""
+    for base in sequence[::-1]:
+        rc = rc + complements[base]
+    return rc
+
+
+def _dict_reverse_complement(sequence):
+    #validation and dict built at every call, as Indexes._reverse_complement used to do
+    for base in sequence:
+        if base not in 'ATCGNatcgn':
+            return None
+    complement_dict = {"A": "T", "C": "G", "G": "C", "T": "A", "N": "N", "a": "t", "c": "g", "g": "c", "t": "a", "n": "n"}
+    return "".join([complement_dict[base] for base in reversed(sequence)])
+
+
+def benchmark_reverse_complement(rows=10000, length=10, repeats=5, seed=1):
+    """Times the reverse complement of the index column of a samplesheet with rows random indexes.
+
+    Returns a list of (method, best time in seconds) over repeats runs, after checking that
+    all methods agree.
+    """
+    import random
+    import timeit
+    generator = random.Random(seed)
+    column = [''.join(generator.choice('ACGT') for position in range(length)) for row in range(rows)]
+    methods = [
+        ('per base concatenation', lambda: [_concatenated_reverse_complement(sequence) for sequence in column]),
+        ('dict per sequence', lambda: [_dict_reverse_complement(sequence) for sequence in column]),
+        ('translate per sequence', lambda: [reverse_complement(sequence) for sequence in column]),
+        ('translate column', lambda: reverse_complement_column(column)),
+    ]
+    expected = reverse_complement_column(column)
+    timings = []
+    for name, method in methods:
+        if method() != expected:
+            raise AssertionError("{} gives a different reverse complement".format(name))
+        timings.append((name, min(timeit.repeat(method, number=1, repeat=repeats))))
+    return timings
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the reverse complement of a samplesheet index column")
+    parser.add_argument('--rows', help="number of samplesheet rows", type=int, default=10000)
+    parser.add_argument('--length', help="length of the indexes", type=int, default=10)
+    parser.add_argument('--repeats', help="number of timed runs, the best one is reported", type=int, default=5)
+    args = parser.parse_args()
+    timings = benchmark_reverse_complement(args.rows, args.length, args.repeats)
+    baseline = timings[0][1]
+    for name, seconds in timings:
+        print("{}\t{:.2f} ms\t{:.1f}x".format(name, seconds * 1000, baseline / seconds))
@@ -1,56 +1,232 @@
 import sys
 import re
 import os
+import csv
+import json
+import itertools
+from collections import Counter, OrderedDict, defaultdict
 
 import click
-from flowcell_parser.classes import SampleSheetParser
-
-def generate_samplesheet(ss_reader):
-    """Will generate a 'clean' samplesheet"""
-    output = ""
-    # Header
-    if ss_reader.header:
-        output += "[Header]{}".format(os.linesep)
-        for field in ss_reader.header:
-            output += "{},{}{}".format(field.rstrip(), ss_reader.header[field].rstrip(), os.linesep)
-    # Reads
-    if ss_reader.reads:
-        output += "[Reads]{}".format(os.linesep)
-        for read in ss_reader.reads:
-            output += "{}{}".format(read.rstrip(), os.linesep)
-    # Settings
-    if ss_reader.settings:
-        output += "[Settings]{}".format(os.linesep)
-        for field in ss_reader.settings:
-            output += "{},{}{}".format(field.rstrip(), ss_reader.settings[field].rstrip(), os.linesep)
-    #Data
-    output += "[Data]{}".format(os.linesep)
-    datafields = []
-    for field in ss_reader.datafields:
-        datafields.append(field)
-    output += ",".join(datafields)
-    output += os.linesep
-    for line in ss_reader.data:
-        line_ar = []
-        for field in datafields:
-            value = line[field]
-            line_ar.append(value)
-        output += ",".join(line_ar)
-        output += os.linesep
-    return output
-
-
-def nuc_compliment(nuc):
-    if nuc == 'A':
-        return 'T'
-    elif nuc == 'T':
-        return 'A'
-    elif nuc == 'C':
-        return'G'
-    elif nuc == 'G':
-        return 'C'
-    else:
-        sys.exit("Critical error. Unknown nucleotide found: {}.".format(nuc))
+from illumina_indexes import load_catalogue, reverse_complement_column, transform_index_columns
+
+#Transforms scored by --detect, as (rc1, rc2, swap). Reverse complements are applied before the swap, as in main
+TRANSFORMS = list(itertools.product((False, True), repeat=3))
+#samplesheet sections, in the order they are written
+SECTIONS = ('[Header]', '[Reads]', '[Settings]', '[Data]')
+#number of [Data] rows read, transformed and written at once
+DATA_CHUNK_SIZE = 1000
+
+def _section(line):
+    """Returns the samplesheet section started by line ('[Header]', '[Reads]', '[Settings]', '[Data]'), None for other lines"""
+    for section in SECTIONS:
+        if section in line:
+            return section
+    return None
+
+
+def _data_lines(lines):
+    """Yields the lines of lines up to the end of the [Data] section"""
+    for line in lines:
+        if _section(line) is not None:
+            sys.exit("Critical error. Sections after [Data] are not supported: {}".format(line.strip()))
+        yield line
+
+
+def read_samplesheet(fh):
+    """Reads the sections of a samplesheet before [Data], leaving fh at the first [Data] line.
+
+    Returns (header, reads, settings, data_lines): header and settings are OrderedDicts, reads
+    a list and data_lines an iterator over the lines of the [Data] section, meant to be read
+    once, as it keeps reading fh. As in flowcell_parser's SampleSheetParser, lines before the
+    first section belong to [Data] (samplesheets without sections).
+    """
+    header = OrderedDict()
+    reads = []
+    settings = OrderedDict()
+    leading_lines = []
+    section = None
+    for line in fh:
+        line_section = _section(line)
+        if line_section == '[Data]':
+            break
+        if line_section is not None:
+            section = line_section
+        elif section is None:
+            leading_lines.append(line)
+        elif section == '[Reads]':
+            reads.append(line.split(',')[0])
+        else:
+            fields = line.split(',')
+            if len(fields) < 2:
+                sys.exit("Critical error. The samplesheet does not seem to comply with the format: {}".format(line.strip()))
+            (header if section == '[Header]' else settings)[fields[0]] = fields[1]
+    if leading_lines and section is not None:
+        sys.exit("Critical error. Unexpected lines before the first section of the samplesheet")
+    return header, reads, settings, _data_lines(itertools.chain(leading_lines, fh))
+
+
+def read_data_fields(path):
+    """Returns the column names of the [Data] section, reading the samplesheet only up to them"""
+    with open(path) as fh:
+        header, reads, settings, data_lines = read_samplesheet(fh)
+        return csv.DictReader(data_lines).fieldnames or []
+
+
+def iter_data_rows(path):
+    """Yields the [Data] rows of a samplesheet as dicts, one at a time"""
+    with open(path) as fh:
+        header, reads, settings, data_lines = read_samplesheet(fh)
+        for row in csv.DictReader(data_lines):
+            yield row
+
+
+def generate_samplesheet(path, fh_out, transform_rows=None, chunk_size=DATA_CHUNK_SIZE):
+    """Writes a 'clean' copy of the samplesheet at path to fh_out.
+
+    The [Data] rows are read, passed to transform_rows and written chunk_size at a time,
+    so memory does not grow with the number of rows. transform_rows(rows) modifies a list
+    of rows (dicts) in place.
+    """
+    with open(path) as fh:
+        header, reads, settings, data_lines = read_samplesheet(fh)
+        # Header
+        if header:
+            fh_out.write("[Header]{}".format(os.linesep))
+            fh_out.writelines("{},{}{}".format(field.rstrip(), header[field].rstrip(), os.linesep) for field in header)
+        # Reads
+        if reads:
+            fh_out.write("[Reads]{}".format(os.linesep))
+            fh_out.writelines("{}{}".format(read.rstrip(), os.linesep) for read in reads)
+        # Settings
+        if settings:
+            fh_out.write("[Settings]{}".format(os.linesep))
+            fh_out.writelines("{},{}{}".format(field.rstrip(), settings[field].rstrip(), os.linesep) for field in settings)
+        #Data
+        fh_out.write("[Data]{}".format(os.linesep))
+        data_reader = csv.DictReader(data_lines)
+        datafields = data_reader.fieldnames or []
+        fh_out.write("{}{}".format(",".join(datafields), os.linesep))
+        while True:
+            rows = list(itertools.islice(data_reader, chunk_size))
+            if not rows:
+                break
+            if transform_rows is not None:
+                transform_rows(rows)
+            fh_out.writelines("{}{}".format(",".join(row[field] for field in datafields), os.linesep) for row in rows)
+
+
+def check_known_indexes(ss_data, catalogue, project):
+    """Warns about the indexes of the selected samples that are not in the index catalogue"""
+    for row in ss_data:
+        if (not project) or (project in row['Sample_ID']):
+            for field in ('index', 'index2'):
+                if row.get(field) and not catalogue.is_index(row[field]):
+                    print("Warning: {} {} of sample {} is not a known index".format(field, row[field], row['Sample_ID']))
+
+
+def load_undetermined(path):
+    """Reads the undetermined barcode counts of a flowcell as {lane: {barcode: reads}}.
+
+    Accepts the Stats.json of bcl2fastq (UnknownBarcodes), a flowcell document exported
+    from statusdb (Undetermined) or directly a {lane: {barcode: reads}} dictionary.
+    """
+    with open(path) as fh:
+        content = json.load(fh)
+    if 'UnknownBarcodes' in content:
+        return dict((str(lane_stats['Lane']), lane_stats['Barcodes']) for lane_stats in content['UnknownBarcodes'])
+    if 'Undetermined' in content:
+        content = content['Undetermined']
+    return dict((str(lane), barcodes) for lane, barcodes in content.items())
+
+
+def transform_name(rc1, rc2, swap):
+    return "+".join(name for name, applied in (('rc1', rc1), ('rc2', rc2), ('swap', swap)) if applied) or 'identity'
+
+
+def score_transforms(ss_data, undetermined, project, single):
+    """Scores every transform by the undetermined reads it would assign to the selected samples.
+
+    For each transform the transformed (lane, index, index2) of the samples are put in a dict
+    and every undetermined barcode, cut to the length of the indexes, is looked up in it, so
+    the cost is linear in the number of samples and barcodes.
+    single tells that the samplesheet has no index2 column.
+    Returns a list of (rc1, rc2, swap, reads, barcodes, samples), best transform first.
+    """
+    rows = [row for row in ss_data if (not project) or (project in row['Sample_ID'])]
+    lanes = sorted(undetermined)
+    #undetermined barcodes split in their index reads, once
+    undet_reads = dict((lane, [(re.split(r'[+-]', barcode), count) for barcode, count in undetermined[lane].items()
+                               if barcode != 'TOTAL']) for lane in lanes)
+    scores = []
+    for rc1, rc2, swap in TRANSFORMS:
+        if single and (rc2 or swap):
+            continue
+        #lane -> (length of index, length of index2) -> {(index, index2): sample}
+        samples_by_key = defaultdict(lambda: defaultdict(dict))
+        new_indexes, new_indexes2 = transform_index_columns([row['index'].upper() for row in rows],
+                                                            ['' if single else row['index2'].upper() for row in rows], rc1, rc2, swap)
+        for row, index1, index2 in zip(rows, new_indexes, new_indexes2):
+            for lane in ([row['Lane']] if row.get('Lane') else lanes):
+                samples_by_key[lane][(len(index1), len(index2))][(index1, index2)] = row['Sample_ID']
+        reads = 0
+        barcodes = 0
+        samples = Counter()
+        for lane in samples_by_key:
+            for (length1, length2), samples_by_index in samples_by_key[lane].items():
+                for barcode_reads, count in undet_reads.get(lane, []):
+                    key = (barcode_reads[0][:length1], barcode_reads[1][:length2] if len(barcode_reads) > 1 else '')
+                    sample = samples_by_index.get(key)
+                    if sample is not None:
+                        reads += count
+                        barcodes += 1
+                        samples[sample] += count
+        scores.append((rc1, rc2, swap, reads, barcodes, samples))
+    #ties go to the transform with fewer changes
+    scores.sort(key=lambda score: (-score[3], sum(score[:3])))
+    return scores
+
+
+def detect_transform(ss_data, undetermined, project, single):
+    """Prints how many undetermined reads each transform recovers and recommends the best one"""
+    scores = score_transforms(ss_data, undetermined, project, single)
+    total = sum(count for lane in undetermined.values() for barcode, count in lane.items() if barcode != 'TOTAL')
+    print("transform\trecovered_reads\trecovered_barcodes\tsamples")
+    for rc1, rc2, swap, reads, barcodes, samples in scores:
+        print("{}\t{}\t{}\t{}".format(transform_name(rc1, rc2, swap), reads, barcodes, len(samples)))
+    rc1, rc2, swap, reads, barcodes, samples = scores[0]
+    if not reads or (not rc1 and not rc2 and not swap):
+        print("No transform recovers more undetermined reads than the samplesheet as it is")
+        return
+    options = " ".join("--{}".format(name) for name, applied in (('rc1', rc1), ('rc2', rc2), ('swap', swap)) if applied)
+    print("Recommended: {} recovers {} of {} undetermined reads ({:.1f}%) for {} samples".format(
+        options, reads, total, 100.0 * reads / max(total, 1), len(samples)))
+
+
+def fix_indexes(rows, single, project, swap, rc1, rc2, platform):
+    """Applies --rc1, --rc2 and --swap to the indexes of the rows of the selected project, in place"""
+    selected = [row for row in rows if (not project) or (project in row['Sample_ID'])]
+
+    if single:
+        #Reverse compliment
+        if rc1:
+            matches = [(row, re.match('([ATCG]{4,12})', row['index'])) for row in selected]
+            matches = [(row, index_in) for row, index_in in matches if index_in]
+            for (row, index_in), rc in zip(matches, reverse_complement_column(index_in.group(1) for row, index_in in matches)):
+                row['index'] = rc
+
+    if not single and (rc1 or rc2 or swap):
+        try:
+            new_indexes, new_indexes2 = transform_index_columns([row['index'] for row in selected], [row['index2'] for row in selected], rc1, rc2, swap)
+        except ValueError as e:
+            sys.exit("Critical error. {}".format(e))
+        for row, new_index, new_index2 in zip(selected, new_indexes, new_indexes2):
+            row['index'] = new_index
+            row['index2'] = new_index2
+            if platform == "miseq_old":
+                if rc1 or swap:
+                    row['I7_Index_ID'] = new_index
+                if rc2 or swap:
+                    row['I5_Index_ID'] = new_index2
 
 
 if sys.version_info[0] == 3:
@@ -64,90 +240,46 @@ elif sys.version_info[0] == 2:
 @click.option('--rc1', is_flag=True,help='Exchanges index 1 for its reverse compliment.')
 @click.option('--rc2', is_flag=True,help='Exchanges index 2 for its reverse compliment.')
 @click.option('--platform', required=True, type=click.Choice(['miseq', 'miseq_old', 'novaseq', 'nextseq']), help="Run platform (Options: 'miseq', 'miseq_old' (V2 samplesheet for MiSeq), 'nextseq', 'novaseq' (No need to specify 6000 or X Plus))")
+@click.option('--indexes', required=False, type=click.Path(exists=True), help='Index file, e.g. illumina_indexes.yaml. Warns about indexes of the new samplesheet that are not in it.')
+@click.option('--detect', is_flag=True, help='Instead of writing a new samplesheet, scores every combination of --rc1, --rc2 and --swap by the undetermined reads it recovers and recommends the best one.')
+@click.option('--undetermined', required=False, type=click.Path(exists=True), help='Undetermined barcode counts used by --detect: Stats.json of bcl2fastq or flowcell document exported from statusdb.')
 
-def main(path, project, swap, rc1, rc2, platform):
-    ss_reader = SampleSheetParser(path)
-    ss_data = ss_reader.data
-    single = True
-
+def main(path, project, swap, rc1, rc2, platform, indexes, detect, undetermined):
     # Check whether both indexes are available
-    index1 = 'index'
-    index2 = 'index2'
-    if index2 in ss_data[0]:
-        single = False
+    single = 'index2' not in read_data_fields(path)
 
-    if single:
-        #Sanity check
-        if rc2 or swap:
-            sys.exit("Single index. Cannot change index 2, nor swap indexes")
+    if detect:
+        if not undetermined:
+            sys.exit("--detect needs the undetermined barcode counts given with --undetermined")
+        detect_transform(list(iter_data_rows(path)), load_undetermined(undetermined), project, single)
+        return
+
+    #Sanity check
+    if single and (rc2 or swap):
+        sys.exit("Single index. Cannot change index 2, nor swap indexes")
+
+    catalogue = load_catalogue(indexes) if indexes else None
+
+    def transform_rows(rows):
+        fix_indexes(rows, single, project, swap, rc1, rc2, platform)
+        if catalogue is not None:
+            check_known_indexes(rows, catalogue, project)
 
-        #Reverse compliment
-        if rc1:
-            for row in ss_data:
-                sample_id = row['Sample_ID']
-                if (not project) or (project in sample_id):
-                    index_in = re.match('([ATCG]{4,12})', row[index1])
-                    if index_in:
-                        if rc1:
-                            rc = ""
-                            for nuc in index_in.group(1)[::-1]:
-                                rc = rc + nuc_compliment(nuc)
-                            row[index1] = '{}'.format(rc)
-
-    if not single:
-        #Reverse Compliment
-        if rc1 or rc2:
-            for row in ss_data:
-                sample_id = row['Sample_ID']
-                if (not project) or (project in sample_id):
-                    if platform == "miseq_old":
-                        if rc1:
-                            rc = ""
-                            for nuc in row['index'][::-1]:
-                                rc = rc + nuc_compliment(nuc)
-                            row['index'] = rc
-                            row['I7_Index_ID'] = rc
-                        if rc2:
-                            rc = ""
-                            for nuc in row['index2'][::-1]:
-                                rc = rc + nuc_compliment(nuc)
-                            row['index2'] = rc
-                            row['I5_Index_ID'] = rc
-                    elif platform == "miseq" or platform == "nextseq" or platform == "novaseq":
-                        if rc1:
-                            rc = ""
-                            for nuc in row['index'][::-1]:
-                                rc = rc + nuc_compliment(nuc)
-                            row['index'] = rc
-                        if rc2:
-                            rc = ""
-                            for nuc in row['index2'][::-1]:
-                                rc = rc + nuc_compliment(nuc)
-                            row['index2'] = rc
-        #Swap indexes
-        if swap:
-            for row in ss_data:
-                sample_id = row['Sample_ID']
-                if (not project) or (project in sample_id):
-                    if platform == "miseq_old":
-                        storage = row['index']
-                        row['index'] = row['index2']
-                        row['I7_Index_ID'] = row['index2']
-                        row['index2'] = storage
-                        row['I5_Index_ID'] = storage
-                    elif platform == "miseq" or platform == "nextseq" or platform == "novaseq":
-                        storage = row['index']
-                        row['index'] = row['index2']
-                        row['index2'] = storage
-
-    redemux_ss = generate_samplesheet(ss_reader)
     if platform == "nextseq" or platform == "novaseq":
         filename = re.search('\/(\w+).csv$', path).group(1)
     else:
         filename = "SampleSheet"
 
-    with open('{}_redemux.csv'.format(filename), 'w') as fh_out:
-        fh_out.write(redemux_ss)
+    #written aside and renamed when complete, so that a failure halfway leaves no truncated samplesheet
+    redemux_path = '{}_redemux.csv'.format(filename)
+    partial_path = '{}.part'.format(redemux_path)
+    try:
+        with open(partial_path, 'w') as fh_out:
+            generate_samplesheet(path, fh_out, transform_rows)
+        os.rename(partial_path, redemux_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
 
 if __name__ == '__main__':
     main()
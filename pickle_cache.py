@@ -0,0 +1,24 @@
+"""Writing of the pickle caches kept by the scripts of this repository
+(illumina_indexes.py, project_inventory.py).
+"""
+import os
+import pickle
+
+
+def write_pickle(path, data):
+    """Pickle data to path atomically.
+
+    The data is written aside and renamed, so that concurrent runs never read half
+    a file; on failure the temporary file is removed and the error raised again.
+    """
+    temporary_file = '{}.{}'.format(path, os.getpid())
+    try:
+        with open(temporary_file, 'wb') as cache:
+            pickle.dump(data, cache, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_file, path)
+    except BaseException:
+        try:
+            os.remove(temporary_file)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,462 @@
+"""Inventory of the NGI directory trees of a project on UPPMAX (archive/incoming, DATA,
+ANALYSIS, DELIVERY), used by project_status.py and project_status_extended.py.
+
+Each root is read once with os.scandir, pruned to the parts the reports look at, and
+kept in memory as nested dicts: {name: subtree} for directories, {name: FileInfo} for
+files. The reports then answer their questions from the inventory instead of running
+their own glob/listdir passes over the shared filesystem.
+
+The inventory can be saved to a cache file: the next run only lists again the
+directories whose mtime changed, the others cost a single stat.
+"""
+import os
+import re
+import io
+import time
+import pickle
+import fnmatch
+from collections import namedtuple
+from pickle_cache import write_pickle
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+ARCHIVE_DIRS = ("/proj/{}/archive/", "/proj/{}/incoming/")
+DATA_DIR = "/proj/{}/nobackup/NGI/DATA/"
+ANALYSIS_DIR = "/proj/{}/nobackup/NGI/ANALYSIS/"
+DELIVERY_DIR = "/proj/{}/nobackup/NGI/DELIVERY/"
+#project ids in samplesheet lines
+PROJECT_ID = re.compile(r'(?<![A-Za-z0-9])P\d+(?!\d)')
+#headers of the project column of the [Data] section (new and old HiSeq samplesheets)
+PROJECT_COLUMNS = ("Sample_Project", "SampleProject")
+#sub directories of piper_ngi used by the reports
+ANALYSIS_SUBDIRS = ("01_raw_alignments", "05_processed_alignments", "06_final_alignment_qc", "logs")
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ngi_config", "project_inventory")
+#bumped whenever the layout of the cached trees changes
+CACHE_VERSION = 1
+#a directory modified less than this many seconds before it is read may change again within the
+#same mtime (1 s resolution on some filesystems), so it is listed again on the next run
+RACY_SECONDS = 2
+
+#size and mtime are None for broken symlinks
+FileInfo = namedtuple('FileInfo', ['size', 'mtime'])
+
+
+def _list_dir(path):
+    """(name, is directory, FileInfo or None) of the entries of path"""
+    entries = []
+    for entry in scandir(path):
+        try:
+            entry_is_dir = entry.is_dir()
+        except OSError:
+            entry_is_dir = False
+        if entry_is_dir:
+            entries.append((entry.name, True, None))
+            continue
+        try:
+            stat = entry.stat()
+            entries.append((entry.name, False, FileInfo(stat.st_size, stat.st_mtime)))
+        except OSError:
+            entries.append((entry.name, False, FileInfo(None, None)))
+    return entries
+
+
+def scan_tree(path, depth, descend=None, parts=(), previous=None, mtimes=None):
+    """Reads the tree under path with os.scandir, down to depth levels.
+
+    Returns {name: subtree} for directories and {name: FileInfo} for the other entries.
+    Directories at the last level, or for which descend(parts) is False (parts being the
+    names leading to them from path), are not read and left as {}. A missing path gives {}.
+
+    mtimes, if given, is filled with the mtime of every directory read, by parts. previous
+    is the (tree, mtimes) of an earlier scan of path: directories with the same mtime as then
+    are not listed again, their entries are taken from the earlier tree (their sub directories
+    are still checked). Sizes and mtimes of files are as of the last listing of their directory.
+    """
+    previous_tree, previous_mtimes = previous if previous is not None else ({}, {})
+    if previous_mtimes:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {}
+        unchanged = previous_mtimes.get(parts) == mtime
+    else:
+        mtime = None
+        unchanged = False
+    if unchanged:
+        entries = [(name, is_dir(node), None if is_dir(node) else node) for name, node in previous_tree.items()]
+    else:
+        try:
+            entries = _list_dir(path)
+        except OSError:
+            return {}
+    if mtimes is not None:
+        if mtime is None:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+        mtimes[parts] = mtime if mtime is not None and time.time() - mtime > RACY_SECONDS else None
+    tree = {}
+    for name, entry_is_dir, info in entries:
+        if not entry_is_dir:
+            tree[name] = info
+            continue
+        entry_parts = parts + (name,)
+        if depth > 1 and (descend is None or descend(entry_parts)):
+            previous_subtree = previous_tree.get(name)
+            tree[name] = scan_tree(os.path.join(path, name), depth - 1, descend, entry_parts,
+                                   (previous_subtree if is_dir(previous_subtree) else {}, previous_mtimes), mtimes)
+        else:
+            tree[name] = {}
+    return tree
+
+
+def is_dir(node):
+    return isinstance(node, dict)
+
+
+def is_file(node):
+    return isinstance(node, FileInfo) and node.size is not None
+
+
+def visible(tree):
+    """(name, node) of a directory as matched by a '*' of glob, i.e. hidden entries excluded"""
+    if not is_dir(tree):
+        return []
+    return [(name, node) for name, node in tree.items() if not name.startswith('.')]
+
+
+def match(tree, pattern):
+    """Names of the entries of a directory matching a glob pattern"""
+    if not is_dir(tree):
+        return []
+    return fnmatch.filter([name for name in tree if not name.startswith('.') or pattern.startswith('.')], pattern)
+
+
+class ProjectInventory(object):
+    """The files of a project (e.g. P1775) under the NGI directories of an UPPMAX project.
+
+    The roots are read the first time they are needed, once each:
+        archive(root): the X flowcells of archive/ or incoming/, down to the fastq files of the
+                 Sample_* directories of the project
+        data: DATA/<project>/<sample>/<libprep>/<flowcell>/<files>
+        analysis: ANALYSIS/<project>/piper_ngi, the sub directories in ANALYSIS_SUBDIRS
+        delivery: DELIVERY/<project>/<sample>
+    """
+
+    def __init__(self, uppmax_project, project, stockholm=True, cache_file=None, all_projects=False):
+        self.uppmax_project = uppmax_project
+        self.project = project
+        self.stockholm = stockholm
+        #the archive trees keep the samples of every project, to be shared by many projects (see share)
+        self.all_projects = all_projects
+        self.archive_dirs = tuple(archive_dir.format(uppmax_project) for archive_dir in ARCHIVE_DIRS)
+        self.data_dir = DATA_DIR.format(uppmax_project)
+        self.analysis_dir = ANALYSIS_DIR.format(uppmax_project)
+        self.delivery_dir = DELIVERY_DIR.format(uppmax_project)
+        self.cache_file = cache_file
+        #name -> (tree, mtimes) read during this run, and from the cache file
+        self._trees = {}
+        self._cached = self._load_cache() if cache_file is not None else {}
+        self._samplesheets = None
+        #trees (and 'samplesheets') taken from another inventory, saved by that one
+        self._shared = set()
+
+    def _tree(self, name, path, depth, descend=None):
+        if name not in self._trees:
+            mtimes = {}
+            tree = scan_tree(path, depth, descend, previous=self._cached.get(name), mtimes=mtimes)
+            self._trees[name] = (tree, mtimes)
+        return self._trees[name][0]
+
+    def archive(self, root):
+        """Tree of an archive root, only X flowcells are read below the root"""
+        return self._tree(('archive', root), root, 5, self._descend_archive)
+
+    @property
+    def data(self):
+        return self._tree('data', os.path.join(self.data_dir, self.project), 4)
+
+    @property
+    def analysis(self):
+        return self._tree('analysis', os.path.join(self.analysis_dir, self.project, "piper_ngi"), 3, self._descend_analysis)
+
+    @property
+    def delivery(self):
+        return self._tree('delivery', os.path.join(self.delivery_dir, self.project), 1)
+
+    def _cache_key(self):
+        #trees read with other settings are not reused
+        return {'version': CACHE_VERSION, 'uppmax_project': self.uppmax_project, 'project': self.project, 'stockholm': self.stockholm,
+                'all_projects': self.all_projects}
+
+    def share(self, project, cache_file=None):
+        """Inventory of project reusing the archive trees (read with all_projects), the listings and the
+        samplesheet index read by this one, so that they are read once for many projects.
+
+        The shared parts are left out of its cache file, which is the same as for a run on project alone.
+        """
+        inventory = ProjectInventory(self.uppmax_project, project, self.stockholm, cache_file)
+        for name, tree in self._trees.items():
+            if isinstance(name, tuple):
+                inventory._trees[name] = tree
+                inventory._shared.add(name)
+        if self._samplesheets is not None:
+            inventory._samplesheets = self._samplesheets
+            inventory._shared.add('samplesheets')
+        return inventory
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file, 'rb') as cache:
+                cached = pickle.load(cache)
+            if cached['key'] == self._cache_key():
+                return cached['trees']
+        except Exception:
+            pass
+        return {}
+
+    def save(self):
+        """Writes the trees read during this run, and those kept from the previous runs, to the cache file"""
+        if self.cache_file is None or not self._trees:
+            return
+        trees = dict(self._cached)
+        trees.update((name, tree) for name, tree in self._trees.items() if name not in self._shared)
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            write_pickle(self.cache_file, {'key': self._cache_key(), 'trees': trees})
+        except (IOError, OSError) as e:
+            print("WARNING: could not write the inventory cache {}: {}".format(self.cache_file, e))
+        if self._samplesheets is not None and 'samplesheets' not in self._shared:
+            self._samplesheets.save()
+
+    def _descend_archive(self, parts):
+        #<flowcell>/Demultiplexing/<project>/Sample_<sample>/<files>
+        if len(parts) == 1:
+            return "_ST-" in parts[0]
+        if len(parts) == 2:
+            return parts[1] == "Demultiplexing"
+        if len(parts) == 3:
+            return self.stockholm or self.all_projects or parts[2] == self.project
+        return parts[3].startswith("Sample_") and (self.all_projects or (not self.stockholm) or parts[3].replace("Sample_", "").startswith(self.project))
+
+    @staticmethod
+    def _descend_analysis(parts):
+        if len(parts) == 1:
+            return parts[0] in ANALYSIS_SUBDIRS
+        return parts[0] == "06_final_alignment_qc"
+
+    @property
+    def samplesheets(self):
+        """SamplesheetIndex of the flowcells in incoming, up to date, kept next to the cache file"""
+        if self._samplesheets is None:
+            incoming = self.archive_dirs[1]
+            index_file = None
+            if self.cache_file is not None:
+                index_file = samplesheet_index_file(self.uppmax_project, os.path.dirname(self.cache_file))
+            self._samplesheets = SamplesheetIndex(incoming, index_file)
+            self._samplesheets.update(self.flowcells(incoming))
+        return self._samplesheets
+
+    def flowcells(self, root):
+        """Names of the entries of an archive root (e.g. incoming), as os.listdir.
+
+        Taken from the tree of the root if it has been read already, otherwise only the root is listed.
+        """
+        if ('archive', root) in self._trees:
+            return list(self._trees[('archive', root)][0])
+        return list(self._tree(('listing', root), root, 1))
+
+    def archived_sample_dirs(self):
+        """Yields (sample name, Sample_ directory tree) for every sequencing of the project found in the archive"""
+        for root in self.archive_dirs:
+            for flowcell, run_tree in self.archive(root).items():
+                if "_ST-" not in flowcell:
+                    continue
+                demultiplexing = run_tree.get("Demultiplexing") if is_dir(run_tree) else None
+                for project_dir, project_tree in visible(demultiplexing):
+                    for sample_dir in match(project_tree, "Sample_*"):
+                        sample_name = sample_dir.replace("Sample_", "")
+                        if self.stockholm:
+                            if not sample_name.startswith(self.project):
+                                continue
+                        elif project_dir != self.project:
+                            continue
+                        yield sample_name, project_tree[sample_dir]
+
+    def data_samples(self):
+        """Names of the entries of DATA/<project>, hidden ones excluded"""
+        return [sample for sample in self.data if not sample.startswith(".")]
+
+    def data_files(self, sample=None):
+        """Yields (sample, libprep, flowcell, file name, FileInfo) of the files organized in DATA"""
+        samples = [(sample, self.data.get(sample))] if sample is not None else visible(self.data)
+        for sample_name, sample_tree in samples:
+            for libprep, libprep_tree in visible(sample_tree):
+                for flowcell, flowcell_tree in visible(libprep_tree):
+                    for file_name, info in visible(flowcell_tree):
+                        yield sample_name, libprep, flowcell, file_name, info
+
+    def is_organized(self, sample, flowcell):
+        """True if DATA/<project>/<sample>/*/<flowcell> exists"""
+        sample_tree = self.data.get(sample)
+        return any(is_dir(libprep_tree) and flowcell in libprep_tree for libprep, libprep_tree in visible(sample_tree))
+
+    def analysis_entries(self, subdir, pattern="*"):
+        """Names in piper_ngi/<subdir> matching pattern"""
+        return match(self.analysis.get(subdir), pattern)
+
+    def analysis_path(self, *names):
+        return os.path.join(self.analysis_dir, self.project, "piper_ngi", *names)
+
+    def has_analysis_file(self, subdir, *names):
+        """True if piper_ngi/<subdir>/<names...> is a file"""
+        node = self.analysis.get(subdir)
+        for name in names:
+            node = node.get(name) if is_dir(node) else None
+        return is_file(node)
+
+    def delivered_samples(self):
+        """Directories of DELIVERY/<project> but 00-Reports"""
+        return [sample for sample, node in self.delivery.items() if is_dir(node) and sample != "00-Reports"]
+
+
+class SamplesheetIndex(object):
+    """The samples of the SampleSheet.csv of the flowcells of a directory (e.g. incoming), by project.
+
+    Every samplesheet is parsed once into {project: [sample of each line naming the project]},
+    projects being the P followed by digits found in the line and the value of the Sample_Project
+    column (e.g. OB-0726), the sample the third column, and kept with the mtime
+    and size of the file. An update only parses again the samplesheets of new flowcells or whose
+    mtime or size changed, and forgets the flowcells that are gone. The index can be kept in a
+    cache file.
+    """
+
+    #bumped whenever _parse changes, so that the cached samplesheets are parsed again
+    VERSION = 2
+
+    def __init__(self, root, cache_file=None):
+        self.root = root
+        self.cache_file = cache_file
+        #flowcell -> (mtime, size, {project: [sample]}, {project: [line without sample]}),
+        #(None, None, {}, {}) without samplesheet
+        self.flowcells = {}
+        #flowcells of the last update, in the order given
+        self.order = []
+        if cache_file is not None:
+            try:
+                with open(cache_file, 'rb') as cache:
+                    cached = pickle.load(cache)
+                if cached['version'] == (CACHE_VERSION, self.VERSION) and cached['root'] == root:
+                    self.flowcells = cached['flowcells']
+            except Exception:
+                pass
+
+    @staticmethod
+    def _parse(path):
+        samples = {}
+        skipped = {}
+        project_column = None
+        with io.open(path, encoding='utf-8', errors='replace') as samplesheet:
+            for line in samplesheet:
+                line = line.rstrip('\n')
+                fields = line.split(',')
+                header = [field.strip() for field in fields]
+                columns = [header.index(column) for column in PROJECT_COLUMNS if column in header]
+                if columns:
+                    #header of the [Data] section
+                    project_column = columns[0]
+                    continue
+                projects = set(PROJECT_ID.findall(line))
+                if project_column is not None and len(fields) > project_column and fields[project_column].strip():
+                    projects.add(fields[project_column].strip())
+                if not projects:
+                    continue
+                for project in projects:
+                    if len(fields) > 2:
+                        samples.setdefault(project, []).append(fields[2])
+                    else:
+                        skipped.setdefault(project, []).append(line)
+        return samples, skipped
+
+    def update(self, flowcells):
+        """Brings the index up to date with flowcells, the names of the entries of root"""
+        updated = {}
+        for flowcell in flowcells:
+            path = os.path.join(self.root, flowcell, 'SampleSheet.csv')
+            try:
+                stat = os.stat(path)
+            except OSError:
+                updated[flowcell] = (None, None, {}, {})
+                continue
+            previous = self.flowcells.get(flowcell)
+            if previous is not None and previous[0] == stat.st_mtime and previous[1] == stat.st_size:
+                updated[flowcell] = previous
+            else:
+                try:
+                    updated[flowcell] = (stat.st_mtime, stat.st_size) + self._parse(path)
+                except (IOError, OSError):
+                    updated[flowcell] = (None, None, {}, {})
+        self.flowcells = updated
+        self.order = list(flowcells)
+
+    def samples(self, project):
+        """Yields (flowcell, sample) for every samplesheet line naming project"""
+        for flowcell in self.order:
+            for sample in self.flowcells[flowcell][2].get(project, []):
+                yield flowcell, sample
+
+    def skipped_lines(self, project):
+        """Yields (flowcell, line) for the lines naming project but without a sample column"""
+        for flowcell in self.order:
+            for line in self.flowcells[flowcell][3].get(project, []):
+                yield flowcell, line
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        try:
+            write_pickle(self.cache_file, {'version': (CACHE_VERSION, self.VERSION), 'root': self.root, 'flowcells': self.flowcells})
+        except (IOError, OSError) as e:
+            print("WARNING: could not write the samplesheet index {}: {}".format(self.cache_file, e))
+
+
+def cache_file(uppmax_project, project, cache_dir=DEFAULT_CACHE_DIR):
+    """Default cache file of the inventory of a project"""
+    return os.path.join(cache_dir, "{}_{}.pickle".format(uppmax_project, project))
+
+
+def samplesheet_index_file(uppmax_project, cache_dir=DEFAULT_CACHE_DIR):
+    """SamplesheetIndex file shared by the projects of an UPPMAX project"""
+    return os.path.join(cache_dir, "{}_samplesheets.pickle".format(uppmax_project))
+
+
+def add_cache_arguments(parser):
+    """Adds the options controlling the inventory cache to an argparse parser"""
+    parser.add_argument('--cache-dir', help="directory where the inventory of each project is kept between runs", type=str, default=DEFAULT_CACHE_DIR)
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument('--no-cache', help="read the whole filesystem, do not use nor write the inventory cache", action='store_true')
+    cache_mode.add_argument('--refresh-cache', help="read the whole filesystem and rewrite the inventory cache", action='store_true')
+
+
+def cache_path_from_args(uppmax_project, project, args):
+    """Cache file of a project given the options added by add_cache_arguments, None with --no-cache.
+    With --refresh-cache the file is removed, with the samplesheet index of the UPPMAX project."""
+    if args.no_cache:
+        return None
+    path = cache_file(uppmax_project, project, args.cache_dir)
+    if args.refresh_cache:
+        for stale in (path, samplesheet_index_file(uppmax_project, args.cache_dir)):
+            if os.path.exists(stale):
+                os.remove(stale)
+    return path
+
+
+def inventory_from_args(uppmax_project, project, args, stockholm=True):
+    """Builds the ProjectInventory of a project from the options added by add_cache_arguments"""
+    return ProjectInventory(uppmax_project, project, stockholm, cache_path_from_args(uppmax_project, project, args))
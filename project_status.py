@@ -1,8 +1,9 @@
-import sys, os, glob
+import sys, os
 import argparse
+import fnmatch
 from operator import itemgetter
-import glob
 import six
+from project_inventory import match, add_cache_arguments, inventory_from_args
 
 def init_sample_hash_emtry():
     empty_sample_result = {
@@ -21,63 +22,41 @@ def init_sample_hash_emtry():
     }
     return empty_sample_result
 
-def find_samples_from_archive(roots, project, samples, stockholm):
-    """given a project (e.g. P1775 or OB-0726) finds all samples sequenced for that specif project
+def find_samples_from_archive(inventory, samples):
+    """given the inventory of a project (e.g. P1775 or OB-0726) finds all samples sequenced for that specif project
     it assumes that we never delete the folder stucture, but only fastq files
     returns an hash with one sample name as key and number of seq runs that contain that sample
      """
-    for root in roots:
-        for dir in os.listdir(root):
-            if "_ST-" in dir:
-                #must be an X FC
-                run_dir     = os.path.join(root, dir)
-                sample_dirs = glob.glob("{}/Demultiplexing/*/Sample_*".format(run_dir))
-                for sample in sample_dirs:
-                    if stockholm:
-                        sample_name = sample.split("/")[-1].replace("Sample_", "")
-                        if not sample_name.startswith(project):
-                            continue
-                    else:#uppsala case
-                        current_project = sample.split("/")[-2]
-                        if project != current_project:
-                            continue
-                        sample_name = sample.split("/")[-1].replace("Sample_", "")
-                    if not sample_name in samples:
-                        samples[sample_name] = init_sample_hash_emtry()
-                    archived_runs = len(glob.glob("{}/{}*L0*R1*fastq.gz".format(sample,sample_name)))
-                    if archived_runs == 0: #stockholm case
-                        sampe_name_hyphen = sample_name.replace("_", "-")
-                        archived_runs = len(glob.glob("{}/{}*L00*R1*fastq.gz".format(sample,sampe_name_hyphen)))
-                    samples[sample_name]["#Archived_runs"] += archived_runs
-
-
-def find_sample_from_DATA(root, project, samples ):
-    """given a project (e.g. P1775) finds all samples tranfered to DATA folder
+    for sample_name, sample_tree in inventory.archived_sample_dirs():
+        if not sample_name in samples:
+            samples[sample_name] = init_sample_hash_emtry()
+        archived_runs = len(match(sample_tree, "{}*L0*R1*fastq.gz".format(sample_name)))
+        if archived_runs == 0: #stockholm case
+            sampe_name_hyphen = sample_name.replace("_", "-")
+            archived_runs = len(match(sample_tree, "{}*L00*R1*fastq.gz".format(sampe_name_hyphen)))
+        samples[sample_name]["#Archived_runs"] += archived_runs
+
+
+def find_sample_from_DATA(inventory, samples):
+    """given the inventory of a project (e.g. P1775) finds all samples tranfered to DATA folder
     returns an hash with one sample name as key and number of seq runs (or lanes runs)
     """
-    if not os.path.exists(os.path.join(root,project)):
-        return samples
-
-    for sample in os.listdir(os.path.join(root,project)):
+    for sample in inventory.data_samples():
         #DATA/SAMPLE/LIB_PREPS/RUNS
-        if sample.startswith("."):
-            continue
-        sample_data_dir = os.path.join(root, project, sample)
-        sample_runs     = glob.glob("{}/*/*/{}*L0*_R1*fastq.gz".format(sample_data_dir,sample)) #if sample splitted in multiple lanes there will be an entry per lane
+        pattern = "{}*L0*_R1*fastq.gz".format(sample)
+        sample_runs = [file_name for _, _, _, file_name, _ in inventory.data_files(sample) if fnmatch.fnmatch(file_name, pattern)] #if sample splitted in multiple lanes there will be an entry per lane
         if not sample in samples:
             samples[sample] = init_sample_hash_emtry()
         samples[sample]['#Data_runs'] = len(sample_runs)
 
 
-def find_sample_from_ANALYSIS(root, project, samples):
-    """given a project (e.g. P1775) finds all samples in ANALYSIS folder
+def find_sample_from_ANALYSIS(inventory, samples):
+    """given the inventory of a project (e.g. P1775) finds all samples in ANALYSIS folder
        returns an hash with one sample name as key and various stats on the sample
        It does this by looking at the bam.out files that is present in the 01_raw_alignments folder
        A sample is counted here if it is found in 01_raw_alignments
     """
-    raw_alignments_dir = os.path.join(root, project, "piper_ngi", "01_raw_alignments")
-    for sample_run in glob.glob("{}/*.out".format(raw_alignments_dir)):
-        sample_run_algn = sample_run.split("/")[-1] # this looks like P1775_102.AH2T7GCCXX.P1775_102.1.bam.out
+    for sample_run_algn in inventory.analysis_entries("01_raw_alignments", "*.out"): # this looks like P1775_102.AH2T7GCCXX.P1775_102.1.bam.out
         sample_name = sample_run_algn.split(".")[0]
         sample_lane = int(sample_run_algn.split(".")[3])
         if not sample_name in samples:
@@ -86,41 +65,34 @@ def find_sample_from_ANALYSIS(root, project, samples):
 
     # now check if I can retrive other informaiton about  this sample
     for sample, sample_entry in samples.items():
-        genome_results_file = os.path.join(root, project, "piper_ngi", "06_final_alignment_qc",
-                                           "{}.clean.dedup.qc".format(sample),
-                                           "genome_results.txt")
+        genome_results = ("06_final_alignment_qc", "{}.clean.dedup.qc".format(sample), "genome_results.txt")
+        has_genome_results = inventory.has_analysis_file(*genome_results)
 
-        if os.path.isfile(genome_results_file) and sample_entry['#Analysis_runs'] == 0:
+        if has_genome_results and sample_entry['#Analysis_runs'] == 0:
             sample_entry['#Analysis_runs'] = 1 # at least one is present
 
         if sample_entry['#Analysis_runs'] > 0:
             #if i have run some analysis on this sample fetch info about sequenced reads and coverage
-            picard_duplication_metrics = os.path.join(root, project, "piper_ngi", "05_processed_alignments",
-                                               "{}.metrics".format(sample))
+            picard_duplication_metrics = ("05_processed_alignments", "{}.metrics".format(sample))
 
-            if os.path.isfile(genome_results_file):
+            if has_genome_results:
                 #store informations
-                parse_qualimap(genome_results_file, sample_entry)
+                parse_qualimap(inventory.analysis_path(*genome_results), sample_entry)
 
 
-            if os.path.isfile(picard_duplication_metrics) and sample_entry['#Reads'] > 0:
+            if inventory.has_analysis_file(*picard_duplication_metrics) and sample_entry['#Reads'] > 0:
                 # if picard file exists and bamqc has been parsed with success
-                parse_bamtools_markdup(picard_duplication_metrics, sample_entry)
+                parse_bamtools_markdup(inventory.analysis_path(*picard_duplication_metrics), sample_entry)
 
 
-def find_sample_from_DELIVERY(root, project, samples):
-    """given a project (e.g. P1775) finds all samples in DELIVERED folder
+def find_sample_from_DELIVERY(inventory, samples):
+    """given the inventory of a project (e.g. P1775) finds all samples in DELIVERED folder
        returns an hash with one sample name as key the key delivered set as true or false
     """
-    project_delivery_dir = os.path.join(root,project)
-    if not os.path.exists(project_delivery_dir):
-        return None
-
-    for sample in os.listdir(project_delivery_dir):
-        if os.path.isdir(os.path.join(project_delivery_dir, sample)) and sample != "00-Reports":
-            if not sample in samples:
-                samples[sample] = init_sample_hash_emtry()
-            samples[sample]['Delivered'] = True
+    for sample in inventory.delivered_samples():
+        if not sample in samples:
+            samples[sample] = init_sample_hash_emtry()
+        samples[sample]['Delivered'] = True
 
 
 def parse_bamtools_markdup(picard_duplication_metrics, sample):
@@ -223,10 +195,6 @@ def parse_qualimap(genome_results_file, sample):
 def main(args):
     uppmax_id    = args.uppmax_project
     stockholm    = args.stockholm
-    raw_data     = "/proj/{}/nobackup/NGI/DATA/".format(uppmax_id)
-    analysis_dir = "/proj/{}/nobackup/NGI/ANALYSIS/".format(uppmax_id)
-    delivery_dir = "/proj/{}/nobackup/NGI/DELIVERY/".format(uppmax_id)
-    archive      = ("/proj/{}/archive/".format(uppmax_id), "/proj/{}/incoming/".format(uppmax_id))
     samples      = {}
 
 
@@ -238,12 +206,14 @@ def main(args):
             return
 
     for project in args.projects[0]:
+        inventory = inventory_from_args(uppmax_id, project, args, stockholm)
         #find all samples sequenced for a project present in archive -- this assumes that fastq files will be deleted but not the folder structure
-        find_samples_from_archive(archive, project, samples, stockholm)
+        find_samples_from_archive(inventory, samples)
         #now find samples that are stored in DATA
-        find_sample_from_DATA(raw_data, project, samples)
-        find_sample_from_ANALYSIS(analysis_dir, project, samples)
-        find_sample_from_DELIVERY(delivery_dir, project, samples)
+        find_sample_from_DATA(inventory, samples)
+        find_sample_from_ANALYSIS(inventory, samples)
+        find_sample_from_DELIVERY(inventory, samples)
+        inventory.save()
 
     if args.project_status:
         sequenced_samples = 0
@@ -310,6 +280,7 @@ if __name__ == '__main__':
 
     parser.add_argument('--skip-header', help="skip header", action='store_true')
     parser.add_argument('--stockholm', help="assume stocholm project format, otherwise uppsala", action='store_true', default=True)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
 
@@ -1,8 +1,13 @@
-import sys, os, glob
+import sys, os
 import argparse
+import fnmatch
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from operator import itemgetter
 import subprocess
 import six
+from project_inventory import ProjectInventory, match, add_cache_arguments, inventory_from_args, cache_path_from_args
 
 
 uppmax_id = 'ngi2016003'
@@ -24,63 +29,41 @@ def init_sample_hash_emtry():
     }
     return empty_sample_result
 
-def find_samples_from_archive(roots, project, samples, stockholm=True):
-    """given a project (e.g. P1775 or OB-0726) finds all samples sequenced for that specif project
+def find_samples_from_archive(inventory, samples):
+    """given the inventory of a project (e.g. P1775 or OB-0726) finds all samples sequenced for that specif project
     it assumes that we never delete the folder stucture, but only fastq files
     returns an hash with one sample name as key and number of seq runs that contain that sample
      """
-    for root in roots:
-        for dir in os.listdir(root):
-            if "_ST-" in dir:
-                #must be an X FC
-                run_dir     = os.path.join(root, dir)
-                sample_dirs = glob.glob("{}/Demultiplexing/*/Sample_*".format(run_dir))
-                for sample in sample_dirs:
-                    if stockholm:
-                        sample_name = sample.split("/")[-1].replace("Sample_", "")
-                        if not sample_name.startswith(project):
-                            continue
-                    else:#uppsala case
-                        current_project = sample.split("/")[-2]
-                        if project != current_project:
-                            continue
-                        sample_name = sample.split("/")[-1].replace("Sample_", "")
-                    if not sample_name in samples:
-                        samples[sample_name] = init_sample_hash_emtry()
-                    archived_runs = len(glob.glob("{}/{}*L0*R1*fastq.gz".format(sample,sample_name)))
-                    if archived_runs == 0: #stockholm case
-                        sampe_name_hyphen = sample_name.replace("_", "-")
-                        archived_runs = len(glob.glob("{}/{}*L00*R1*fastq.gz".format(sample,sampe_name_hyphen)))
-                    samples[sample_name]["#Archived_runs"] += archived_runs
-
-
-def find_sample_from_DATA(root, project, samples ):
-    """given a project (e.g. P1775) finds all samples tranfered to DATA folder
+    for sample_name, sample_tree in inventory.archived_sample_dirs():
+        if not sample_name in samples:
+            samples[sample_name] = init_sample_hash_emtry()
+        archived_runs = len(match(sample_tree, "{}*L0*R1*fastq.gz".format(sample_name)))
+        if archived_runs == 0: #stockholm case
+            sampe_name_hyphen = sample_name.replace("_", "-")
+            archived_runs = len(match(sample_tree, "{}*L00*R1*fastq.gz".format(sampe_name_hyphen)))
+        samples[sample_name]["#Archived_runs"] += archived_runs
+
+
+def find_sample_from_DATA(inventory, samples):
+    """given the inventory of a project (e.g. P1775) finds all samples tranfered to DATA folder
     returns an hash with one sample name as key and number of seq runs (or lanes runs)
     """
-    if not os.path.exists(os.path.join(root,project)):
-        return samples
-
-    for sample in os.listdir(os.path.join(root,project)):
+    for sample in inventory.data_samples():
         #DATA/SAMPLE/LIB_PREPS/RUNS
-        if sample.startswith("."):
-            continue
-        sample_data_dir = os.path.join(root, project, sample)
-        sample_runs     = glob.glob("{}/*/*/{}*L0*_R1*fastq.gz".format(sample_data_dir,sample)) #if sample splitted in multiple lanes there will be an entry per lane
+        pattern = "{}*L0*_R1*fastq.gz".format(sample)
+        sample_runs = [file_name for _, _, _, file_name, _ in inventory.data_files(sample) if fnmatch.fnmatch(file_name, pattern)] #if sample splitted in multiple lanes there will be an entry per lane
         if not sample in samples:
             samples[sample] = init_sample_hash_emtry()
         samples[sample]['#Data_runs'] = len(sample_runs)
 
 
-def find_sample_from_ANALYSIS(root, project, samples):
-    """given a project (e.g. P1775) finds all samples in ANALYSIS folder
+def find_sample_from_ANALYSIS(inventory, samples):
+    """given the inventory of a project (e.g. P1775) finds all samples in ANALYSIS folder
        returns an hash with one sample name as key and various stats on the sample
        It does this by looking at the bam.out files that is present in the 01_raw_alignments folder
        A sample is counted here if it is found in 01_raw_alignments
     """
-    raw_alignments_dir = os.path.join(root, project, "piper_ngi", "01_raw_alignments")
-    for sample_run in glob.glob("{}/*.out".format(raw_alignments_dir)):
-        sample_run_algn = sample_run.split("/")[-1] # this looks like P1775_102.AH2T7GCCXX.P1775_102.1.bam.out
+    for sample_run_algn in inventory.analysis_entries("01_raw_alignments", "*.out"): # this looks like P1775_102.AH2T7GCCXX.P1775_102.1.bam.out
         sample_name = sample_run_algn.split(".")[0]
         sample_lane = int(sample_run_algn.split(".")[3])
         if not sample_name in samples:
@@ -89,41 +72,34 @@ def find_sample_from_ANALYSIS(root, project, samples):
 
     # now check if I can retrive other informaiton about  this sample
     for sample, sample_entry in samples.items():
-        genome_results_file = os.path.join(root, project, "piper_ngi", "06_final_alignment_qc",
-                                           "{}.clean.dedup.qc".format(sample),
-                                           "genome_results.txt")
+        genome_results = ("06_final_alignment_qc", "{}.clean.dedup.qc".format(sample), "genome_results.txt")
+        has_genome_results = inventory.has_analysis_file(*genome_results)
 
-        if os.path.isfile(genome_results_file) and sample_entry['#Analysis_runs'] == 0:
+        if has_genome_results and sample_entry['#Analysis_runs'] == 0:
             sample_entry['#Analysis_runs'] = 1 # at least one is present
 
         if sample_entry['#Analysis_runs'] > 0:
             #if i have run some analysis on this sample fetch info about sequenced reads and coverage
-            picard_duplication_metrics = os.path.join(root, project, "piper_ngi", "05_processed_alignments",
-                                               "{}.metrics".format(sample))
+            picard_duplication_metrics = ("05_processed_alignments", "{}.metrics".format(sample))
 
-            if os.path.isfile(genome_results_file):
+            if has_genome_results:
                 #store informations
-                parse_qualimap(genome_results_file, sample_entry)
+                parse_qualimap(inventory.analysis_path(*genome_results), sample_entry)
 
 
-            if os.path.isfile(picard_duplication_metrics) and sample_entry['#Reads'] > 0:
+            if inventory.has_analysis_file(*picard_duplication_metrics) and sample_entry['#Reads'] > 0:
                 # if picard file exists and bamqc has been parsed with success
-                parse_bamtools_markdup(picard_duplication_metrics, sample_entry)
+                parse_bamtools_markdup(inventory.analysis_path(*picard_duplication_metrics), sample_entry)
 
 
-def find_sample_from_DELIVERY(root, project, samples):
-    """given a project (e.g. P1775) finds all samples in DELIVERED folder
+def find_sample_from_DELIVERY(inventory, samples):
+    """given the inventory of a project (e.g. P1775) finds all samples in DELIVERED folder
        returns an hash with one sample name as key the key delivered set as true or false
     """
-    project_delivery_dir = os.path.join(root,project)
-    if not os.path.exists(project_delivery_dir):
-        return None
-
-    for sample in os.listdir(project_delivery_dir):
-        if os.path.isdir(os.path.join(project_delivery_dir, sample)) and sample != "00-Reports":
-            if not sample in samples:
-                samples[sample] = init_sample_hash_emtry()
-            samples[sample]['Delivered'] = True
+    for sample in inventory.delivered_samples():
+        if not sample in samples:
+            samples[sample] = init_sample_hash_emtry()
+        samples[sample]['Delivered'] = True
 
 
 def parse_bamtools_markdup(picard_duplication_metrics, sample):
@@ -215,17 +191,15 @@ def parse_qualimap(genome_results_file, sample):
     sample['MedianInsertSize'] = MedianInsertSize
     sample['AutosomalCoverage'] = autosomal_cov_bases / autosomal_cov_length
 
-def find_results_from_francesco(uppmax_project, project):
-    raw_data_dir = "/proj/{}/nobackup/NGI/DATA/".format(uppmax_project)
-    analysis_dir = "/proj/{}/nobackup/NGI/ANALYSIS/".format(uppmax_project)
-    delivery_dir = "/proj/{}/nobackup/NGI/DELIVERY/".format(uppmax_project)
-    archive_dir  = ("/proj/{}/archive/".format(uppmax_project), "/proj/{}/incoming/".format(uppmax_project))
+def find_results_from_francesco(uppmax_project, project, inventory=None):
+    if inventory is None:
+        inventory = ProjectInventory(uppmax_project, project)
     samples      = {}
 
-    find_samples_from_archive(archive_dir, project, samples)
-    find_sample_from_DATA(raw_data_dir, project, samples)
-    find_sample_from_ANALYSIS(analysis_dir, project, samples)
-    find_sample_from_DELIVERY(delivery_dir, project, samples)
+    find_samples_from_archive(inventory, samples)
+    find_sample_from_DATA(inventory, samples)
+    find_sample_from_ANALYSIS(inventory, samples)
+    find_sample_from_DELIVERY(inventory, samples)
 
     return samples
 
@@ -245,22 +219,18 @@ def get_low_coverage(project, results_francesco):
             result[sample] = coverage
     return result
 
-def get_samples_with_undetermined(data_dir, project):
+def get_samples_with_undetermined(inventory):
     """ get all fastq_files from DATA directory
         check which ones named 'Undetermined'
         then add sample and flowcell to the list
     """
     result = {}
     # get list of fastq_files in DATA directory
-    project_path = os.path.join(data_dir, project, '*/*/*/*.fastq*')
-    fastq_files = glob.glob(project_path)
-    for file_path in fastq_files:
+    for _, _, flowcell, filename, _ in inventory.data_files():
         # check which files are named 'Undetermined'
-        filename = os.path.basename(file_path)
-        if 'Undetermined' in filename:
+        if fnmatch.fnmatch(filename, '*.fastq*') and 'Undetermined' in filename:
             # get sample and flowcell id
             sample = filename.split('_Undetermined')[0]
-            flowcell = file_path.split('/')[-2]
             # update result list
             if sample not in result:
                 result[sample] = [flowcell]
@@ -305,10 +275,9 @@ def get_samples_under_qc(project):
                 result.append(sample)
     return result
 
-def get_samples_with_failed_analysis(project, analysis_dir):
-    log_path = os.path.join(analysis_dir, '{}/piper_ngi/logs/{}-*.exit'.format(project, project))
+def get_samples_with_failed_analysis(project, inventory):
     under_analysis = get_samples_under_analysis(project)
-    exit_files = glob.glob(log_path)
+    exit_files = [inventory.analysis_path('logs', name) for name in inventory.analysis_entries('logs', '{}-*.exit'.format(project))]
     result = {}
     for path in exit_files:
         with open(path, 'r') as exit_file:
@@ -348,45 +317,27 @@ def get_incoherent_samples(results_francesco):
     return result
 
 
-def get_sequenced(project):
-    incoming = "/proj/ngi2016003/incoming"
+def get_sequenced(project, inventory, verbose=True):
+    """samples of project in the samplesheets of incoming, with the flowcells (one per samplesheet line) they are on"""
     project_flowcells = {}
-    for fc in os.listdir(incoming):
-        sample_sheet = os.path.join(incoming, fc, 'SampleSheet.csv')
-        command = 'grep {} {}'.format(project, sample_sheet)
-        try:
-            p = subprocess.Popen(command, shell=True, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except Exception as e:
-            print('Command failed: {}'.format(command))
-            raise e
-        output = p.communicate()[0]
-        if output:
-            for line in output.split('\n'):
-                # if not an empty line
-                if line:
-                    try:
-                        sample = line.split(',')[2]
-                    except Exception as e:
-                        print(line)
-                        print('Skipping line: {} from sample sheet: {}'.format(line, sample_sheet))
-                        # if something went wrong
-                        continue
-                    else:
-                        if sample not in project_flowcells:
-                            project_flowcells[sample] = [fc]
-                        else:
-                            project_flowcells[sample].append(fc)
+    for fc, line in inventory.samplesheets.skipped_lines(project) if verbose else []:
+        print(line)
+        print('Skipping line: {} from sample sheet: {}'.format(line, os.path.join(inventory.samplesheets.root, fc, 'SampleSheet.csv')))
+    for fc, sample in inventory.samplesheets.samples(project):
+        if sample not in project_flowcells:
+            project_flowcells[sample] = [fc]
+        else:
+            project_flowcells[sample].append(fc)
     return project_flowcells
 
-def get_organized(project):
-    sequenced = get_sequenced(project)
-    project_path = os.path.join('/proj/ngi2016003/nobackup/NGI/DATA', project)
+def get_organized(project, inventory, sequenced=None):
+    if sequenced is None:
+        sequenced = get_sequenced(project, inventory)
     organized = {}
     for sample in sequenced:
         for fc in sequenced[sample]:
-            # '*'' is libprep, can be 'A', 'B', etc
-            path = os.path.join(project_path, sample, '*', fc)
-            if glob.glob(path): # list of files
+            # DATA/<project>/<sample>/*/<fc>, '*'' is libprep, can be 'A', 'B', etc
+            if inventory.is_organized(sample, fc):
                 if sample not in organized:
                     organized[sample] = [fc]
                 elif fc not in organized[sample]:
@@ -397,26 +348,109 @@ def get_organized(project):
 def get_reprepped(project):
     pass
 
-def get_not_organized(project):
-    flowcells_samples = get_sequenced(project)
-    project_path = os.path.join('/proj/ngi2016003/nobackup/NGI/DATA', project)
+def get_not_organized(project, inventory):
+    flowcells_samples = get_sequenced(project, inventory)
     not_organized = {}
     for sample in flowcells_samples:
         for fc in flowcells_samples[sample]:
-            # '*'' is libprep, can be 'A', 'B', etc
-            path = os.path.join(project_path, sample, '*', fc)
-            if not glob.glob(path):
+            # DATA/<project>/<sample>/*/<fc>, '*'' is libprep, can be 'A', 'B', etc
+            if not inventory.is_organized(sample, fc):
                 if sample not in not_organized:
                     not_organized[sample] = [fc]
                 else:
                     not_organized[sample].append(fc)
     return not_organized
 
+# columns of the combined report of several projects, one row per sample
+REPORT_COLUMNS = ['project', 'sample', '#Archived_runs', '#Data_runs', '#Analysis_runs', 'Delivered', '#Reads', 'RowCov',
+                  '#AlignedReads', '%AlignedReads', 'AlignCov', 'AutosomalCoverage', '%Dup', 'MedianInsertSize',
+                  'Sequenced_flowcells', 'Organized_flowcells', 'Undetermined_flowcells', 'Error']
+
+# inventory with the archive trees and samplesheet index of all the projects, set in each worker of report_projects
+_SHARED_INVENTORY = None
+
+def get_project_report(project, inventory):
+    """one row per sample of project: the statistics of find_results_from_francesco and
+    the flowcells the sample has been sequenced on, organized from and with undetermined"""
+    samples = find_results_from_francesco(inventory.uppmax_project, project, inventory)
+    sequenced = get_sequenced(project, inventory, verbose=False)
+    organized = get_organized(project, inventory, sequenced)
+    undetermined = get_samples_with_undetermined(inventory)
+    rows = []
+    for sample in sorted(set(samples) | set(sequenced)):
+        row = OrderedDict((column, None) for column in REPORT_COLUMNS)
+        row.update(init_sample_hash_emtry())
+        row.update(samples.get(sample, {}))
+        row['project'] = project
+        row['sample'] = sample
+        row['Sequenced_flowcells'] = sorted(sequenced.get(sample, []))
+        row['Organized_flowcells'] = sorted(organized.get(sample, []))
+        row['Undetermined_flowcells'] = sorted(undetermined.get(sample, []))
+        rows.append(OrderedDict((column, row[column]) for column in REPORT_COLUMNS))
+    if not rows:
+        # every project asked for is listed, even without samples
+        row = OrderedDict((column, None) for column in REPORT_COLUMNS)
+        row['project'] = project
+        rows.append(row)
+    return rows
+
+def _init_report_worker(shared):
+    global _SHARED_INVENTORY
+    _SHARED_INVENTORY = shared
+
+def _report_project(project, cache_file=None):
+    # a project that fails gets an error row, the other projects are still reported
+    try:
+        inventory = _SHARED_INVENTORY.share(project, cache_file)
+        rows = get_project_report(project, inventory)
+        inventory.save()
+        return rows
+    except Exception as e:
+        row = OrderedDict((column, None) for column in REPORT_COLUMNS)
+        row['project'] = project
+        row['Error'] = "{}: {}".format(type(e).__name__, e)
+        return [row]
+
+def report_projects(shared, projects, cache_files, workers=1):
+    """rows of get_project_report of every project of projects, in order.
+
+    The archive trees and the samplesheet index are read once in shared, the projects are
+    then evaluated by workers processes, each starting from a copy of shared.
+    """
+    for root in shared.archive_dirs:
+        shared.archive(root)
+    shared.samplesheets
+    shared.save()
+    if workers <= 1:
+        _init_report_worker(shared)
+        results = [_report_project(project, cache_files[project]) for project in projects]
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_report_worker, initargs=(shared, )) as pool:
+            results = list(pool.map(_report_project, projects, [cache_files[project] for project in projects]))
+    return [row for rows in results for row in rows]
+
+def print_report(rows, report_format='tsv', skip_header=False):
+    if report_format == 'json':
+        print(json.dumps(rows, indent=2))
+        return
+    if not skip_header:
+        print("\t".join(REPORT_COLUMNS))
+    for row in rows:
+        values = []
+        for column in REPORT_COLUMNS:
+            value = row[column]
+            if isinstance(value, list):
+                value = ','.join(value)
+            values.append('' if value is None else str(value))
+        print("\t".join(values))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("""Process one or more project and report basic statistiscs for it """)
     parser.add_argument('projects', metavar='project', type=str, nargs='+', help='Projects we want to have statistics for (P1111)')
     parser.add_argument('--project-status', help="reports number of samples, of samples-runs, analysed samples and delivered samples (work only if a single project is specified)", action='store_true')
     parser.add_argument('--skip-header', help="skip header", action='store_true')
+    parser.add_argument('--report', help="one combined report of all the projects, a row per sample (the default, in tsv, when more than one project is specified, the other options then do not apply)", choices=['tsv', 'json'])
+    parser.add_argument('--workers', help="number of projects evaluated in parallel by --report", type=int, default=1)
 
     # added by Kate
     parser.add_argument('--incoherent', help="Project-status but only for samples which have incoherent number of sequenced/organized/analyzed", action="store_true")
@@ -440,21 +474,29 @@ if __name__ == '__main__':
     parser.add_argument('--to-sequence', help="List of the samples that are not sequenced AT ALL on ANY flowcells or lanes. Not implemented yet", action="store_true")
     parser.add_argument('--qc-done', help="List of samples with completed QC. Not implemented yet", action="store_true")
     parser.add_argument('--sample', '-s', type=str, help="Statistics for the specified sample. Not implemented yet")
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
     if not args.projects:
         print("ERROR: project must be specified")
         sys.exit()
 
+    if args.report or len(args.projects) > 1:
+        # archive and incoming are read once for all the projects, DATA, ANALYSIS and DELIVERY once per project
+        cache_files = dict((project, cache_path_from_args(uppmax_id, project, args)) for project in args.projects)
+        shared = ProjectInventory(uppmax_id, "projects", cache_file=cache_path_from_args(uppmax_id, "projects", args), all_projects=True)
+        print_report(report_projects(shared, args.projects, cache_files, args.workers), args.report or 'tsv', args.skip_header)
+        sys.exit()
+
     # parse arguments
     project = args.projects[0]
-    data_dir = "/proj/{}/nobackup/NGI/DATA/".format(uppmax_id)
-    analysis_dir = "/proj/{}/nobackup/NGI/ANALYSIS/".format(uppmax_id)
+    # every report reads the filesystem through the same inventory, each tree at most once
+    inventory = inventory_from_args(uppmax_id, project, args)
 
 
     # output the result
     if args.low_coverage:
-        all_results = find_results_from_francesco(uppmax_id, project)
+        all_results = find_results_from_francesco(uppmax_id, project, inventory)
         samples = get_low_coverage(project, all_results)
         if samples:
             if not args.skip_header:
@@ -465,7 +507,7 @@ if __name__ == '__main__':
             print('All samples are above 28.5X')
 
     elif args.sequenced:
-        flowcells_samples = get_sequenced(project) # from incoming
+        flowcells_samples = get_sequenced(project, inventory) # from incoming
         if flowcells_samples:
             if not args.skip_header:
                 print('Sequenced samples')
@@ -475,7 +517,7 @@ if __name__ == '__main__':
             print('No samples sequenced')
 
     elif args.resequenced:
-        sequenced = get_sequenced(project)
+        sequenced = get_sequenced(project, inventory)
         resequenced = {}
         for sample, flowcells in sequenced.items():
             if len(flowcells) > 1:
@@ -488,7 +530,7 @@ if __name__ == '__main__':
 
     elif args.organized:
         # todo: print by flowcell, not by sample
-        organized = get_organized(project)
+        organized = get_organized(project, inventory)
         if organized:
             if not args.skip_header:
                 print('Organized flowcells/samples:')
@@ -498,7 +540,7 @@ if __name__ == '__main__':
             print('No organized samples')
 
     elif args.to_organize:
-        result = get_not_organized(project)
+        result = get_not_organized(project, inventory)
         if result:
             if not args.skip_header:
                 print('Samples to be organized:')
@@ -508,7 +550,7 @@ if __name__ == '__main__':
             print('All samples organized')
 
     elif args.analyzed:
-        samples = find_results_from_francesco(uppmax_id, project)
+        samples = find_results_from_francesco(uppmax_id, project, inventory)
         analyzed_samples = []
         sequenced_samples = []
         for sample_id, sample in samples.items():
@@ -535,7 +577,7 @@ if __name__ == '__main__':
             print('No analyzed samples')
 
     elif args.undetermined:
-        result = get_samples_with_undetermined(data_dir, project)
+        result = get_samples_with_undetermined(inventory)
         if result:
             if not args.skip_header:
                 print('Organized with undetermined:')
@@ -555,7 +597,7 @@ if __name__ == '__main__':
             print('No samples are being analyzed')
 
     elif args.to_analyze:
-        samples = find_results_from_francesco(uppmax_id, project)
+        samples = find_results_from_francesco(uppmax_id, project, inventory)
         samples_to_analyze = []
         for sample_id, sample in samples.items():
             organized = sample.get('#Data_runs', '')
@@ -582,7 +624,7 @@ if __name__ == '__main__':
             print('No samples under QC')
 
     elif args.analysis_failed:
-        result = get_samples_with_failed_analysis(project, analysis_dir)
+        result = get_samples_with_failed_analysis(project, inventory)
         if result:
             if not args.skip_header:
                 print('Samples with failed analysis:')
@@ -592,7 +634,7 @@ if __name__ == '__main__':
             print('No analysis failed')
 
     elif args.incoherent:
-        results_francesco = find_results_from_francesco(uppmax_id, project)
+        results_francesco = find_results_from_francesco(uppmax_id, project, inventory)
         result = get_incoherent_samples(results_francesco)
         if result:
             if not args.skip_header:
@@ -604,7 +646,7 @@ if __name__ == '__main__':
             print("All samples should be fine.")
 
     elif args.low_mapping:
-        result = find_results_from_francesco(uppmax_id, project)
+        result = find_results_from_francesco(uppmax_id, project, inventory)
 
         low_mapping = {}
         for sample_id, sample in result.items():
@@ -627,7 +669,7 @@ if __name__ == '__main__':
             print('All samples mapped more than 97%')
 
     elif args.flowcells:
-        result = get_sequenced(project)
+        result = get_sequenced(project, inventory)
         if result:
             for sample in sorted(list(result.keys())):
                 print('{} {}'.format(sample, ' '.join(result[sample])))
@@ -645,7 +687,7 @@ if __name__ == '__main__':
         # + organized on flowcells - done
         # sequenced, but not organized - done
         # undetermined
-        result = find_results_from_francesco(uppmax_id, project)
+        result = find_results_from_francesco(uppmax_id, project, inventory)
         sample = args.sample
         sample_entry = result.get(sample, {})
         if sample_entry:
@@ -665,7 +707,7 @@ if __name__ == '__main__':
         else:
             print('No stats for sample {}'.format(sample))
 
-        sequenced = get_sequenced(project)
+        sequenced = get_sequenced(project, inventory)
         flowcells = sequenced.get(sample, {})
         if flowcells:
             print('Sequenced on flowcells:')
@@ -674,7 +716,7 @@ if __name__ == '__main__':
         else:
             print('Nothing sequenced')
 
-        organized = get_organized(project)
+        organized = get_organized(project, inventory)
         flowcells = organized.get(sample, {})
         if flowcells:
             print('Organized on flowcells:')
@@ -683,7 +725,7 @@ if __name__ == '__main__':
         else:
             print('Nothing organized')
     else:
-        result = find_results_from_francesco(uppmax_id, project)
+        result = find_results_from_francesco(uppmax_id, project, inventory)
         if not args.skip_header:
             print("sample_name\t#Reads\tRaw_coverage\t#Aligned_reads\t%Aligned_reads\tAlign_cov\tAutosomalCoverage\t%Dup\tMedianInsertSize")
         for sample, sample_entry in result.items():
@@ -698,3 +740,5 @@ if __name__ == '__main__':
                     sample_entry.get('%Dup'),
                     sample_entry.get('MedianInsertSize')
                 ))
+
+    inventory.save()
@@ -2,24 +2,48 @@
 
 import re
 import math
-import unicodedata
 import csv
 import copy
 import sys
 import os
+import json
+import sqlite3
 import yaml
+import functools
+import itertools
 
 import couchdb
 import numpy
 import click
 
+try:
+    import pulp
+except ImportError:
+    pulp = None
+
 from collections import defaultdict, Counter, OrderedDict
 from time import time
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 from genologics.config import BASEURI, USERNAME, PASSWORD
 from genologics.lims import Lims
-from genologics.entities import Process
+from genologics.entities import Process, Project
+
+from statusdb_flowcells import DEFAULT_BATCH_SIZE, iter_change_batches, iter_docs_by_id
+
+#Local index of the flowcells each project was sequenced on, see ProjectFlowcellIndex
+DEFAULT_INDEX_FILE = os.path.join(os.environ.get("HOME", ""), ".ngi_config", "repooler_flowcells.sqlite")
+#Above this many candidate structures the auto solver leaves the exact search for the ILP/greedy ones
+EXACT_SOLVER_MAX_STRUCTURES = 60
+#Entities requested per LIMS batch/retrieve call
+LIMS_BATCH_SIZE = 500
+#LIMS entities already loaded during this run, by URI
+LIMS_CACHE = dict()
+#Largest pool (uL) that fits into a single well
+POOL_MAX = 200
+#Parameters that can be varied with --what_if
+WHAT_IF_PARAMETERS = ['target_clusters', 'clusters_per_lane', 'lane_volume', 'pool_excess', 'min_pipette']
 
 def credentials():
     try:
@@ -54,34 +78,112 @@ def connection():
     return couch
 
 
-def proj_struct(couch, project, target_clusters):
-    """"Fetches the structure of a project"""
-    db = couch['x_flowcells']
-    view = db.view('names/project_ids_list')
-    fc_track = defaultdict(set)
-
-    #Adds flowcells to ALL projects. Due to interactions its easier to just get FCs for ALL projects
-    for rec in view.rows:
-        fc = ''.join(rec.key)
-        fc = unicodedata.normalize('NFKD', fc).encode('ascii','ignore')
-        id = ''.join(rec.id)
-        id = unicodedata.normalize('NFKD', id).encode('ascii','ignore')
-        for projs in rec.value:
-            projs = ''.join(projs)
-            projs = unicodedata.normalize('NFKD', projs).encode('ascii','ignore')
-            if fc_track[projs] == set([]):
-                fc_track[projs] = dict()
-            fc_track[projs][fc] = id
+class ProjectFlowcellIndex(object):
+    """Index from project ids to the x_flowcells documents where the project was sequenced.
 
-    #Adds lanes and samples to flowcells, includes samples from other projects if they share lane
-    if fc_track[project] == set([]):
+    Stored in a SQLite file so that a run does not need to read the whole
+    names/project_ids_list view. The index is built once from the _changes feed
+    of x_flowcells, then kept up to date from the changes made since, so that all
+    its entries come from _entries.
+    """
+
+    #bumped whenever _entries changes, an index of another version is built again
+    VERSION = 2
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS flowcells (doc_id TEXT, fc TEXT, project TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS flowcells_project ON flowcells (project)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS flowcells_doc ON flowcells (doc_id)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def _meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def last_seq(self):
+        return self._meta('last_seq')
+
+    def clear(self):
+        self.connection.execute("DELETE FROM flowcells")
+        self.connection.execute("DELETE FROM meta")
+        self.connection.commit()
+
+    def update(self, db, batch_size=DEFAULT_BATCH_SIZE):
+        """Applies the changes made since the last update, the whole _changes feed on the first run"""
+        if self._meta('version') != self.VERSION:
+            self.clear()
+        last_seq = self.last_seq()
+        for changes, last_seq in iter_change_batches(db, last_seq if last_seq is not None else 0, batch_size):
+            for change in changes:
+                self.connection.execute("DELETE FROM flowcells WHERE doc_id = ?", (change['id'],))
+                if not change.get('deleted'):
+                    self.connection.executemany("INSERT INTO flowcells VALUES (?, ?, ?)", self._entries(change['doc']))
+            self._set_last_seq(last_seq)
+
+    def _set_last_seq(self, last_seq):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_seq', ?)", (json.dumps(last_seq),))
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (json.dumps(self.VERSION),))
+        self.connection.commit()
+
+    @staticmethod
+    def _entries(fc_doc):
+        """(doc id, flowcell, project) of a flowcell document: the flowcell is RunInfo.Id, the projects are taken from the sample names"""
+        try:
+            entry = fc_doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
+        except KeyError:
+            return []
+        fc = fc_doc.get('RunInfo', {}).get('Id', fc_doc['_id'])
+        projects = set()
+        for row in entry:
+            match = re.match(r'(P\d+)_', row.get('Sample', ''))
+            if match:
+                projects.add(match.group(1))
+        return [(fc_doc['_id'], fc, project) for project in sorted(projects)]
+
+    def flowcells(self, project):
+        """Returns a dict flowcell name -> document id of the flowcells where project was sequenced"""
+        rows = self.connection.execute("SELECT fc, doc_id FROM flowcells WHERE project = ? ORDER BY doc_id", (project,))
+        return dict(rows)
+
+    def close(self):
+        self.connection.close()
+
+
+def fetch_project_flowcells(couch, project, index_file=DEFAULT_INDEX_FILE, refresh_index=False):
+    """Fetches the lane statistics of the flowcells where project was sequenced, as a list of (flowcell, statistics)"""
+    db = couch['x_flowcells']
+    fc_index = ProjectFlowcellIndex(index_file)
+    if refresh_index:
+        fc_index.clear()
+    fc_index.update(db)
+    fc_ids = fc_index.flowcells(project)
+    fc_index.close()
+    if not fc_ids:
         raise Exception('Error: Project not logged in x_flowcells database!')
-    for fc, id in fc_track[project].items():
+    fc_names = dict((id, fc) for fc, id in fc_ids.items())
+    fc_stats = list()
+
+    #Only the flowcells of the project are fetched, in bulk
+    for doc in iter_docs_by_id(db, sorted(fc_names)):
         try:
-            entry = db[id]['illumina']
+            entry = doc['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
         except KeyError:
-            print("Error: Illumina table for db entry" , id, "doesn't exist!")
-        entry = db[id]['illumina']['Demultiplex_Stats']['Barcode_lane_statistics']
+            print("Error: Illumina table for db entry" , doc['_id'], "doesn't exist!")
+            continue
+        fc_stats.append((fc_names[doc['_id']], entry))
+    return fc_stats
+
+
+def lane_struct(fc_stats, project, target_clusters):
+    """Builds the structure of a project from the lane statistics of its flowcells"""
+    fc_track = dict()
+
+    #Adds lanes and samples to flowcells, includes samples from other projects if they share lane
+    for fc, entry in fc_stats:
         for index in range(0, len(entry)):
             lane = entry[index]['Lane']
             sample = entry[index]['Sample']
@@ -91,22 +193,26 @@ def proj_struct(couch, project, target_clusters):
                 clusters = entry[index]['PF Clusters']
             clusters = int(re.sub(r",", "", clusters))
 
-
-            if not isinstance(fc_track[project][fc], dict):
-                fc_track[project][fc] = dict()
-            if not lane in fc_track[project][fc]:
-                fc_track[project][fc][lane] = dict()
+            if not fc in fc_track:
+                fc_track[fc] = dict()
+            if not lane in fc_track[fc]:
+                fc_track[fc][lane] = dict()
             #Only counts samples for the given project, other samples are "auto-filled"
             if project in sample or sample in "Undetermined":
-                fc_track[project][fc][lane][sample] = clusters
+                fc_track[fc][lane][sample] = clusters
             else:
-                fc_track[project][fc][lane][sample] = target_clusters
+                fc_track[fc][lane][sample] = target_clusters
     #Removes any lanes that don't have any part project samples
-    for fc, lanes in fc_track[project].items():
-        for lane,sample in lanes.items():
+    for fc, lanes in fc_track.items():
+        for lane,sample in list(lanes.items()):
             if not any(project in s for s in list(sample.keys())):
-                   del fc_track[project][fc][lane]
-    return fc_track[project]
+                   del fc_track[fc][lane]
+    return fc_track
+
+
+def proj_struct(couch, project, target_clusters, index_file=DEFAULT_INDEX_FILE, refresh_index=False):
+    """"Fetches the structure of a project"""
+    return lane_struct(fetch_project_flowcells(couch, project, index_file, refresh_index), project, target_clusters)
 
 
 def parse_indata(struct, target_clusters):
@@ -212,6 +318,139 @@ def simple_unique_set(sample_struct, clusters_rem, target_clusters):
 
     return confirmed_best
 
+def _sample_bitsets(sample_struct, clusters_rem):
+    """Gives every sample (except Undetermined) a bit. Returns the bitset of each structure
+    and the bitset of the samples that still need clusters"""
+    bits = dict()
+    masks = dict()
+    for key, samples in sample_struct.items():
+        mask = 0
+        for sample in samples:
+            if sample != "Undetermined":
+                if not sample in bits:
+                    bits[sample] = 1 << len(bits)
+                mask |= bits[sample]
+        masks[key] = mask
+    required = 0
+    for sample, bit in bits.items():
+        if clusters_rem[sample] > 0:
+            required |= bit
+    return masks, required
+
+
+def exact_unique_set(sample_struct, clusters_rem, target_clusters):
+    """Creates the smallest set where every sample with remaining clusters appears once and only once.
+    Branch and bound over bitsets of samples; exponential in the worst case, meant for small projects"""
+    masks, required = _sample_bitsets(sample_struct, clusters_rem)
+    if not required:
+        #Every sample is done, nothing to optimise
+        return simple_unique_set(sample_struct, clusters_rem, target_clusters)
+    #Structures without any unfinished sample are never needed
+    candidates = sorted(key for key in masks if masks[key] & required)
+    required_bits = [1 << i for i in range(required.bit_length()) if required >> i & 1]
+    options = dict((bit, [key for key in candidates if masks[key] & bit]) for bit in required_bits)
+    max_cover = max([bin(masks[key] & required).count('1') for key in candidates] or [1])
+    best = [None]
+
+    def search(used, chosen):
+        remaining = required & ~used
+        if not remaining:
+            best[0] = list(chosen)
+            return
+        #Bound: every further structure covers at most max_cover of the remaining samples
+        bound = len(chosen) - (-bin(remaining).count('1') // max_cover)
+        if best[0] is not None and bound >= len(best[0]):
+            return
+        #Branch on the remaining sample with fewest structures left to cover it
+        branch = None
+        for bit in required_bits:
+            if bit & remaining:
+                keys = [key for key in options[bit] if not masks[key] & used]
+                if not keys:
+                    return
+                if branch is None or len(keys) < len(branch):
+                    branch = keys
+        #Structures covering most remaining samples first, to find a good solution early
+        for key in sorted(branch, key=lambda k: -bin(masks[k] & remaining).count('1')):
+            chosen.append(key)
+            search(used | masks[key], chosen)
+            chosen.pop()
+
+    search(0, [])
+    if best[0] is None:
+        raise Exception('Error: No set of pools contains every remaining sample once and only once!')
+    confirmed_best = dict((key, sample_struct[key]) for key in best[0])
+
+    validate_samples_unique(confirmed_best)
+    validate_all_samples_present(confirmed_best, sample_struct, clusters_rem)
+
+    return confirmed_best
+
+
+def ilp_unique_set(sample_struct, clusters_rem, target_clusters):
+    """Same as exact_unique_set, solved as an integer program with PuLP for large projects"""
+    if pulp is None:
+        raise Exception('Error: The ilp solver requires the pulp package!')
+    masks, required = _sample_bitsets(sample_struct, clusters_rem)
+    if not required:
+        return simple_unique_set(sample_struct, clusters_rem, target_clusters)
+    candidates = sorted(key for key in masks if masks[key] & required)
+    problem = pulp.LpProblem('repool', pulp.LpMinimize)
+    chosen = dict((key, pulp.LpVariable('s{}'.format(index), cat='Binary')) for index, key in enumerate(candidates))
+    problem += pulp.lpSum(chosen.values())
+    #Unfinished samples in exactly one structure, finished ones in at most one
+    samples = set(s for key in candidates for s in sample_struct[key] if s != "Undetermined")
+    for sample in samples:
+        containing = pulp.lpSum(chosen[key] for key in candidates if sample in sample_struct[key])
+        if clusters_rem[sample] > 0:
+            problem += containing == 1
+        else:
+            problem += containing <= 1
+    problem.solve(pulp.PULP_CBC_CMD(msg=False))
+    if pulp.LpStatus[problem.status] != 'Optimal':
+        raise Exception('Error: No set of pools contains every remaining sample once and only once!')
+    confirmed_best = dict((key, sample_struct[key]) for key in candidates if chosen[key].varValue > 0.5)
+
+    validate_samples_unique(confirmed_best)
+    validate_all_samples_present(confirmed_best, sample_struct, clusters_rem)
+
+    return confirmed_best
+
+
+UNIQUE_SET_SOLVERS = OrderedDict([('greedy', simple_unique_set), ('exact', exact_unique_set), ('ilp', ilp_unique_set)])
+
+
+def unique_set(sample_struct, clusters_rem, target_clusters, solver='auto'):
+    """Picks the lane structures to repool with the given solver. 'auto' uses the exact solver on small
+    projects, the ILP one (if pulp is installed) on large ones and falls back to the greedy heuristic"""
+    if solver == 'auto':
+        masks, required = _sample_bitsets(sample_struct, clusters_rem)
+        if len([key for key in masks if masks[key] & required]) <= EXACT_SOLVER_MAX_STRUCTURES:
+            solver = 'exact'
+        elif pulp is not None:
+            solver = 'ilp'
+        else:
+            solver = 'greedy'
+    return UNIQUE_SET_SOLVERS[solver](sample_struct, clusters_rem, target_clusters)
+
+
+def compare_solvers(sample_struct, clusters_rem, target_clusters, clusters_per_lane):
+    """Runs every available solver on the same input and prints the pools, lanes and time each needs"""
+    print('{:>8} {:>8} {:>8} {:>12}'.format('Solver', 'Pools', 'Lanes', 'Time (s)'))
+    for name, solver in UNIQUE_SET_SOLVERS.items():
+        if name == 'ilp' and pulp is None:
+            continue
+        start = time()
+        try:
+            best_sample_struct = solver(sample_struct, clusters_rem, target_clusters)
+        except Exception as e:
+            print('{:>8} {}'.format(name, e))
+            continue
+        elapsed = time() - start
+        needed_lanes = sample_distributor(best_sample_struct, clusters_rem, clusters_per_lane)[1]
+        print('{:>8} {:>8} {:>8} {:>12.4f}'.format(name, len(best_sample_struct), int(sum(needed_lanes.values())), elapsed))
+
+
 def validate_samples_unique(lane_maps):
     """Crude way to check that no samples are in different TYPES of lanes"""
     tempList = list()
@@ -318,11 +557,107 @@ def integrate_conc_diff(lane_maps, desired_ratios):
             volume_ratios[key] = numpy.zeros(len(volume_ratios[key]))
     return volume_ratios, conc_factor
 
+def _reduce_pool(uprounded, conc_factor, lane_sum, lanes, rem_list, minAdd, minTres):
+    """Brings the pool to at most 100% by removing minAdd steps from its samples, None if that is impossible.
+    Takes the same steps as iterative_realize_numbers, which removes one minAdd at a time from the sample most
+    overexpressed compared to its remaining clusters: every sample offers a decreasing series of overexpressions
+    and the largest ones are taken at once, only ties at the cut are settled step by step."""
+    if sum(uprounded) <= 1.0:
+        return uprounded
+    #minAdd and minTres have 6 decimals, so the volumes are whole millionths and the step count is exact.
+    #The last step is left to the step by step check, which also sees the rounding errors of the sum
+    units = numpy.round(numpy.asarray(uprounded)*1e6).astype(numpy.int64)
+    steps = -(-(int(units.sum()) - 10**6) // int(round(minAdd*1e6))) - 1
+
+    #Same expressions as the step by step version, so that values and comparisons are identical
+    def can_step(current):
+        #Sample must stay above minTres and keep more clusters than it needs
+        return (current >= minAdd + minTres) & ((current - minAdd)*conc_factor*lane_sum*lanes > rem_list)
+
+    def overexpression(current):
+        return (current*conc_factor)*lane_sum*lanes - rem_list
+
+    #Volumes after each step and overexpression before each allowed step, all samples stepped together
+    volumes = [numpy.array(uprounded, dtype=float)]
+    allowed = numpy.ones(len(uprounded), dtype=bool)
+    samples = []
+    oe_values = []
+    while True:
+        allowed &= can_step(volumes[-1])
+        index = numpy.nonzero(allowed)[0]
+        if len(index) == 0:
+            break
+        samples.append(index)
+        oe_values.append(overexpression(volumes[-1])[index])
+        current = volumes[-1].copy()
+        current[index] = current[index] - minAdd
+        volumes.append(current)
+    if sum(len(index) for index in samples) < steps:
+        return None
+
+    reduced = volumes[0].copy()
+    if steps > 0:
+        samples = numpy.concatenate(samples)
+        oe_values = numpy.concatenate(oe_values)
+        cut = numpy.sort(oe_values)[::-1][steps - 1]
+        taken = numpy.bincount(samples[oe_values > cut], minlength=len(uprounded))
+        reduced = numpy.array(volumes)[taken, numpy.arange(len(uprounded))]
+    #Samples overexpressed exactly as much as the cut and the last step, in argsort order like the step by step version
+    while sum(reduced) > 1.0:
+        ok = can_step(reduced)
+        for most_oe in overexpression(reduced).argsort()[::-1]:
+            if ok[most_oe]:
+                reduced[most_oe] = reduced[most_oe] - minAdd
+                break
+        else:
+            return None
+    return reduced
+
 def realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor, clusters_rem, total_lanes, pool_excess, lane_volume, min_pipette):
+    """Actual numbers need to be offset to:
+    Work with a pipette minimum and pipette threshold in relation to pool size (5 ul) + excess.
+    Lanesum is then downsized to sub 100% with as equal coverage as possible.
+    If impossible an extra lane is added for that struct, until a lane count works.
+    Computes the same numbers as iterative_realize_numbers, all reductions of a lane count at once.
+    """
+    extra_lanes=dict()
+    rounded_ratios = dict()
+    final_pool_sizes = dict()
+
+    for key, values in volume_ratios.items():
+        values = numpy.asarray(values, dtype=float)
+        rem_list = numpy.array([clusters_rem[name] for name in best_sample_struct[key]])
+        lane_sum = sum(lane_maps[key])
+        #Sets 'Undetermined's factor to 0, helps out later.
+        conc_factor[key][0] = 0
+        while True:
+            poolsize = lane_volume*total_lanes[key] + pool_excess
+            minTres = round(min_pipette/poolsize, 6)
+            minAdd = round(0.1/poolsize, 6)
+
+            #Rounds all values up, Undetermined stays at 0
+            uprounded = numpy.where(values == 0, 0.0, numpy.where(values <= minTres, minTres, values - values % minAdd))
+            reduced = _reduce_pool(uprounded, conc_factor[key], lane_sum, total_lanes[key], rem_list, minAdd, minTres)
+            if reduced is not None:
+                uprounded = reduced
+                break
+            #Add extra lane, new pool size
+            total_lanes[key] = total_lanes[key] + 1
+            extra_lanes[key] = extra_lanes.get(key, 0) + 1
+
+        final_pool_sizes[key] = poolsize*float(sum(uprounded))
+        if sum(uprounded) == 0:
+            rounded_ratios[key] = uprounded
+        else:
+            rounded_ratios[key] = uprounded/float(sum(uprounded))
+    return [rounded_ratios, final_pool_sizes, extra_lanes]
+
+def iterative_realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor, clusters_rem, total_lanes, pool_excess, lane_volume, min_pipette):
     """Actual numbers need to be offset to:
     Work with a pipette minimum and pipette threshold in relation to pool size (5 ul) + excess.
     Lanesum is then downsized to sub 100% with as equal coverage as possible.
     If impossible entire process is rerun with an extra lane for that struct.
+    Original step by step version of realize_numbers, kept as reference.
     """
     extra_lanes=dict()
     rounded_ratios = dict()
@@ -392,33 +727,46 @@ def realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor, c
     return [rounded_ratios, final_pool_sizes, extra_lanes]
 
 
-def generate_output(project_id, dest_plate_list, best_sample_struct,total_lanes, req_lanes, lane_maps, rounded_ratios,
-                    target_clusters, clusters_per_lane, extra_lanes, lane_volume, pool_excess, final_pool_sizes, volume_ratios, desired_ratios):
-    """"Gathers the container id and well name for all samples in project"""
-    timestamp = datetime.fromtimestamp(time()).strftime('%Y-%m-%d_%H:%M')
-
+def batch_resolve(lims, entities, cache, batch_size=LIMS_BATCH_SIZE):
+    """Loads LIMS entities (artifacts, containers, samples) through the batch/retrieve endpoints, batch_size per request.
+    cache maps URIs to loaded entities, the ones already in it are not requested again"""
+    missing = OrderedDict()
+    for entity in entities:
+        if not entity.uri in cache and not entity.uri in missing:
+            missing[entity.uri] = entity
+    missing = list(missing.values())
+    for start in range(0, len(missing), batch_size):
+        lims.get_batch(missing[start:start + batch_size])
+        for entity in missing[start:start + batch_size]:
+            cache[entity.uri] = entity
+    return [cache[entity.uri] for entity in entities]
+
+def fetch_lims_locations(project_id):
+    """Gets the project name and the container id and well name for all samples in project"""
     #Cred to Denis for providing a base epp
     location = dict()
     lims = Lims(BASEURI, USERNAME, PASSWORD)
-    allProjects = lims.get_projects()
-    for proj in allProjects:
-        if proj.id == project_id:
-            projName = proj.name
-            break
+    projName = Project(lims, id=project_id).name
 
     #Sets up source id
     #All normalization processes for project
     norms=['Library Normalization (MiSeq) 4.0', 'Library Normalization (Illumina SBS) 4.0','Library Normalization (HiSeq X) 1.0']
     pros=lims.get_processes(type=norms, projectname=projName)
-    #For all processes
-    for p in pros:
-        #For all artifacts in process
-        for o in p.all_outputs():
-            #If artifact is analyte type and has project name in sample
-            if o.type=="Analyte" and project_id in o.name:
-                location[o.name.split()[0]] = list()
-                location[o.name.split()[0]].append(o.location[0].id)
-                location[o.name.split()[0]].append(o.location[1])
+    #Artifacts of all processes are loaded together in batches, instead of one request each when first accessed.
+    #Container ids are part of the container URIs, so containers need no request at all
+    outputs = batch_resolve(lims, [o for p in pros for o in p.all_outputs()], LIMS_CACHE)
+    for o in outputs:
+        #If artifact is analyte type and has project name in sample
+        if o.type=="Analyte" and project_id in o.name:
+            location[o.name.split()[0]] = list()
+            location[o.name.split()[0]].append(o.location[0].id)
+            location[o.name.split()[0]].append(o.location[1])
+    return projName, location
+
+def generate_output(project_id, projName, location, dest_plate_list, best_sample_struct,total_lanes, req_lanes, lane_maps, rounded_ratios,
+                    target_clusters, clusters_per_lane, extra_lanes, lane_volume, pool_excess, final_pool_sizes, volume_ratios, desired_ratios):
+    """"Writes the summary, the robot csv and the dumpfile of the repool"""
+    timestamp = datetime.fromtimestamp(time()).strftime('%Y-%m-%d_%H:%M')
 
     #Continue coding from here
     generate_summary(projName, best_sample_struct, timestamp, project_id, dest_plate_list, total_lanes, req_lanes,
@@ -488,7 +836,7 @@ def generate_csv(projName, timestamp, location, dest_plate_list, total_lanes, be
     #Index 0 is number, index 1 is Letter
     wellIndex = [1, 1]
     destNo = 0
-    pool_max = 200
+    pool_max = POOL_MAX
 
     with open(name, 'w') as csvfile:
         writer = csv.writer(csvfile)
@@ -534,7 +882,7 @@ def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lane
     #Index 0 is number, index 1 is Letter
     wellIndex = [1, 1]
     destNo = 0
-    pool_max = 200
+    pool_max = POOL_MAX
 
     with open(name, 'w') as csvfile:
         writer = csv.writer(csvfile)
@@ -575,8 +923,123 @@ def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lane
                             wellIndex[0] = 1
                             destNo += 1
 
+def parse_grid(grid_options, defaults):
+    """Turns the --what_if options (name=value,value,...) into the list of parameter combinations to evaluate.
+    Parameters without a --what_if option keep the value given on the command line"""
+    values = OrderedDict((name, [defaults[name]]) for name in WHAT_IF_PARAMETERS)
+    for option in grid_options:
+        name, _, listed = option.partition('=')
+        if not name in values or not listed:
+            raise click.BadParameter('{} is not one of name=value,value,... with name in {}'.format(option, ', '.join(WHAT_IF_PARAMETERS)),
+                                     param_hint='--what_if')
+        try:
+            values[name] = [float(value) for value in listed.split(',')]
+        except ValueError:
+            raise click.BadParameter('{} contains a value that is not a number'.format(option), param_hint='--what_if')
+        #Keeps whole numbers as integers, e.g. 320e6 clusters
+        values[name] = [int(value) if value.is_integer() else value for value in values[name]]
+    return [OrderedDict(zip(values.keys(), combination)) for combination in itertools.product(*values.values())]
+
+
+def evaluate_parameters(fc_stats, project_id, solver, parameters):
+    """Runs the repooling calculations for one combination of parameters, without LIMS.
+    Returns the parameters together with the lanes needed and whether the pools can be pipetted"""
+    row = OrderedDict(parameters)
+    try:
+        structure = lane_struct(fc_stats, project_id, parameters['target_clusters'])
+        [lane_maps, clusters_rem, sample_struct] = parse_indata(structure, parameters['target_clusters'])
+        best_sample_struct = unique_set(sample_struct, clusters_rem, parameters['target_clusters'], solver)
+        [desired_ratios, total_lanes, req_lanes] = sample_distributor(best_sample_struct, clusters_rem, parameters['clusters_per_lane'])
+        [volume_ratios, conc_factor] = integrate_conc_diff(lane_maps, desired_ratios)
+        [rounded_ratios, final_pool_sizes, extra_lanes] = realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor, clusters_rem,
+                                                                          total_lanes, parameters['pool_excess'], parameters['lane_volume'],
+                                                                          parameters['min_pipette'])
+    except Exception as e:
+        row.update([('ideal_lanes', ''), ('total_lanes', ''), ('extra_lanes', ''), ('largest_pool', ''), ('feasible', False), ('note', str(e))])
+        return row
+    largest_pool = max(list(final_pool_sizes.values()) or [0])
+    row['ideal_lanes'] = round(sum(req_lanes.values()), 3)
+    row['total_lanes'] = int(sum(total_lanes.values()))
+    row['extra_lanes'] = sum(extra_lanes.values())
+    row['largest_pool'] = round(largest_pool, 2)
+    row['feasible'] = largest_pool <= POOL_MAX
+    row['note'] = '' if row['feasible'] else 'A pool does not fit into a single well'
+    return row
+
+
+def run_what_if(fc_stats, project_id, solver, combinations, workers):
+    """Evaluates every combination of parameters in parallel and prints one table, cheapest feasible combination first"""
+    evaluate = functools.partial(evaluate_parameters, fc_stats, project_id, solver)
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            rows = list(pool.map(evaluate, combinations))
+    else:
+        rows = [evaluate(parameters) for parameters in combinations]
+    rows.sort(key=lambda row: (not row['feasible'], row['total_lanes'] if row['feasible'] else 0, row['extra_lanes'] if row['feasible'] else 0))
+    columns = list(rows[0].keys())
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join(str(row[column]) for column in columns))
+    return rows
+
+def save_fixture(fixture_file, project_id, fc_stats, projName, location):
+    """Records what repooler reads from statusdb and LIMS for a project, so that it can be replayed offline"""
+    fixture = OrderedDict([('project_id', project_id), ('project_name', projName),
+                           ('flowcells', fc_stats), ('locations', location)])
+    with open(fixture_file, 'w') as f:
+        json.dump(fixture, f, indent=1)
+
+
+def load_fixture(fixture_file):
+    """Reads a fixture written by save_fixture"""
+    with open(fixture_file) as f:
+        return json.load(f)
+
+
+def benchmark_stages(fixture, solver, target_clusters, clusters_per_lane, lane_volume, pool_excess, min_pipette, repeats):
+    """Times every stage of the calculation on a fixture, best of repeats runs. Every stage gets a fresh copy
+    of its input since some modify it. Also checks that realize_numbers agrees with iterative_realize_numbers"""
+    timings = OrderedDict()
+
+    def timed(name, function, *args):
+        best = None
+        for repeat in range(repeats):
+            copied = copy.deepcopy(args)
+            start = time()
+            result = function(*copied)
+            elapsed = time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings[name] = best
+        return result
+
+    structure = timed('lane_struct', lane_struct, fixture['flowcells'], fixture['project_id'], target_clusters)
+    [lane_maps, clusters_rem, sample_struct] = timed('parse_indata', parse_indata, structure, target_clusters)
+    for name, unique_set_solver in UNIQUE_SET_SOLVERS.items():
+        if name == 'ilp' and pulp is None:
+            continue
+        try:
+            timed('unique_set ({})'.format(name), unique_set_solver, sample_struct, clusters_rem, target_clusters)
+        except Exception:
+            timings['unique_set ({})'.format(name)] = None
+    best_sample_struct = unique_set(sample_struct, clusters_rem, target_clusters, solver)
+    [desired_ratios, total_lanes, req_lanes] = timed('sample_distributor', sample_distributor, best_sample_struct, clusters_rem, clusters_per_lane)
+    [volume_ratios, conc_factor] = timed('integrate_conc_diff', integrate_conc_diff, lane_maps, desired_ratios)
+    numbers_args = (lane_maps, best_sample_struct, volume_ratios, conc_factor, clusters_rem, total_lanes, pool_excess, lane_volume, min_pipette)
+    batched = timed('realize_numbers', realize_numbers, *numbers_args)
+    iterative = timed('iterative_realize_numbers', iterative_realize_numbers, *numbers_args)
+
+    same = batched[2] == iterative[2] and all(numpy.array_equal(batched[0][key], iterative[0][key]) and
+                                              batched[1][key] == iterative[1][key] for key in iterative[0])
+    print('{} ({}): {} samples, {} lane structures, {} selected'.format(fixture['project_id'], fixture['project_name'],
+                                                                         len(clusters_rem), len(sample_struct), len(best_sample_struct)))
+    for name, elapsed in timings.items():
+        print('  {:<32} {}'.format(name, 'failed' if elapsed is None else '{:.6f}s'.format(elapsed)))
+    print('  realize_numbers matches iterative_realize_numbers: {}'.format('yes' if same else 'NO'))
+    return timings
+
 @click.command()
-@click.option('--project_id', required=True,help='ID of project to repool. \nExamples: P2652, P1312 etc.')
+@click.option('--project_id', help='ID of project to repool, required unless replaying a fixture. \nExamples: P2652, P1312 etc.')
 @click.option('--dest_plate_list', default=['dp_1'],
               help='List of destination plates for the robot\'s csv file. Include too many rather than too few; excess will be unused. Default: [dp_1]')
 @click.option('--target_clusters', default=320*1000000, help='Threshold of clusters per sample. \nDefault:320*1000000')
@@ -584,22 +1047,63 @@ def generate_dumpfile(projName, timestamp, location, dest_plate_list, total_lane
 @click.option('--lane_volume', default=5, help='Lane volume. \nDefault:5 (uL)')
 @click.option('--pool_excess', default=2, help='Excess pool volume when creating a pool. \nDefault:2 (uL)')
 @click.option('--min_pipette', default=1, help='Minimum pipette volume. \nDefault:1 (uL)')
-
-def main(target_clusters, clusters_per_lane, project_id, dest_plate_list, lane_volume, pool_excess, min_pipette):
+@click.option('--index_file', default=DEFAULT_INDEX_FILE, help='Local index of the flowcells of each project, updated at every run. \nDefault:~/.ngi_config/repooler_flowcells.sqlite')
+@click.option('--refresh_index', is_flag=True, help='Rebuild the local flowcell index from scratch.')
+@click.option('--solver', default='auto', type=click.Choice(['auto', 'exact', 'ilp', 'greedy']),
+              help='Method picking the lane structures to repool. auto: exact on small projects, ilp (needs pulp) on large ones. \nDefault:auto')
+@click.option('--compare_solvers', 'compare', is_flag=True, help='Only print the result and time of every solver for the project.')
+@click.option('--what_if', multiple=True,
+              help='Only print the lanes needed for every combination of parameter values, e.g. --what_if lane_volume=5,6 --what_if min_pipette=0.5,1. '
+                   'Parameters: target_clusters, clusters_per_lane, lane_volume, pool_excess, min_pipette.')
+@click.option('--workers', default=1, help='Number of processes evaluating the --what_if combinations. \nDefault:1')
+@click.option('--record', type=click.Path(), help='Save what is read from statusdb and LIMS for the project to this fixture file.')
+@click.option('--replay', type=click.Path(exists=True), help='Read the project from a fixture file instead of statusdb and LIMS.')
+@click.option('--benchmark', type=click.Path(exists=True), multiple=True,
+              help='Only time every stage of the calculation on the given fixture file(s), e.g. a small, a medium and a large project.')
+@click.option('--repeats', default=5, type=click.IntRange(1), help='Runs per stage when benchmarking, the best time is kept. \nDefault:5')
+
+def main(target_clusters, clusters_per_lane, project_id, dest_plate_list, lane_volume, pool_excess, min_pipette, index_file, refresh_index, solver, compare, what_if, workers, record, replay, benchmark, repeats):
     """Application that calculates samples under threshold for a project, then calculate the optimal composition for reaching the threshold
     without altering concentrations nor the structure of the pools. Outputs both a summary as well as a functional csv file."""
     print("\nWARNING: Output from repooler is experimental. Remember to review all numbers before re-sequencing.\n")
 
-    couch = connection()
-    structure = proj_struct(couch, project_id, target_clusters)
+    if benchmark:
+        for fixture_file in benchmark:
+            benchmark_stages(load_fixture(fixture_file), solver, target_clusters, clusters_per_lane, lane_volume, pool_excess, min_pipette, repeats)
+        return
+    if what_if:
+        combinations = parse_grid(what_if, dict(target_clusters=target_clusters, clusters_per_lane=clusters_per_lane,
+                                                lane_volume=lane_volume, pool_excess=pool_excess, min_pipette=min_pipette))
+    if replay:
+        fixture = load_fixture(replay)
+        project_id = fixture['project_id']
+        fc_stats = fixture['flowcells']
+        projName, location = fixture['project_name'], fixture['locations']
+    elif project_id is None:
+        raise click.UsageError('--project_id is required unless replaying a fixture')
+    else:
+        couch = connection()
+        fc_stats = fetch_project_flowcells(couch, project_id, index_file, refresh_index)
+        if record:
+            projName, location = fetch_lims_locations(project_id)
+            save_fixture(record, project_id, fc_stats, projName, location)
+    if what_if:
+        run_what_if(fc_stats, project_id, solver, combinations, workers)
+        return
+    structure = lane_struct(fc_stats, project_id, target_clusters)
     [lane_maps, clusters_rem, sample_struct] = parse_indata(structure, target_clusters)
-    best_sample_struct = simple_unique_set(sample_struct, clusters_rem, target_clusters)
+    if compare:
+        compare_solvers(sample_struct, clusters_rem, target_clusters, clusters_per_lane)
+        return
+    best_sample_struct = unique_set(sample_struct, clusters_rem, target_clusters, solver)
     [desired_ratios, total_lanes, req_lanes] = sample_distributor(best_sample_struct, clusters_rem, clusters_per_lane)
     [volume_ratios, conc_factor] = integrate_conc_diff(lane_maps, desired_ratios)
     [rounded_ratios, final_pool_sizes, extra_lanes] = realize_numbers(lane_maps, best_sample_struct, volume_ratios, conc_factor,
                                                                       clusters_rem, total_lanes, pool_excess, lane_volume, min_pipette)
 
-    generate_output(project_id, dest_plate_list, best_sample_struct, total_lanes, req_lanes, lane_maps, rounded_ratios,
+    if not replay and not record:
+        projName, location = fetch_lims_locations(project_id)
+    generate_output(project_id, projName, location, dest_plate_list, best_sample_struct, total_lanes, req_lanes, lane_maps, rounded_ratios,
                     target_clusters, clusters_per_lane, extra_lanes,lane_volume,pool_excess, final_pool_sizes, volume_ratios, desired_ratios)
 if __name__ == '__main__':
     main()
@@ -0,0 +1,276 @@
+"""Helpers shared by the scripts that scan the statusdb flowcell databases
+(compute_undet_index_stats.py, compute_production_stats.py, hiseqX_run_times.py).
+"""
+import os
+import json
+import zlib
+import sqlite3
+import itertools
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#number of documents fetched per request when paging through _all_docs
+DEFAULT_BATCH_SIZE = 500
+
+
+def iter_flowcell_docs(flowcell_db, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield every document of a flowcell database exactly once.
+
+    Pages through ``_all_docs`` with ``include_docs=true``, so a full scan costs
+    one request per ``batch_size`` documents instead of one request for each
+    ``flowcell_db[doc_id]`` access. Design documents are skipped.
+
+    :param couchdb.Database flowcell_db: the database to scan (e.g. x_flowcells)
+    :param int batch_size: number of documents fetched per request
+    :returns: generator of documents (dict-like)
+    """
+    for row in flowcell_db.iterview('_all_docs', batch_size, include_docs=True):
+        if row.id.startswith('_design/'):
+            continue
+        yield row.doc
+
+
+def iter_docs_by_id(flowcell_db, doc_ids, batch_size=DEFAULT_BATCH_SIZE):
+    """Yields the documents with the given ids, fetched batch_size at a time with _all_docs?keys=[...]"""
+    for start in range(0, len(doc_ids), batch_size):
+        for row in flowcell_db.view('_all_docs', keys=doc_ids[start:start + batch_size], include_docs=True):
+            if row.doc is not None:
+                yield row.doc
+
+
+def split_in_partitions(doc_ids, partitions):
+    """Splits the sorted list doc_ids in at most partitions contiguous lists of similar size"""
+    size = max(1, -(-len(doc_ids) // max(1, partitions)))
+    return [doc_ids[start:start + size] for start in range(0, len(doc_ids), size)]
+
+
+def iter_change_batches(flowcell_db, since=0, batch_size=DEFAULT_BATCH_SIZE):
+    """Reads the _changes feed of a flowcell database from since onwards.
+
+    Yields tuples (changes, last_seq), one per batch of at most batch_size changes.
+    Changes carry the full document (include_docs), design documents are skipped.
+    """
+    while True:
+        changes = flowcell_db.changes(since=since, include_docs=True, limit=batch_size)
+        results = changes['results']
+        since = changes['last_seq']
+        yield [change for change in results if not change['id'].startswith('_design/')], since
+        if len(results) < batch_size:
+            break
+
+
+class FlowcellCache(object):
+    """Local copy of a flowcell database stored in a SQLite file.
+
+    Documents are kept as compressed JSON together with the last sequence
+    read from the ``_changes`` feed, so that an update only downloads the
+    documents created, modified or deleted since the previous run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, doc BLOB)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def last_seq(self):
+        """Returns the last sequence of the _changes feed stored in the cache, 0 if empty"""
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'last_seq'").fetchone()
+        if row is None:
+            return 0
+        return json.loads(row[0])
+
+    def clear(self):
+        """Removes all documents and the stored sequence"""
+        self.connection.execute("DELETE FROM docs")
+        self.connection.execute("DELETE FROM meta")
+        self.connection.commit()
+
+    def update(self, flowcell_db, batch_size=DEFAULT_BATCH_SIZE):
+        """Pulls the changes made to flowcell_db since the last update.
+
+        :returns: number of changes applied to the cache
+        """
+        applied = 0
+        for results, last_seq in iter_change_batches(flowcell_db, self.last_seq(), batch_size):
+            for change in results:
+                if change.get('deleted'):
+                    self.connection.execute("DELETE FROM docs WHERE id = ?", (change['id'],))
+                else:
+                    self.connection.execute("INSERT OR REPLACE INTO docs (id, doc) VALUES (?, ?)",
+                                            (change['id'], self._pack(change['doc'])))
+                applied += 1
+            #commit after every batch so an interrupted update can be resumed
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_seq', ?)",
+                                    (json.dumps(last_seq),))
+            self.connection.commit()
+        return applied
+
+    def iter_docs(self, first_id=None, last_id=None):
+        """Yields the cached documents sorted by document id, optionally only those with first_id <= id <= last_id"""
+        if first_id is None:
+            rows = self.connection.execute("SELECT doc FROM docs ORDER BY id")
+        else:
+            rows = self.connection.execute("SELECT doc FROM docs WHERE id BETWEEN ? AND ? ORDER BY id", (first_id, last_id))
+        for (doc,) in rows:
+            yield self._unpack(doc)
+
+    def doc_ids(self):
+        """Returns the sorted ids of the cached documents"""
+        return [doc_id for (doc_id,) in self.connection.execute("SELECT id FROM docs ORDER BY id")]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _pack(doc):
+        return sqlite3.Binary(zlib.compress(json.dumps(doc).encode('utf-8')))
+
+    @staticmethod
+    def _unpack(blob):
+        return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class FlowcellReader(object):
+    """Gives access to the documents of the flowcell databases (x_flowcells, flowcells).
+
+    Without a cache directory documents are read from statusdb in batches. With a
+    cache directory each database is mirrored in ``<cache_dir>/<db_name>.sqlite``:
+    the cache is brought up to date from the _changes feed (unless ``offline``)
+    and documents are then read locally. ``refresh`` discards the cache and
+    downloads the whole database again.
+    """
+
+    def __init__(self, couch, batch_size=DEFAULT_BATCH_SIZE, cache_dir=None, offline=False, refresh=False, workers=1):
+        if offline and cache_dir is None:
+            raise ValueError("offline mode requires a cache directory")
+        self.couch = couch
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.refresh = refresh
+        self.workers = workers
+        #databases already refreshed during this run
+        self._refreshed = set()
+
+    def iter_docs(self, db_name):
+        """Yields every document of the database db_name"""
+        if self.cache_dir is None:
+            for doc in iter_flowcell_docs(self.couch[db_name], self.batch_size):
+                yield doc
+            return
+        cache = self.open_cache(db_name)
+        try:
+            for doc in cache.iter_docs():
+                yield doc
+        finally:
+            cache.close()
+
+    def map_partitions(self, db_name, function):
+        """Applies function to the documents of db_name split in contiguous ranges of document ids.
+
+        function receives an iterable of documents and must be picklable (a module level
+        function or a functools.partial of one), as with more than one worker it runs in a
+        process pool. Documents are fetched from statusdb by a thread pool, batch_size at a time and
+        with at most workers batches fetched ahead of the workers, or read from the cache directly
+        by the worker processes. The results are returned in document id
+        order, one per range: merging them in that order gives the same result as applying
+        function to the whole database, as long as the merge is associative.
+        """
+        if self.workers <= 1:
+            return [function(self.iter_docs(db_name))]
+        #a few ranges per worker, so that a slow range does not leave the other workers idle
+        partitions = self.workers * 4
+        if self.cache_dir is not None:
+            cache = self.open_cache(db_name)
+            ranges = [(doc_ids[0], doc_ids[-1]) for doc_ids in split_in_partitions(cache.doc_ids(), partitions)]
+            cache.close()
+            with ProcessPoolExecutor(self.workers) as pool:
+                results = [pool.submit(_map_cache_range, cache.path, first_id, last_id, function) for first_id, last_id in ranges]
+                return [result.result() for result in results]
+        flowcell_db = self.couch[db_name]
+        doc_ids = [row.id for row in flowcell_db.view('_all_docs') if not row.id.startswith('_design/')]
+        fetch = functools.partial(_fetch_docs, flowcell_db, batch_size=self.batch_size)
+        #documents are large: ranges of at most batch_size documents, and only those being fetched
+        #or processed are kept in memory
+        id_ranges = iter(split_in_partitions(doc_ids, max(partitions, -(-len(doc_ids) // self.batch_size))))
+        with ThreadPoolExecutor(self.workers) as fetchers, ProcessPoolExecutor(self.workers) as pool:
+            fetching = deque(fetchers.submit(fetch, ids) for ids in itertools.islice(id_ranges, self.workers))
+            results = []
+            running = set()
+            while fetching:
+                docs = fetching.popleft().result()
+                for ids in itertools.islice(id_ranges, 1):
+                    fetching.append(fetchers.submit(fetch, ids))
+                if len(running) >= self.workers:
+                    running = wait(running, return_when=FIRST_COMPLETED).not_done
+                result = pool.submit(function, docs)
+                del docs
+                running.add(result)
+                results.append(result)
+            return [result.result() for result in results]
+
+    def update_seq(self, db_name):
+        """Returns the sequence of db_name the documents are read at: the last sequence of the
+        cache (updated unless offline), or the current update_seq of the database without cache"""
+        if self.cache_dir is None:
+            return self.couch[db_name].info()['update_seq']
+        cache = self.open_cache(db_name)
+        try:
+            return cache.last_seq()
+        finally:
+            cache.close()
+
+    def open_cache(self, db_name):
+        """Returns the FlowcellCache of db_name, updated unless working offline"""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        cache = FlowcellCache(os.path.join(self.cache_dir, "{}.sqlite".format(db_name)))
+        if self.refresh and db_name not in self._refreshed:
+            cache.clear()
+            self._refreshed.add(db_name)
+        if self.offline:
+            if len(cache) == 0:
+                print("WARNING: offline cache for {} is empty".format(db_name))
+        else:
+            cache.update(self.couch[db_name], self.batch_size)
+        return cache
+
+
+def _fetch_docs(flowcell_db, doc_ids, batch_size=DEFAULT_BATCH_SIZE):
+    return list(iter_docs_by_id(flowcell_db, doc_ids, batch_size))
+
+
+def _map_cache_range(path, first_id, last_id, function):
+    cache = FlowcellCache(path)
+    try:
+        return function(cache.iter_docs(first_id, last_id))
+    finally:
+        cache.close()
+
+
+def add_reader_arguments(parser):
+    """Adds the options controlling how flowcell documents are read to an argparse parser"""
+    parser.add_argument('--batch-size', help="number of flowcell documents fetched per request to statusdb", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--cache-dir', help="directory where a local copy of the flowcell databases is kept and updated incrementally", type=str, default=None)
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument('--refresh', help="discard the local cache and download the flowcell databases again", action='store_true')
+    cache_mode.add_argument('--offline', help="read only from the local cache, do not contact statusdb for flowcells", action='store_true')
+    parser.add_argument('--workers', help="number of parallel workers used to fetch and process the flowcells", type=int, default=1)
+
+
+def check_reader_arguments(parser, args):
+    """Reports with parser.error the combinations of the options added by add_reader_arguments
+    that FlowcellReader does not accept, to be called after parse_args"""
+    if args.offline and args.cache_dir is None:
+        parser.error("--offline requires --cache-dir")
+
+
+def reader_from_args(couch, args):
+    """Builds a FlowcellReader from the options added by add_reader_arguments"""
+    return FlowcellReader(couch, args.batch_size, args.cache_dir, args.offline, args.refresh, args.workers)